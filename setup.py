@@ -27,4 +27,7 @@ setuptools.setup(
         "Development Status :: 3 - Alpha",
     ],
     python_requires='>=3.6',
+    extras_require={
+        "numpy": ["numpy"],
+    },
 )
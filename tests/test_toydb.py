@@ -1,5 +1,8 @@
 
 import shutil
+import asyncio
+from pathlib import Path
+import pytest
 import toydb as tdb
 
 
@@ -84,3 +87,932 @@ def test_table_query():
         where=lambda r: None not in r.values()
     ) == [data[0]]
     db.remove()
+
+def test_index_query():
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    # Create a table
+    table_name = "test_table"
+    schema = {
+        "some_text": tdb.dtypes.STRING[50],
+        "a_number": tdb.dtypes.I32,
+    }
+    db.createTable(table_name,schema)
+    data = [(str(i % 7),i) for i in range(500)] + [(None,None)]
+    db.insertMany(table_name,data[:250])
+    # Build the index over existing rows, then keep it updated
+    db.createIndex(table_name,"a_number")
+    db.createIndex(table_name,"some_text")
+    db.insertMany(table_name,data[250:])
+    col = tdb.expr.col
+    where = (col("a_number") >= 100) & (col("a_number") < 120)
+    assert db._indexScan(table_name,where) == list(range(100,120))
+    assert db.query(table_name,where=where) == data[100:120]
+    assert db.query(table_name,where=col("some_text") == "3") == [
+        r for r in data if r[0] == "3"]
+    # Deleting rows shifts row numbers
+    db.delete(table_name,col("a_number") < 10)
+    assert db.query(table_name,where=col("a_number") <= 12) == data[10:13]
+    # Reopen the database and use the persisted index
+    db = tdb.Database("tmp.tdb")
+    assert db.query(table_name,where=col("a_number") == 400) == [data[400]]
+    db.remove()
+
+def test_primary_key():
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    # Create a table with a primary key
+    table_name = "test_table"
+    schema = {
+        "user_id": tdb.dtypes.STRING[16],
+        "a_number": tdb.dtypes.I32,
+    }
+    db.createTable(table_name,schema,primary_key="user_id")
+    data = [(f"user-{i}",i) for i in range(2000)]
+    db.insertMany(table_name,data)
+    assert db.get(table_name,"user-1234") == data[1234]
+    assert db.get(table_name,"nobody") is None
+    # Keys that can't be stored never match (rather than being truncated)
+    assert db.get(table_name,"user-1234" + "\x00" * 8) is None
+    assert db.get(table_name,None) is None
+    with pytest.raises(TypeError):
+        db.get(table_name,1234)
+    index = db._indexes[table_name]["user_id"]
+    assert index.containsMany(["user-5","nobody","user-1999"]) == [True,False,True]
+    assert index.getMany(["user-5",None]) == [5,None]
+    assert db.query(table_name,where=tdb.expr.col("user_id") == "user-7") == [data[7]]
+    # Keys must be unique and not null
+    with pytest.raises(tdb.exceptions.UniqueConstraintError):
+        db.insert(table_name,("user-42",0))
+    with pytest.raises(tdb.exceptions.SchemaError):
+        db.insert(table_name,(None,0))
+    assert len(db.query(table_name)) == len(data)
+    # Deleting a row frees up its key
+    db.delete(table_name,tdb.expr.col("user_id") == "user-42")
+    assert db.get(table_name,"user-42") is None
+    assert db.get(table_name,"user-43") == data[43]
+    db.insert(table_name,("user-42",-1))
+    assert db.get(table_name,"user-42") == ("user-42",-1)
+    db.remove()
+
+def test_insert_many_batches():
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    table_name = "test_table"
+    schema = {
+        "some_text": tdb.dtypes.STRING[10],
+        "a_number": tdb.dtypes.I32,
+    }
+    db.createTable(table_name,schema,primary_key="a_number")
+    # Any iterable works, and the last batch can be partial
+    data = [(str(i),i) for i in range(25)]
+    db.insertMany(table_name,iter(data),batch_size=10)
+    assert db.query(table_name) == data
+    # An invalid row rejects its whole batch
+    with pytest.raises(tdb.exceptions.SchemaError):
+        db.insertMany(table_name,[("a",100),("b","oops")])
+    with pytest.raises(tdb.exceptions.UniqueConstraintError):
+        db.insertMany(table_name,[("a",100),("b",100)])
+    assert db.query(table_name) == data
+    # Big loads checkpoint between batches, so the log stays small
+    db.wal_checkpoint_bytes = 4_096
+    sizes = []
+    def rows():
+        for i in range(1_000,6_000):
+            sizes.append(db._wal.size())
+            yield (str(i),i)
+    db.insertMany(table_name,rows(),batch_size=100)
+    assert max(sizes) < 4_096 + 100 * 64
+    assert len(db.query(table_name)) == 5_025
+    db.remove()
+
+def test_mmap_reads():
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    table_name = "test_table"
+    schema = {
+        "some_text": tdb.dtypes.STRING[10],
+        "a_number": tdb.dtypes.I32,
+    }
+    db.createTable(table_name,schema)
+    assert db.query(table_name) == []
+    data = [(str(i),i) for i in range(100)]
+    db.insertMany(table_name,data)
+    assert db._readLine(table_name,42) == list(data[42])
+    assert db._readLine(table_name,-1) == list(data[-1])
+    # The mapping is shared between reads...
+    mm = db._getMap(table_name)
+    assert db.query(table_name) == data
+    assert db._getMap(table_name) is mm
+    # ...and refreshed after a write
+    db.insert(table_name,("new",100))
+    assert db._readLine(table_name,-1) == ["new",100]
+    db.remove()
+
+def test_numpy_scan():
+    np = pytest.importorskip("numpy")
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    table_name = "test_table"
+    schema = {
+        "some_text": tdb.dtypes.STRING[10],
+        "a_number": tdb.dtypes.I32,
+        "a_float": tdb.dtypes.F64,
+    }
+    db.createTable(table_name,schema)
+    data = [(str(i % 3),i,i / 2) for i in range(100)] + [(None,None,None)]
+    db.insertMany(table_name,data)
+    arrays = db.scanArray(table_name)
+    assert arrays["a_number"].tolist() == [r[1] for r in data]
+    assert arrays["some_text"].mask.tolist() == [r[0] is None for r in data]
+    col = tdb.expr.col
+    where = (col("a_number") >= 10) & (col("some_text") == "1")
+    res = db.query(table_name,select=["a_float"],where=where,as_numpy=True,limit=5)
+    assert res["a_float"].tolist() == [r[2] for r in db.query(table_name,where=where,limit=5)]
+    db.remove()
+
+def test_expressions():
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    table_name = "test_table"
+    schema = {
+        "some_text": tdb.dtypes.STRING[10],
+        "a_number": tdb.dtypes.I32,
+        "boolean_val": tdb.dtypes.BOOL,
+    }
+    db.createTable(table_name,schema,primary_key="a_number")
+    db.createIndex(table_name,"some_text")
+    data = [(str(i % 10) if i % 7 else None,i,i % 2 == 0) for i in range(200)]
+    db.insertMany(table_name,data)
+    col = tdb.expr.col
+    cases = [
+        (col("some_text") != "3", lambda r: r[0] is not None and r[0] != "3"),
+        (col("some_text").isin(["1","2"]), lambda r: r[0] in ("1","2")),
+        (col("some_text").isnull(), lambda r: r[0] is None),
+        (~(col("boolean_val") == True), lambda r: not r[2]),
+        (col("a_number").between(5,9) | (col("some_text") > "8"),
+            lambda r: 5 <= r[1] <= 9 or (r[0] is not None and r[0] > "8")),
+        (col("a_number").isin([3,50,1000]) & (col("boolean_val") == True),
+            lambda r: r[1] in (3,50) and r[2]),
+        # Comparisons against null never match
+        (col("a_number") < None, lambda r: False),
+        (col("some_text") != None, lambda r: False),
+        (~(col("some_text") >= None) & (col("a_number") < 3), lambda r: r[1] < 3),
+    ]
+    for where, check in cases:
+        assert db.query(table_name,where=where) == [r for r in data if check(r)]
+    # AND-ed comparisons are combined into one range per column
+    where = (col("a_number") > 5) & (col("a_number") <= 9) & (col("a_number") >= 5) \
+        & (col("some_text") != "1") & (col("boolean_val") == True)
+    assert tdb.expr.column_bounds(where.conjuncts(),["a_number","some_text"]) == {
+        "a_number": (5,9,False,True)}
+    # Index lookups for `isin` and `|`
+    assert db._indexScan(table_name,col("a_number").isin([3,50,1000])) == [3,50]
+    assert db._indexScan(table_name,
+        (col("some_text") == "1") | (col("a_number") == 2)) == [
+        i for i, r in enumerate(data) if r[0] == "1" or i == 2]
+    assert db._indexScan(table_name,
+        (col("boolean_val") == True) | col("a_number").isin([1])) is None
+    # Expressions work with delete too
+    db.delete(table_name,col("some_text").isnull() | (col("a_number") >= 100))
+    assert db.query(table_name) == [r for r in data[:100] if r[0] is not None]
+    db.remove()
+
+def test_projection():
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    table_name = "test_table"
+    schema = {
+        "long_text": tdb.dtypes.STRING[200],
+        "a_number": tdb.dtypes.I32,
+        "other_text": tdb.dtypes.STRING[5],
+        "boolean_val": tdb.dtypes.BOOL,
+    }
+    db.createTable(table_name,schema)
+    data = [("x" * i,i,None if i % 3 else str(i),i % 2 == 0) for i in range(50)]
+    db.insertMany(table_name,data)
+    rstruct = db._structs[table_name]
+    proj = rstruct.project(["boolean_val","a_number"])
+    assert proj is rstruct.project(["a_number","boolean_val"])
+    assert proj.format == ">201x?i6x???"
+    assert proj.unpack(rstruct.pack(data[3])) == [3,False]
+    # Only the selected and filtered columns are decoded
+    col = tdb.expr.col
+    assert db.query(table_name,select=["boolean_val","a_number"],
+        where=col("other_text").notnull()) == [
+        (r[3],r[1]) for r in data if r[2] is not None]
+    assert next(db._iterReadAllDict(table_name,columns=["other_text"])) == {"other_text": "0"}
+    db.remove()
+
+def test_order_by():
+    # Create a new database, with a tiny sort buffer
+    # to force the external sort to spill to disk
+    db = tdb.Database("tmp.tdb",sort_buffer_rows=7)
+    table_name = "test_table"
+    schema = {
+        "some_text": tdb.dtypes.STRING[10],
+        "a_number": tdb.dtypes.I32,
+    }
+    db.createTable(table_name,schema)
+    data = [(str(i % 5) if i % 6 else None,(i * 37) % 101) for i in range(100)]
+    db.insertMany(table_name,data)
+    text_desc = lambda r: (r[0] is None, r[0] or "")
+    # External merge sort, mixing directions
+    expected = sorted(sorted(data,key=lambda r: r[1]),key=text_desc,reverse=True)
+    assert db.query(table_name,order_by=[("some_text","desc"),"a_number"]) == expected
+    # Top-k with a limit
+    assert db.query(table_name,order_by=("a_number","desc"),limit=5) == sorted(
+        data,key=lambda r: -r[1])[:5]
+    # Streaming from an index
+    db.createIndex(table_name,"a_number")
+    where = tdb.expr.col("some_text") == "1"
+    assert db.query(table_name,select=["a_number"],where=where,order_by="a_number") == [
+        (r[1],) for r in sorted(data,key=lambda r: r[1]) if r[0] == "1"]
+    assert list(db._iterQuery(table_name,{"a_number": lambda v: v},
+        order_by=("a_number","desc"),limit=3)) == [(100,),(99,),(98,)]
+    db.remove()
+
+def test_group_by():
+    # Create a new database, with a tiny group buffer
+    # to force the aggregation to spill to disk
+    db = tdb.Database("tmp.tdb",aggregate_buffer_groups=4)
+    table_name = "test_table"
+    schema = {
+        "some_text": tdb.dtypes.STRING[10],
+        "a_number": tdb.dtypes.I32,
+    }
+    db.createTable(table_name,schema)
+    data = [(str(i % 10),i if i % 3 else None) for i in range(100)]
+    db.insertMany(table_name,data)
+    agg = tdb.aggregates
+    res = db.query(table_name,group_by=["some_text"],aggregates={
+        "n": agg.count(),
+        "n_vals": agg.count("a_number"),
+        "total": agg.sum("a_number"),
+        "lo": agg.min("a_number"),
+        "hi": agg.max("a_number"),
+    },order_by="some_text")
+    expected = []
+    for k in map(str,range(10)):
+        vals = [r[1] for r in data if r[0] == k and r[1] is not None]
+        expected.append((k,10,len(vals),sum(vals),min(vals),max(vals)))
+    assert res == expected
+    # Aggregates without a GROUP BY
+    assert db.query(table_name,where=tdb.expr.col("a_number") < 10,
+        aggregates={"n": agg.count(),"avg": agg.mean("a_number")}) == [(6,4.5)]
+    assert db.query(table_name,where=tdb.expr.col("a_number") < 0,
+        aggregates={"n": agg.count(),"avg": agg.mean("a_number")}) == [(0,None)]
+    db.remove()
+
+def test_join():
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    db.createTable("users",{
+        "id": tdb.dtypes.I32,
+        "name": tdb.dtypes.STRING[10],
+    })
+    db.createTable("orders",{
+        "user_id": tdb.dtypes.I32,
+        "amount": tdb.dtypes.I32,
+    })
+    users = [(i,f"user{i}") for i in range(20)] + [(None,"nobody")]
+    orders = [(i % 25 if i % 7 else None,i) for i in range(60)]
+    db.insertMany("users",users)
+    db.insertMany("orders",orders)
+    inner = sorted((u + o) for u in users for o in orders
+        if u[0] is not None and u[0] == o[0])
+    left = sorted(inner + [u + (None,None) for u in users
+        if not any(u[0] is not None and u[0] == o[0] for o in orders)],
+        key=lambda r: (r[0] is None,r))
+    on = ("id","user_id")
+    # Hash join
+    assert sorted(db.join("users","orders",on)) == inner
+    assert sorted(db.join("users","orders",on,how="left"),
+        key=lambda r: (r[0] is None,r)) == left
+    assert sorted(db.join("orders","users",("user_id","id"),
+        select=["name","amount"])) == sorted((r[1],r[3]) for r in inner)
+    assert len(list(db.join("users","orders",on,limit=5))) == 5
+    # Sort-merge join
+    db.createIndex("orders","user_id")
+    assert sorted(db.join("users","orders",on)) == inner
+    assert sorted(db.join("users","orders",on,how="left"),
+        key=lambda r: (r[0] is None,r)) == left
+    db.createIndex("users","id")
+    assert sorted(db.join("users","orders",on,
+        select=["users.id","orders.amount"])) == sorted((r[0],r[3]) for r in inner)
+    db.remove()
+
+def test_buffer_pool():
+    # Create a new database, with room for a few pages
+    db = tdb.Database("tmp.tdb",buffer_pool_size=3 * tdb.BufferPool.PAGE_SIZE)
+    table_name = "test_table"
+    db.createTable(table_name,{"n": tdb.dtypes.I64})
+    n_rows = 20_000
+    db.insertMany(table_name,[(i,) for i in range(n_rows)])
+    pool = db.buffer_pool
+    rows_per_page = pool.rowsPerPage(db._structs[table_name].row_struct.size)
+    assert n_rows // rows_per_page > 3
+    assert db.query(table_name) == [(i,) for i in range(n_rows)]
+    assert pool.size <= pool.capacity
+    assert len(pool) == 3
+    # Hot pages are served from memory
+    hits = pool.hits
+    assert db._readLine(table_name,n_rows - 1) == [n_rows - 1]
+    assert db._readLine(table_name,-2) == [n_rows - 2]
+    assert pool.hits == hits + 2
+    # Appends only invalidate the last page
+    db._readLine(table_name,0)
+    db.insert(table_name,[n_rows])
+    assert (table_name,0) in pool._pages
+    assert db._readLine(table_name,-1) == [n_rows]
+    assert db.query(table_name,where=tdb.expr.col("n") >= n_rows - 2) == [
+        (n_rows - 2,),(n_rows - 1,),(n_rows,)]
+    assert len(db.query(table_name)) == n_rows + 1
+    db.remove()
+
+def test_tombstone_delete():
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    table_name = "test_table"
+    db.createTable(table_name,{
+        "id": tdb.dtypes.I32,
+        "some_text": tdb.dtypes.STRING[10],
+    },primary_key="id")
+    db.createIndex(table_name,"some_text")
+    db.insertMany(table_name,[(i,str(i % 7)) for i in range(1000)])
+    tablefile = Path(db.metadata["tables"][table_name]["filename"])
+    size = tablefile.stat().st_size
+    # Deletes happen in place
+    db.delete(table_name,tdb.expr.col("some_text") == "3")
+    assert tablefile.stat().st_size == size
+    expected = [(i,str(i % 7)) for i in range(1000) if i % 7 != 3]
+    assert db.query(table_name) == expected
+    assert db.get(table_name,3) is None
+    assert db.query(table_name,where=tdb.expr.col("some_text") == "3") == []
+    # Inserts reuse the freed slots
+    db.insertMany(table_name,[(i,"new") for i in range(1000,1050)])
+    assert tablefile.stat().st_size == size
+    expected += [(i,"new") for i in range(1000,1050)]
+    assert sorted(db.query(table_name)) == sorted(expected)
+    assert db.get(table_name,1010) == (1010,"new")
+    # Compact the table a few rows at a time
+    db.delete(table_name,tdb.expr.col("id") < 500)
+    remaining = db.vacuum(table_name,max_rows=10)
+    assert 0 < remaining
+    while remaining:
+        remaining = db.vacuum(table_name,max_rows=100)
+    expected = [r for r in expected if r[0] >= 500]
+    assert sorted(db.query(table_name)) == sorted(expected)
+    assert tablefile.stat().st_size < size
+    assert db.get(table_name,999) == (999,"5")
+    assert sorted(db.query(table_name,where=tdb.expr.col("some_text") == "new")) == [
+        (i,"new") for i in range(1000,1050)]
+    db.remove()
+
+def test_update():
+    # Create a new database
+    db = tdb.Database("tmp.tdb")
+    table_name = "test_table"
+    db.createTable(table_name,{
+        "id": tdb.dtypes.I32,
+        "status": tdb.dtypes.STRING[10],
+        "counter": tdb.dtypes.I64,
+    },primary_key="id")
+    db.createIndex(table_name,"status")
+    db.insertMany(table_name,[(i,"new",0) for i in range(100)])
+    tablefile = Path(db.metadata["tables"][table_name]["filename"])
+    size = tablefile.stat().st_size
+    col = tdb.expr.col
+    # Update through the primary key's index
+    assert db.update(table_name,{"counter": lambda row: row["counter"] + 1},
+        col("id") == 5) == 1
+    assert db.update(table_name,{"counter": lambda row: row["counter"] + 1},
+        col("id") == 5) == 1
+    assert db.get(table_name,5) == (5,"new",2)
+    # Update an indexed column
+    assert db.update(table_name,{"status": "done"},col("id") < 10) == 10
+    assert tablefile.stat().st_size == size
+    assert sorted(db.query(table_name,"id",where=col("status") == "done")) == [
+        (i,) for i in range(10)]
+    assert len(db.query(table_name,where=col("status") == "new")) == 90
+    # Primary keys stay unique
+    with pytest.raises(tdb.exceptions.UniqueConstraintError):
+        db.update(table_name,{"id": 1},col("id") == 2)
+    with pytest.raises(tdb.exceptions.SchemaError):
+        db.update(table_name,{"counter": "a lot"})
+    assert db.update(table_name,{"id": lambda row: row["id"] + 1000}) == 100
+    assert db.get(table_name,5) is None
+    assert db.get(table_name,1005) == (1005,"done",2)
+    db.remove()
+
+def test_wal_recovery():
+    # Create a new database
+    db = tdb.Database("tmp.tdb",durability="group")
+    table_name = "test_table"
+    db.createTable(table_name,{
+        "id": tdb.dtypes.I32,
+        "some_text": tdb.dtypes.STRING[10],
+    },primary_key="id")
+    rows = [(i,str(i)) for i in range(10)]
+    db.insertMany(table_name,rows)
+    assert db._wal.size() > 0
+    # Free slots are only used up once the rows written there commit
+    db.delete(table_name,tdb.expr.col("id") == 3)
+    def fail(records):
+        raise OSError("No space left on device")
+    db._wal.commit = fail
+    with pytest.raises(OSError):
+        db.insert(table_name,(3,"3"))
+    del db._wal.commit
+    assert db._peekFreeSlots(table_name,5) == [3]
+    db.insert(table_name,(3,"3"))
+    assert db._peekFreeSlots(table_name,5) == []
+    # Checkpoints wait for a transaction's indexes to catch up
+    import threading
+    with db._transaction():
+        t = threading.Thread(target=db.checkpoint)
+        t.start()
+        t.join(0.2)
+        assert t.is_alive()
+    t.join()
+    assert db._wal.size() == 0
+    # Simulate a crash after a transaction is committed
+    # to the log, but before it's applied to the table...
+    rstruct = db._structs[table_name]
+    size = rstruct.row_struct.size
+    wal = tdb.WriteAheadLog
+    db._wal.commit([(wal.WRITE,table_name,10 * size,rstruct.pack([10,"ten"]))])
+    db._wal.close()
+    # ...with a torn write at the end of the log
+    with (db.filename / "wal.log").open("ab") as f:
+        f.write(db._wal._encodeRecord(wal.WRITE,table_name,
+            11 * size,rstruct.pack([11,"eleven"]))[:-3])
+    del db
+    # The committed transaction is replayed
+    db = tdb.Database("tmp.tdb")
+    assert db._wal.size() == 0
+    assert db.query(table_name) == rows + [(10,"ten")]
+    assert db.get(table_name,10) == (10,"ten")
+    assert db.get(table_name,11) is None
+    db.remove()
+
+def test_group_commit():
+    import threading
+    shutil.rmtree("tmp.tdb",ignore_errors=True)
+    Path("tmp.tdb").mkdir()
+    log = tdb.WriteAheadLog("tmp.tdb/wal.log","group",group_delay=0.005)
+    def writer(i):
+        for j in range(5):
+            log.commit([(log.WRITE,"t",i * 5 + j,b"x")])
+    threads = [threading.Thread(target=writer,args=(i,)) for i in range(16)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert log.n_commits == 80
+    assert log.n_syncs < log.n_commits
+    assert sorted(v for _, _, v, _ in log.committed()) == list(range(80))
+    log.close()
+    shutil.rmtree("tmp.tdb")
+
+def _concurrent_writer(i):
+    db = tdb.Database("tmp.tdb",durability="none")
+    for j in range(100):
+        db.insert("test_table",[i * 100 + j,f"proc-{i}"])
+        assert len(db.query("test_table",where=tdb.expr.col("id") == i * 100 + j)) == 1
+    db.close()
+
+def test_multiprocess_locking():
+    import multiprocessing as mp
+    # Create a new database
+    db = tdb.Database("tmp.tdb",durability="none")
+    table_name = "test_table"
+    db.createTable(table_name,{
+        "id": tdb.dtypes.I32,
+        "some_text": tdb.dtypes.STRING[10],
+    },primary_key="id")
+    # Several processes write at once
+    procs = [mp.Process(target=_concurrent_writer,args=(i,)) for i in range(4)]
+    for p in procs: p.start()
+    for p in procs: p.join()
+    assert all(p.exitcode == 0 for p in procs)
+    assert sorted(db.query(table_name)) == [(i,f"proc-{i // 100}") for i in range(400)]
+    assert db.get(table_name,321) == (321,"proc-3")
+    # Readers wait for writers (or time out)
+    other = tdb.Database("tmp.tdb",lock_timeout=0.1)
+    with db._lock([table_name],exclusive=True):
+        with pytest.raises(tdb.exceptions.LockTimeoutError):
+            other.query(table_name)
+    assert len(other.query(table_name)) == 400
+    # Shared locks can't be upgraded in place, but exclusive
+    # locks can be taken again in either mode
+    locks = other._locks
+    with locks.shared("x"), pytest.raises(tdb.exceptions.LockUpgradeError):
+        locks.acquire("x",tdb.LockManager.EXCLUSIVE)
+    with locks.exclusive("x"), locks.shared("x"), locks.exclusive("x"):
+        assert not db._locks.acquire("x",blocking=False)
+    # Tables created by another process are picked up
+    other.createTable("another_table",{"n": tdb.dtypes.I32})
+    other.insert("another_table",[1])
+    assert db.query("another_table") == [(1,)]
+    other.close()
+    db.remove()
+
+def test_parallel_scan():
+    # Create a new database, big enough to be split across workers
+    db = tdb.Database("tmp.tdb")
+    db.createTable("t",{
+        "k": tdb.dtypes.STRING[4],
+        "x": tdb.dtypes.I32,
+    })
+    db.insertMany("t",[(str(i % 7),i if i % 5 else None) for i in range(50_000)])
+    db.delete("t",tdb.expr.col("x") < 100)
+    col, agg = tdb.expr.col, tdb.aggregates
+    where = (col("x") > 1000) & (col("x") < 40_000)
+    assert (db.query("t",where=where,workers=3)
+        == db.query("t",where=where))
+    assert (db.query("t",["x"],order_by=("x","desc"),limit=5,workers=3)
+        == db.query("t",["x"],order_by=("x","desc"),limit=5))
+    aggs = {"n": agg.count(),"total": agg.sum("x"),"avg": agg.mean("x")}
+    res = db.query("t",group_by=["k"],aggregates=aggs,order_by="k",workers=3)
+    assert res == db.query("t",group_by=["k"],aggregates=aggs,order_by="k")
+    assert len(res) == 7
+    # Comparisons against null can be sent to workers too
+    assert db.query("t",where=col("x") == None,workers=3) == []
+    assert db.query("t",["x"],where=~(col("x") < None) & (col("x") < 200),workers=3) == [
+        (x,) for x in range(100,200) if x % 5]
+    # Callable filters can't be sent to workers, so they run serially
+    assert len(db.query("t",where=lambda r: r["k"] == "1",workers=3)) == len(
+        db.query("t",where=col("k") == "1"))
+    db.remove()
+
+def test_async_database():
+    async def run(db):
+        await db.createTable("t",{
+            "k": tdb.dtypes.STRING[4],
+            "x": tdb.dtypes.I32,
+        })
+        await db.insert("t",("a",-1))
+        await db.insertMany("t",[(str(i % 3),i) for i in range(2_500)])
+        assert await db.listTables() == ["t"]
+        # Stream concurrent queries in batches
+        async def collect(**kwargs):
+            return [row async for row in db.query("t",**kwargs)]
+        where = tdb.expr.col("x") >= 0
+        every, evens, top = await asyncio.gather(
+            collect(where=where),
+            collect(select=["x"],where=tdb.expr.col("k") == "0"),
+            collect(select=["x"],order_by=("x","desc"),limit=3))
+        assert every == [(str(i % 3),i) for i in range(2_500)]
+        assert evens == [(i,) for i in range(0,2_500,3)]
+        assert top == [(2_499,),(2_498,),(2_497,)]
+        # Stop streaming early
+        async for row in db.query("t"):
+            break
+        assert row == ("a",-1)
+        assert await db.update("t",{"x": 0},tdb.expr.col("x") < 0) == 1
+        # Writes between batches stop streaming queries that are
+        # still reading the table, but not finished or aggregated ones
+        rows, counts = [], []
+        with pytest.raises(tdb.exceptions.TableChangedError):
+            async for row in db.query("t",where=where):
+                rows.append(row)
+                if len(rows) == 100:
+                    await db.delete("t",tdb.expr.col("x") >= 2_000)
+                    assert await db.vacuum("t") == 0
+        assert len(rows) == 100
+        async for row in db.query("t",group_by=["k"],
+            aggregates={"n": tdb.aggregates.count()},order_by="k"):
+            counts.append(row)
+            await db.insert("t",("b",-2))
+        assert counts == [("0",667),("1",667),("2",666),("a",1)]
+        n = 0
+        async for row in db.query("t",where=tdb.expr.col("x").between(0,98)):
+            n += 1
+            if n == 100:
+                await db.insert("t",("c",-3))
+        assert n == 100
+        await db.remove()
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run(tdb.AsyncDatabase("tmp.tdb",max_workers=2,batch_size=100)))
+    loop.close()
+
+def test_cursor():
+    db = tdb.Database("tmp.tdb")
+    db.createTable("t",{
+        "k": tdb.dtypes.STRING[4],
+        "x": tdb.dtypes.I32,
+    })
+    data = [(str(i % 3),i) for i in range(1_000)]
+    db.insertMany("t",data)
+    cur = db.cursor("t",where=tdb.expr.col("x") >= 10)
+    assert cur.columns == ["k","x"]
+    assert cur.fetchone() == data[10]
+    assert cur.fetchmany(3) == data[11:14]
+    assert cur.rownumber == 4
+    # Resume from another cursor's position
+    with db.cursor("t",where=tdb.expr.col("x") >= 10,offset=cur.rownumber) as cur2:
+        assert cur2.fetchmany(2) == cur.fetchmany(2) == data[14:16]
+    assert cur2.closed
+    with pytest.raises(tdb.exceptions.CursorClosedError):
+        cur2.fetchone()
+    # The thread can't write to a table it has a cursor open on
+    with pytest.raises(tdb.exceptions.CursorOpenError):
+        db.insert("t",("x",-1))
+    with pytest.raises(tdb.exceptions.CursorOpenError):
+        db.createIndex("t","x")
+    assert len(cur.fetchall()) == 1_000 - 16
+    assert cur.fetchone() is None and cur.fetchmany() == []
+    cur.close()
+    # Cursors can be closed from another thread, releasing the lock
+    # of the thread that read them
+    import threading
+    cur = db.cursor("t")
+    assert cur.fetchone() == data[0]
+    closer = threading.Thread(target=cur.close)
+    closer.start()
+    closer.join()
+    assert cur.closed
+    db.insert("t",("x",-1))
+    # Offsets, limits and iteration
+    cur = db.cursor("t",["x"],order_by=("x","desc"),limit=3,offset=2)
+    assert list(cur) == [(997,),(996,),(995,)]
+    cur = db.cursor("t",group_by=["k"],aggregates={"n": tdb.aggregates.count()},
+        order_by="k",offset=1)
+    assert cur.columns == ["k","n"] and cur.fetchall() == [("1",333),("2",333),("x",1)]
+    db.remove()
+
+def test_varstring():
+    db = tdb.Database("tmp.tdb")
+    db.createTable("t",{
+        "id": tdb.dtypes.I32,
+        "text": tdb.dtypes.VARSTRING,
+    })
+    # Rows only hold a reference to the string
+    assert db._structs["t"].row_struct.size == 15
+    data = [(i,"x" * (i % 50) if i % 7 else None) for i in range(500)]
+    db.insertMany("t",data)
+    db.insert("t",(500,"ünïcødé " * 100))
+    assert db.query("t",where=tdb.expr.col("id") < 500) == data
+    assert db.query("t",["text"],where=tdb.expr.col("id") == 500) == [("ünïcødé " * 100,)]
+    # Filters compare the strings, not their references
+    assert db.query("t",["id"],where=tdb.expr.col("text") == "xxx") == [
+        (i,) for i, t in data if t == "xxx"]
+    assert len(db.query("t",where=tdb.expr.col("text").isin(["x","xx"]))) == len(
+        [t for _, t in data if t in ("x","xx")])
+    assert db.query("t",["text"],where=~tdb.expr.col("text").isnull(),
+        order_by=("text","desc"),limit=1) == [("ünïcødé " * 100,)]
+    assert db.update("t",{"text": "updated"},tdb.expr.col("id") == 1) == 1
+    assert db.query("t",["text"],where=tdb.expr.col("id") == 1) == [("updated",)]
+    with pytest.raises(tdb.exceptions.SchemaError):
+        db.createIndex("t","text")
+    # Too-long strings reject the whole batch before it touches the heap
+    heap_size = db._structs["t"].heap.size()
+    with pytest.raises(tdb.exceptions.SchemaError):
+        db.insertMany("t",[(600,"ok"),(601,"x" * 2 ** 24)])
+    assert db._structs["t"].heap.pending() == []
+    assert db._structs["t"].heap.size() == heap_size
+    assert db.query("t",where=tdb.expr.col("id") >= 600) == []
+    db.close()
+    # Strings survive a reopen (and are replayed from the log)
+    db = tdb.Database("tmp.tdb")
+    assert db.query("t",["text"],where=tdb.expr.col("id") == 1) == [("updated",)]
+    assert db.query("t",["text"],where=tdb.expr.col("id") == 7) == [(None,)]
+    db.remove()
+
+@pytest.mark.parametrize("codec",["zlib","lzma","bz2"])
+def test_compressed_table(codec):
+    db = tdb.Database("tmp.tdb")
+    schema = {
+        "k": tdb.dtypes.STRING[50],
+        "x": tdb.dtypes.I32,
+    }
+    db.createTable("plain",schema)
+    db.createTable("t",schema,compression=codec)
+    data = [(str(i % 10),i if i % 3 else None) for i in range(20_000)]
+    db.insertMany("plain",data)
+    db.insertMany("t",data)
+    # The padding compresses away
+    files = [p for p in (db.filename / "tables").iterdir()
+        if p.name.startswith(tdb.util.md5("t"))]
+    size = sum(p.stat().st_size for p in files)
+    assert size * 5 < (db.filename / "tables" / tdb.util.md5("plain")).stat().st_size
+    assert db.query("t") == data
+    db.createIndex("t","x")
+    assert db.query("t",where=tdb.expr.col("x") == 10) == [("0",10)]
+    # In-place writes recompress the blocks they change
+    db.delete("t",tdb.expr.col("k") == "1")
+    assert db.update("t",{"k": "z"},tdb.expr.col("k") == "2") == 2_000
+    db.insert("t",("new",-1))
+    assert db.vacuum("t") == 0
+    expected = sorted([("z" if k == "2" else k,x) for k, x in data if k != "1"]
+        + [("new",-1)],key=lambda r: (r[0],r[1] or 0))
+    assert sorted(db.query("t"),key=lambda r: (r[0],r[1] or 0)) == expected
+    assert len(db.query("t",workers=2)) == len(expected)
+    db.close()
+    db = tdb.Database("tmp.tdb")
+    assert len(db.query("t")) == len(expected)
+    with pytest.raises(ValueError):
+        db.createTable("bad",schema,compression="snappy")
+    db.dropTable("t")
+    assert not any(p.name.startswith(tdb.util.md5("t"))
+        for p in (db.filename / "tables").iterdir())
+    db.remove()
+
+def test_zone_maps():
+    db = tdb.Database("tmp.tdb")
+    db.createTable("t",{
+        "ts": tdb.dtypes.I64,
+        "k": tdb.dtypes.STRING[8],
+    })
+    data = [(i,f"k{i % 100}" if i % 10 else None) for i in range(100_000)]
+    db.insertMany("t",data)
+    col = tdb.expr.col
+    n_pages = len(db._pageNumbers("t"))
+    # Only the pages of the matching zones are read
+    db.buffer_pool.clear()
+    assert db.query("t",where=col("ts") >= 99_000) == data[99_000:]
+    assert db.buffer_pool.misses < n_pages // 20
+    assert db.query("t",where=col("ts") == -1) == []
+    assert db._pageNumbers("t",col("ts") < 0) == []
+    assert len(db._pageNumbers("t",(col("ts") < 10) | col("ts").isin([50_000]))) < 5
+    # Strings and nulls are tracked too
+    assert db._pageNumbers("t",col("k") == "zzz") == []
+    assert db._pageNumbers("t",col("k").isnull()) == db._pageNumbers("t")
+    # Stats are widened by updates and truncated by vacuum
+    assert db.update("t",{"ts": -5},col("ts") == 5) == 1
+    assert db.query("t",["k"],where=col("ts") < 0) == [("k5",)]
+    db.delete("t",col("ts") >= 50_000)
+    assert db.vacuum("t") == 0
+    assert len(db._zones["t"]) == 50_000 // db._zones["t"].zone_rows + 1
+    db.insert("t",(1_000_000,"new"))
+    assert db.query("t",where=col("ts") > 50_000) == [(1_000_000,"new")]
+    # Zone maps are rebuilt if they're missing
+    db._zonePath("t").unlink()
+    db._zones["t"].reload()
+    assert db.query("t",["k"],where=col("ts") == -5) == [("k5",)]
+    assert db._zonePath("t").exists()
+    db.remove()
+
+def test_bloom_filters():
+    db = tdb.Database("tmp.tdb")
+    db.createTable("t",{
+        "id": tdb.dtypes.STRING[8],
+        "n": tdb.dtypes.I64,
+        "note": tdb.dtypes.VARSTRING,
+    },bloom_filters=["id","note"])
+    # Scattered IDs, so every zone's min/max covers them all
+    data = [(f"u{i * 7919 % 100_000:05}",i,f"note {i}") for i in range(100_000)]
+    db.insertMany("t",data)
+    col = tdb.expr.col
+    n_zones = len(db._zones["t"])
+    n_pages = len(db._pageNumbers("t"))
+    assert len(db._blooms["t"]["id"]) == n_zones
+    assert db._zones["t"].candidates(col("id") == "u50000a",
+        db._structs["t"],100_000) == list(range(n_zones))
+    # Zones whose filter rules the value out are skipped
+    assert db.query("t",["n"],where=col("id") == data[12_345][0]) == [(12_345,)]
+    assert len(db._pageNumbers("t",col("id") == data[12_345][0])) < n_pages // 10
+    assert len(db._pageNumbers("t",col("id").isin(["u00000","nope"]))) < n_pages // 10
+    assert len(db._pageNumbers("t",col("note") == "note 77")) < n_pages // 10
+    assert db.query("t",where=col("id") == "nope") == []
+    # Other filters still scan the table
+    assert len(db.query("t",where=col("id") != "nope")) == 100_000
+    # Filters are kept up to date by writes
+    assert db.update("t",{"id": "new"},col("n") == 5) == 1
+    assert db.query("t",["n"],where=col("id") == "new") == [(5,)]
+    db.insert("t",("newer",-1,None))
+    assert db.query("t",["n"],where=col("id") == "newer") == [(-1,)]
+    # Filters can be added later, and survive reopening
+    db.createBloomFilter("t","n")
+    with pytest.raises(AssertionError):
+        db.createBloomFilter("t","n")
+    db.close()
+    db = tdb.Database("tmp.tdb")
+    assert db.query("t",["id"],where=col("n") == 7) == [(data[7][0],)]
+    assert len(db._pageNumbers("t",col("n") == 7.0)) < n_pages // 10
+    # ...and are rebuilt once vacuum has compacted the table
+    db.delete("t",col("n") >= 1_000)
+    assert db.vacuum("t") == 0
+    assert len(db._blooms["t"]["id"]) == 1
+    assert db.query("t",["n"],where=col("n") == -1) == [(-1,)]
+    db.remove()
+
+def test_analyze_explain():
+    db = tdb.Database("tmp.tdb")
+    db.createTable("t",{
+        "id": tdb.dtypes.I64,
+        "age": tdb.dtypes.I32,
+        "name": tdb.dtypes.STRING[8],
+    })
+    data = [(i,i % 100 if i % 20 else None,f"n{i % 1000}") for i in range(50_000)]
+    db.insertMany("t",data)
+    db.createIndex("t","age")
+    col = tdb.expr.col
+    wide = col("age") >= 10
+    # Without statistics, indexes are always used
+    plan = db.explain("t",where=wide)
+    assert plan.method == "index_scan" and not plan.analyzed
+    stats = db.analyze("t")
+    assert stats["rows"] == 50_000
+    assert stats["columns"]["age"]["null_frac"] == 0.05
+    assert 95 <= stats["columns"]["age"]["distinct"] <= 105
+    assert 950 <= stats["columns"]["name"]["distinct"] <= 1050
+    assert 48_000 <= stats["columns"]["id"]["distinct"] <= 52_000
+    assert stats["columns"]["id"]["histogram"][0] < 100
+    # With them, the cheapest plan is chosen
+    plan = db.explain("t",where=wide)
+    assert plan.method == "seq_scan" and plan.analyzed
+    assert 40_000 <= plan.rows <= 45_000
+    assert [p.method for p in plan.alternatives] == ["index_scan"]
+    # Queries are planned once, however many parts use the plan
+    plans, plan_fn = [], db._plan
+    db._plan = lambda *args: plans.append(args) or plan_fn(*args)
+    assert db.query("t",where=wide,workers=2) == [
+        r for r in data if r[1] is not None and r[1] >= 10]
+    narrow = (col("age") == 3) & (col("name") == "n3")
+    assert db.query("t",where=narrow,workers=2) == [
+        r for r in data if r[1] == 3 and r[2] == "n3"]
+    assert len(plans) == 2
+    del db._plan
+    plan = db.explain("t",where=(col("age") == 3) & (col("name") == "n3"))
+    assert plan.method == "index_scan" and plan.index == ["age"]
+    assert db.explain("t",where=col("id") == 7).method == "zone_scan"
+    # Steps after the scan are shown too
+    text = str(db.explain("t",where=wide,order_by="name",limit=3,
+        group_by=["name"],aggregates={"n": tdb.aggregates.count()}))
+    assert text.splitlines()[:2] == ["top 3 by name",
+        "  hash aggregate by name: n=count()"]
+    assert "seq_scan on t" in text and "rejected: index_scan" in text
+    # Statistics are kept in the catalog
+    db.close()
+    db = tdb.Database("tmp.tdb")
+    assert db.explain("t",where=wide).method == "seq_scan"
+    db.remove()
+
+def test_result_cache():
+    db = tdb.Database("tmp.tdb",result_cache_size=2 ** 20)
+    db.createTable("t",{
+        "a": tdb.dtypes.I32,
+        "b": tdb.dtypes.STRING[8],
+    })
+    db.insertMany("t",[(i,f"b{i % 7}") for i in range(1_000)])
+    col = tdb.expr.col
+    cache = db.result_cache
+    rows = db.query("t",where=col("a") < 10)
+    assert (cache.hits, cache.misses) == (0, 1)
+    # Equivalent queries share an entry
+    assert db.query("T",["a","b"],where=col("a") < 10) == rows
+    assert (cache.hits, cache.misses) == (1, 1)
+    # Results are copies
+    db.query("t",where=col("a") < 10).clear()
+    assert db.query("t",where=col("a") < 10) == rows
+    counts = db.query("t",group_by=["b"],aggregates={"n": tdb.aggregates.count()},
+        order_by="b")
+    assert db.query("t",group_by=["b"],aggregates={"n": tdb.aggregates.count()},
+        order_by="b") == counts
+    assert cache.hits == 4 and len(cache) == 2
+    # Writes invalidate the table's results
+    db.insert("t",(5,"new"))
+    assert len(cache) == 0
+    assert db.query("t",where=col("a") < 10) == rows + [(5,"new")]
+    db.delete("t",col("a") == 5)
+    assert db.query("t",where=col("a") < 10) == [r for r in rows if r[0] != 5]
+    # Plain callables aren't cached
+    misses = cache.misses
+    db.query("t",where=lambda r: r["a"] < 10)
+    assert cache.misses == misses and len(cache) == 1
+    # The cache stays within its budget
+    assert len(db.query("t")) == 999
+    assert cache.size <= cache.capacity
+    small = tdb.ResultCache(2_000)
+    small.put("t",1,rows)
+    small.put("t",2,rows)
+    assert small.get("t",1) is None and small.get("t",2) == rows
+    db.dropTable("t")
+    assert len(cache) == 0
+    db.remove()
+    db = tdb.Database("tmp.tdb")
+    db.createTable("t",{"a": tdb.dtypes.I32})
+    db.query("t")
+    assert db.result_cache.misses == 0
+    db.remove()
+
+def test_row_codec():
+    rs = tdb.RowStruct(["a","b","c","d"],[tdb.dtypes.I32,tdb.dtypes.F64,
+        tdb.dtypes.STRING[4],tdb.dtypes.BOOL],tombstone=True)
+    rows = [[1,2.5,"abcd",True],[None,3,"",False],[-7,None,None,None]]
+    buf = bytearray(len(rows) * rs.row_struct.size)
+    for i, row in enumerate(rows):
+        rs.pack_into(buf,i * rs.row_struct.size,row)
+    assert buf[:rs.row_struct.size] == rs.pack(rows[0])
+    assert list(rs.iter_unpack(buf)) == rows
+    assert rs.unpack(rs.pack({"c": "x"})) == [None,None,"x",None]
+    assert rs.project(["c","a"]).unpack(rs.pack(rows[0])) == [1,"abcd"]
+    raw = rs.row_struct.unpack(rs.pack(rows[1]))
+    assert rs.decode(raw) == rows[1]
+    # Types (and string lengths) are checked per column
+    for bad in ([1.5,0.0,"",True],[1,True,"",True],[1,0.0,"abcde",True],
+        [1,0.0,b"",True],[1,0.0,"",1],[1,0.0,""]):
+        with pytest.raises(tdb.exceptions.SchemaError):
+            rs.validateRows([bad])
+    with pytest.raises(TypeError):
+        rs.project(["a"]).pack(rows[0])
@@ -0,0 +1,205 @@
+
+import asyncio
+import functools
+import itertools as it
+import concurrent.futures
+
+from . import dtypes
+from . import exceptions
+from . import expr
+from .Database import Database
+from .aggregates import Aggregate
+
+from typing import Union, Dict, Any, Sequence, List, Callable, Optional, AsyncIterator
+
+
+class AsyncDatabase:
+
+    def __init__(self, name: str = "db.tdb", path: str = ".",
+        max_workers: int = 4, batch_size: int = 1_000, **kwargs):
+        """An ``asyncio`` interface to a `toydb.Database`.
+
+        Every call runs on a bounded thread pool, so file
+        I/O doesn't block the event loop. Queries are streamed
+        back in batches of ``batch_size`` rows (see ``query``),
+        and each batch is a separate job on the pool, so
+        concurrent queries take turns instead of one big scan
+        holding up the others.
+
+        Opening the database (and recovering it, if needed)
+        happens in the constructor, and does block.
+
+        :param name: Name of the database directory
+        :param path: Directory containing the database
+        :param max_workers: Number of threads doing I/O
+        :param batch_size: Number of rows per query batch
+        :param kwargs: Other arguments for `toydb.Database`
+        """
+        assert max_workers > 0
+        assert batch_size > 0
+        self.db = Database(name, path, **kwargs)
+        self.batch_size = batch_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+
+    def __repr__(self):
+        return f"<toydb.AsyncDatabase {self.db.name}>"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _run(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking function on the thread pool.
+
+        :param func: Function to call
+        :return: Its return value
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+            functools.partial(func, *args, **kwargs))
+
+    async def close(self):
+        """Close the database (see ``Database.close``) and
+        stop the thread pool.
+        """
+        await self._run(self.db.close)
+        self._executor.shutdown()
+
+    async def remove(self):
+        """Delete the database (see ``Database.remove``)."""
+        await self._run(self.db.remove)
+        self._executor.shutdown()
+
+    async def listTables(self) -> List[str]:
+        """See ``Database.listTables``."""
+        return await self._run(self.db.listTables)
+
+    async def getTableSchema(self, table_name: str) -> Dict[str,dtypes.DType]:
+        """See ``Database.getTableSchema``."""
+        return await self._run(self.db.getTableSchema, table_name)
+
+    async def getTableColumns(self, table_name: str) -> List[str]:
+        """See ``Database.getTableColumns``."""
+        return await self._run(self.db.getTableColumns, table_name)
+
+    async def createTable(self, table_name: str, schema: Dict[str,dtypes.DType], **kwargs):
+        """See ``Database.createTable``."""
+        await self._run(self.db.createTable, table_name, schema, **kwargs)
+
+    async def createIndex(self, table_name: str, column: str, **kwargs):
+        """See ``Database.createIndex``."""
+        await self._run(self.db.createIndex, table_name, column, **kwargs)
+
+    async def createBloomFilter(self, table_name: str, column: str, **kwargs):
+        """See ``Database.createBloomFilter``."""
+        await self._run(self.db.createBloomFilter, table_name, column, **kwargs)
+
+    async def analyze(self, table_name: str) -> dict:
+        """See ``Database.analyze``."""
+        return await self._run(self.db.analyze, table_name)
+
+    async def dropTable(self, table_name: str):
+        """See ``Database.dropTable``."""
+        await self._run(self.db.dropTable, table_name)
+
+    async def insert(self, table_name: str, row: Union[Sequence[Any], Dict[str, Any]]):
+        """See ``Database.insert``."""
+        await self._run(self.db.insert, table_name, row)
+
+    async def insertMany(self, table_name: str,
+        rows: Sequence[Union[Sequence[Any], Dict[str, Any]]]):
+        """See ``Database.insertMany``."""
+        await self._run(self.db.insertMany, table_name, rows)
+
+    async def update(self, table_name: str, set: Dict[str,Any], where = None) -> int:
+        """See ``Database.update``."""
+        return await self._run(self.db.update, table_name, set, where)
+
+    async def delete(self, table_name: str, where: Union[expr.Expr,Callable[[dict],bool]]):
+        """See ``Database.delete``."""
+        await self._run(self.db.delete, table_name, where)
+
+    async def vacuum(self, table_name: str, max_rows: Optional[int] = None) -> int:
+        """See ``Database.vacuum``."""
+        return await self._run(self.db.vacuum, table_name, max_rows)
+
+    async def checkpoint(self):
+        """See ``Database.checkpoint``."""
+        await self._run(self.db.checkpoint)
+
+    async def get(self, table_name: str, key: Any) -> Optional[tuple]:
+        """See ``Database.get``."""
+        return await self._run(self.db.get, table_name, key)
+
+    async def explain(self, from_: str, **kwargs):
+        """See ``Database.explain``."""
+        return await self._run(self.db.explain, from_, **kwargs)
+
+    def _nextBatch(self, table_name: str, state: dict) -> List[tuple]:
+        """Read the next batch of a query's results, holding
+        the table's lock only while the batch is read.
+
+        :param table_name: Table being queried
+        :param state: The query's arguments (see ``Database._iterQuery``),
+            and its result iterator, next row and the table's
+            version once it's started
+        :return: Up to ``batch_size`` rows. Empty once the
+            query is done.
+        :raises exceptions.TableChangedError: If the table was
+            written to since the last batch, and the query is
+            still reading it
+        """
+        with self.db._lock([table_name]):
+            version = self.db._versions.get(table_name)
+            if "itr" not in state:
+                assert table_name in self.db.listTables()
+                args = state.pop("args")
+                # Aggregates are computed in full by the first batch
+                state["version"] = None if args["group_by"] or args["aggregates"] else version
+                state["itr"] = self.db._iterQuery(table_name,
+                    self.db._selectGetters(table_name, args.pop("select")), **args)
+            elif state["version"] not in (None, version):
+                state["itr"].close()
+                raise exceptions.TableChangedError(
+                    f"Table \"{table_name}\" was written to while it was being streamed.")
+            # Read a row ahead, so finished queries aren't checked
+            rows = state.pop("ahead", [])
+            rows += it.islice(state["itr"], self.batch_size + 1 - len(rows))
+            state["ahead"] = rows[self.batch_size:]
+            if not state["ahead"]:
+                state["version"] = None
+            return rows[:self.batch_size]
+
+    async def query(self, from_: str, select: List[Union[str,Dict[str,Callable]]] = "*",
+        where = None, limit: int = None, order_by = None,
+        group_by: List[str] = None, aggregates: Dict[str,Aggregate] = None,
+        workers: Optional[int] = None) -> AsyncIterator[tuple]:
+        """Stream the results of a query (see ``Database.query``
+        for the arguments), as in ``async for row in db.query(...)``.
+
+        Results are read a batch at a time, and the table is
+        only locked while a batch is being read. The rows left
+        to read can't be trusted once another write commits (eg
+        a ``vacuum`` moves rows the query hasn't reached yet to
+        the slots it's already passed), so if the table's written
+        to between batches, the query raises
+        ``exceptions.TableChangedError`` instead, and can be run
+        again. Aggregate queries are computed in full by the
+        first batch, so writes after it don't affect them.
+
+        :yields: Result rows, as tuples
+        :raises exceptions.TableChangedError: If the table
+            was written to while the query was streaming
+        """
+        table_name = from_.lower()
+        state = {"args": dict(select=select, where=where, limit=limit,
+            order_by=order_by, group_by=group_by, aggregates=aggregates,
+            workers=workers)}
+        while True:
+            batch = await self._run(self._nextBatch, table_name, state)
+            if not batch:
+                return
+            for row in batch:
+                yield row
@@ -0,0 +1,299 @@
+
+import bisect
+import struct
+from pathlib import Path
+
+from . import dtypes
+
+from typing import Union, Any, Iterable, Iterator, List, Optional, Tuple
+
+
+_MAX_ROW = 2 ** 63 - 1
+
+
+class _Node:
+    __slots__ = ("page", "leaf", "keys", "children", "next")
+
+    def __init__(self, page: int, leaf: bool, keys: List[tuple] = None,
+        children: List[int] = None, next_: int = -1):
+        self.page = page
+        self.leaf = leaf
+        self.keys = keys if keys is not None else []
+        self.children = children if children is not None else []
+        self.next = next_
+
+
+class BTree:
+
+    PAGE_SIZE = 4096
+    MAGIC = b"TDBT"
+    _header = struct.Struct(">4sqq")
+    _node_header = struct.Struct(">?Hq")
+
+    def __init__(self, filename: Union[str,Path], dtype: dtypes.DType):
+        """An on-disk B+tree index mapping column values
+        to the row numbers they're stored at.
+
+        Entries are stored as ``(is_null, value, row)``
+        keys, which makes every entry unique (even when
+        values repeat) and sorts null values last.
+
+        Page ``0`` of the file holds a header with the root
+        page number and the number of pages. Every other page
+        holds a single node. Leaves are linked together so
+        range scans can walk them in order.
+
+        Deletes don't rebalance the tree, so leaves can be
+        left underfull until the index is rebuilt.
+
+        :param filename: Location of the index file. It will
+            be created if it doesn't already exist.
+        :param dtype: Datatype of the indexed column
+        """
+        self.filename = Path(filename)
+        self.dtype = dtype
+        fmt = str(dtype)
+        self._isStr = "s" in fmt or "c" in fmt
+        self._null = "" if self._isStr else dtype.default
+        self._entry = struct.Struct(f">?{fmt}q")
+        avail = self.PAGE_SIZE - self._node_header.size - 8
+        self.order = max(4, avail // (self._entry.size + 8))
+        self._children_offset = self._node_header.size + self.order * self._entry.size
+        self.page_size = max(self.PAGE_SIZE,
+            self._children_offset + (self.order + 1) * 8)
+        if not self.filename.exists() or self.filename.stat().st_size == 0:
+            self.build([])
+
+    def __repr__(self):
+        return f"<toydb.BTree {self.filename.name}>"
+
+    def _key(self, value: Any, row: int) -> tuple:
+        """Create a sortable index key.
+
+        :param value: Column value
+        :param row: Row number
+        :return: ``(is_null, value, row)`` key tuple
+        """
+        if value is None:
+            return (True, self._null, row)
+        return (False, value, row)
+
+    def _readHeader(self, f) -> Tuple[int,int]:
+        f.seek(0)
+        magic, root, n_pages = self._header.unpack(f.read(self._header.size))
+        assert magic == self.MAGIC, f"\"{self.filename}\" isn't a BTree index."
+        return root, n_pages
+
+    def _writeHeader(self, f, root: int, n_pages: int):
+        f.seek(0)
+        f.write(self._header.pack(self.MAGIC, root, n_pages))
+
+    def _readNode(self, f, page: int) -> _Node:
+        f.seek(page * self.page_size)
+        data = f.read(self.page_size)
+        leaf, n, nxt = self._node_header.unpack_from(data)
+        start = self._node_header.size
+        keys = [self._decodeEntry(e) for e in self._entry.iter_unpack(
+            data[start:start + n * self._entry.size])]
+        children = None
+        if not leaf:
+            children = list(struct.unpack_from(f">{n + 1}q", data, self._children_offset))
+        return _Node(page, leaf, keys, children, nxt)
+
+    def _decodeEntry(self, entry: tuple) -> tuple:
+        is_null, val, row = entry
+        if self._isStr:
+            val = val.rstrip(b"\x00").decode()
+        return (is_null, val, row)
+
+    def _writeNode(self, f, node: _Node):
+        assert len(node.keys) <= self.order
+        buf = bytearray(self.page_size)
+        self._node_header.pack_into(buf, 0, node.leaf, len(node.keys), node.next)
+        offset = self._node_header.size
+        for is_null, val, row in node.keys:
+            if self._isStr: val = val.encode()
+            self._entry.pack_into(buf, offset, is_null, val, row)
+            offset += self._entry.size
+        if not node.leaf:
+            struct.pack_into(f">{len(node.children)}q", buf,
+                self._children_offset, *node.children)
+        f.seek(node.page * self.page_size)
+        f.write(buf)
+
+    def build(self, entries: Iterable[Tuple[Any,int]]):
+        """Replace the contents of the index by bulk
+        loading ``entries`` bottom-up.
+
+        :param entries: Iterable of ``(value, row)`` pairs
+        """
+        keys = sorted(self._key(v, r) for v, r in entries)
+        chunks = [keys[i:i + self.order]
+            for i in range(0, len(keys), self.order)] or [[]]
+        with self.filename.open("wb") as f:
+            level = []
+            for i, chunk in enumerate(chunks, 1):
+                nxt = i + 1 if i < len(chunks) else -1
+                self._writeNode(f, _Node(i, True, chunk, None, nxt))
+                level.append((chunk[0] if chunk else None, i))
+            n_pages = len(chunks) + 1
+            while len(level) > 1:
+                parents = []
+                for i in range(0, len(level), self.order + 1):
+                    group = level[i:i + self.order + 1]
+                    self._writeNode(f, _Node(n_pages, False,
+                        [k for k, _ in group[1:]], [p for _, p in group]))
+                    parents.append((group[0][0], n_pages))
+                    n_pages += 1
+                level = parents
+            self._writeHeader(f, level[0][1], n_pages)
+
+    def _split(self, f, node: _Node, n_pages: int) -> Tuple[tuple,_Node]:
+        """Split an overfull node in two.
+
+        :return: The separator key and the new right-hand node
+        """
+        mid = len(node.keys) // 2
+        if node.leaf:
+            right = _Node(n_pages, True, node.keys[mid:], None, node.next)
+            node.keys, node.next = node.keys[:mid], right.page
+            sep = right.keys[0]
+        else:
+            sep = node.keys[mid]
+            right = _Node(n_pages, False, node.keys[mid + 1:], node.children[mid + 1:])
+            node.keys, node.children = node.keys[:mid], node.children[:mid + 1]
+        self._writeNode(f, node)
+        self._writeNode(f, right)
+        return sep, right
+
+    def _insert(self, f, page: int, key: tuple, n_pages: List[int]):
+        node = self._readNode(f, page)
+        if node.leaf:
+            i = bisect.bisect_left(node.keys, key)
+            if i < len(node.keys) and node.keys[i] == key:
+                return None
+            node.keys.insert(i, key)
+        else:
+            i = bisect.bisect_right(node.keys, key)
+            split = self._insert(f, node.children[i], key, n_pages)
+            if split is None: return None
+            sep, right = split
+            node.keys.insert(i, sep)
+            node.children.insert(i + 1, right.page)
+        if len(node.keys) <= self.order:
+            self._writeNode(f, node)
+            return None
+        n_pages[0] += 1
+        return self._split(f, node, n_pages[0] - 1)
+
+    def insert(self, value: Any, row: int):
+        """Add an entry to the index.
+
+        :param value: Column value
+        :param row: Row number of ``value``
+        """
+        self.insertMany([(value, row)])
+
+    def insertMany(self, entries: Iterable[Tuple[Any,int]]):
+        """Add multiple entries to the index.
+
+        :param entries: Iterable of ``(value, row)`` pairs
+        """
+        with self.filename.open("r+b") as f:
+            root, n_pages = self._readHeader(f)
+            n_pages = [n_pages]
+            for v, r in entries:
+                split = self._insert(f, root, self._key(v, r), n_pages)
+                if split is not None:
+                    sep, right = split
+                    new_root = _Node(n_pages[0], False, [sep], [root, right.page])
+                    self._writeNode(f, new_root)
+                    root = new_root.page
+                    n_pages[0] += 1
+            self._writeHeader(f, root, n_pages[0])
+
+    def remove(self, value: Any, row: int):
+        """Remove an entry from the index.
+
+        :param value: Column value
+        :param row: Row number of ``value``
+        """
+        self.removeMany([(value, row)])
+
+    def removeMany(self, entries: Iterable[Tuple[Any,int]]):
+        """Remove multiple entries from the index. Entries
+        that aren't in the index are ignored.
+
+        :param entries: Iterable of ``(value, row)`` pairs
+        """
+        with self.filename.open("r+b") as f:
+            root, _ = self._readHeader(f)
+            for v, r in entries:
+                key = self._key(v, r)
+                node = self._findLeaf(f, root, key)
+                i = bisect.bisect_left(node.keys, key)
+                if i < len(node.keys) and node.keys[i] == key:
+                    del node.keys[i]
+                    self._writeNode(f, node)
+
+    def _findLeaf(self, f, root: int, key: Optional[tuple]) -> _Node:
+        """Find the leaf where ``key`` is (or would be) stored.
+
+        :param key: Key to search for. If ``None``, the
+            left-most leaf is returned.
+        """
+        node = self._readNode(f, root)
+        while not node.leaf:
+            i = 0 if key is None else bisect.bisect_right(node.keys, key)
+            node = self._readNode(f, node.children[i])
+        return node
+
+    def search(self, lo: Any = None, hi: Any = None, lo_inclusive: bool = True,
+        hi_inclusive: bool = True) -> Iterator[int]:
+        """Find the rows with values in a range. Null
+        values never match.
+
+        :param lo: Lower bound. If ``None``, there's no lower bound.
+        :param hi: Upper bound. If ``None``, there's no upper bound.
+        :param lo_inclusive: Include values equal to ``lo``
+        :param hi_inclusive: Include values equal to ``hi``
+        :yields: Matching row numbers, in value order
+        """
+        start = None
+        if lo is not None:
+            start = (False, lo, -1 if lo_inclusive else _MAX_ROW)
+        stop = None
+        if hi is not None:
+            stop = (False, hi, _MAX_ROW if hi_inclusive else -1)
+        with self.filename.open("rb") as f:
+            root, _ = self._readHeader(f)
+            node = self._findLeaf(f, root, start)
+            i = 0 if start is None else bisect.bisect_left(node.keys, start)
+            while True:
+                for key in node.keys[i:]:
+                    if key[0] or (stop is not None and key > stop):
+                        return
+                    yield key[2]
+                if node.next < 0: return
+                node, i = self._readNode(f, node.next), 0
+
+    def items(self, reverse: bool = False) -> Iterator[Tuple[Any,int]]:
+        """Iterate over every entry in the index, in
+        order. Null values come last (or first, if
+        ``reverse`` is ``True``).
+
+        :param reverse: Iterate in descending order
+        :yields: ``(value, row)`` pairs
+        """
+        with self.filename.open("rb") as f:
+            root, _ = self._readHeader(f)
+            for is_null, val, row in self._iterNode(f, root, reverse):
+                yield (None if is_null else val), row
+
+    def _iterNode(self, f, page: int, reverse: bool) -> Iterator[tuple]:
+        node = self._readNode(f, page)
+        if node.leaf:
+            yield from (reversed(node.keys) if reverse else node.keys)
+            return
+        for child in (reversed(node.children) if reverse else node.children):
+            yield from self._iterNode(f, child, reverse)
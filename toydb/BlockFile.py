@@ -0,0 +1,308 @@
+
+import os
+import zlib
+import struct
+import importlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+from . import util
+
+from typing import Union, List
+
+
+class BlockFile:
+
+    CODECS = ("zlib", "lzma", "bz2")
+    BLOCK_SIZE = 64 * 2 ** 10
+    BLOCK, SIZE = 1, 2
+    _header = struct.Struct(">4sI")
+    _entry = struct.Struct(">BqqIII")
+    _magic = b"TDBZ"
+
+    def __init__(self, filename: Union[str,Path], codec: str = "zlib",
+        block_size: int = BLOCK_SIZE, cache_blocks: int = 4):
+        """A table file stored as compressed blocks.
+
+        The table's bytes are split into blocks of ``block_size``
+        bytes, and each block is compressed on its own, so
+        reads only decompress the blocks they need. Reads and
+        writes use offsets into the uncompressed bytes, like
+        a regular file.
+
+        Blocks are never overwritten: a write recompresses the
+        blocks it changes and appends them to the data file,
+        and appends their new location to the block index at
+        ``filename``. Once over half of the data file is old
+        versions of blocks, it's compacted (see ``compact``).
+
+        Index entries hold a CRC of their block, so after a crash
+        ``load(validate=True)`` can fall back to the last intact
+        version of each block. The table's write-ahead log then
+        redoes the lost writes.
+
+        :param filename: Location of the block index. The
+            data files are next to it.
+        :param codec: Compression module. One of ``BlockFile.CODECS``.
+        :param block_size: Uncompressed size of each block, in bytes
+        :param cache_blocks: Number of decompressed blocks to
+            keep in memory, so reads of neighbouring pages don't
+            decompress the same block again.
+        """
+        if codec not in self.CODECS:
+            raise ValueError(f"Unknown codec \"{codec}\". Options: {self.CODECS}.")
+        assert block_size > 0
+        self.filename = Path(filename)
+        self.codec = codec
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self._module = importlib.import_module(codec)
+        self._guard = threading.RLock()
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._blocks = None
+        self._size = 0
+        self._gen = 0
+        self._data_size = 0
+
+    def __repr__(self):
+        return f"<toydb.BlockFile {self.filename.name} ({self.codec})>"
+
+    def _dataPath(self, gen: int) -> Path:
+        return Path(f"{self.filename}.data{gen}")
+
+    def paths(self) -> List[Path]:
+        """Get the files making up the table (the index and
+        the current data file), eg to sync them.
+        """
+        self._load()
+        return [self.filename, self._dataPath(self._gen)]
+
+    def reload(self):
+        """Forget the cached index and blocks, eg after another
+        process has written to the table.
+        """
+        with self._guard:
+            self._blocks = None
+            self._cache.clear()
+
+    def _load(self):
+        if self._blocks is None:
+            self.load()
+
+    def load(self, validate: bool = False):
+        """Read the block index.
+
+        :param validate: Check each block against its CRC, and
+            skip the index entries of blocks that are corrupt (eg
+            torn by a crash), so the previous version is used.
+        """
+        with self._guard:
+            data = self.filename.read_bytes() if self.filename.exists() else b""
+            gen, blocks, size = 0, [], 0
+            if len(data) >= self._header.size:
+                magic, gen = self._header.unpack_from(data)
+                assert magic == self._magic, f"\"{self.filename}\" isn't a block file."
+            data_path = self._dataPath(gen)
+            f = data_path.open("rb") if validate and data_path.exists() else None
+            try:
+                pos = self._header.size
+                while pos + self._entry.size <= len(data):
+                    kind, n, offset, clen, rlen, crc = self._entry.unpack_from(data, pos)
+                    pos += self._entry.size
+                    if kind == self.SIZE:
+                        size = n
+                        del blocks[-(-n // self.block_size):]
+                    elif kind == self.BLOCK:
+                        if f is not None:
+                            f.seek(offset)
+                            if zlib.crc32(f.read(clen)) != crc:
+                                continue
+                        blocks.extend([None] * (n + 1 - len(blocks)))
+                        blocks[n] = (offset, clen, rlen, crc)
+            finally:
+                if f is not None:
+                    f.close()
+            self._gen, self._blocks, self._size = gen, blocks, size
+            self._data_size = data_path.stat().st_size if data_path.exists() else 0
+            self._cache.clear()
+            self._dirty.clear()
+
+    def size(self) -> int:
+        """Get the uncompressed size of the table, in bytes."""
+        with self._guard:
+            self._load()
+            return self._size
+
+    def _getBlock(self, n: int) -> bytes:
+        """Get a block's uncompressed bytes."""
+        block = self._dirty.get(n)
+        if block is not None:
+            return bytes(block)
+        block = self._cache.get(n)
+        if block is not None:
+            self._cache.move_to_end(n)
+            return block
+        loc = self._blocks[n] if n < len(self._blocks) else None
+        if loc is None:
+            return b""
+        offset, clen, _, _ = loc
+        with self._dataPath(self._gen).open("rb") as f:
+            f.seek(offset)
+            block = self._module.decompress(f.read(clen))
+        self._cache[n] = block
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return block
+
+    def read(self, offset: int, n: int) -> bytes:
+        """Read uncompressed bytes.
+
+        :param offset: Where to start reading
+        :param n: Max number of bytes to read
+        :return: The bytes (fewer than ``n`` at the end of the table)
+        """
+        with self._guard:
+            self._load()
+            end = min(offset + n, self._size)
+            parts = []
+            while offset < end:
+                b, start = divmod(offset, self.block_size)
+                part = self._getBlock(b)[start:start + end - offset]
+                if not part: break
+                parts.append(part)
+                offset += len(part)
+            return b"".join(parts)
+
+    def write(self, offset: int, data: bytes):
+        """Write uncompressed bytes. Changes are buffered
+        until ``flush``.
+
+        :param offset: Where to write ``data``. Gaps past
+            the end of the table are filled with zeros.
+        :param data: Bytes to write
+        """
+        with self._guard:
+            self._load()
+            if offset > self._size:
+                self.write(self._size, bytes(offset - self._size))
+            data = memoryview(data)
+            end = offset + len(data)
+            while offset < end:
+                b, start = divmod(offset, self.block_size)
+                block = self._dirty.get(b)
+                if block is None:
+                    block = self._dirty[b] = bytearray(self._getBlock(b))
+                n = min(self.block_size - start, end - offset)
+                if len(block) < start:
+                    block.extend(bytes(start - len(block)))
+                block[start:start + n] = data[:n]
+                data = data[n:]
+                offset += n
+            self._size = max(self._size, end)
+
+    def truncate(self, size: int):
+        """Change the size of the table. Changes are
+        buffered until ``flush``.
+
+        :param size: New uncompressed size, in bytes
+        """
+        with self._guard:
+            self._load()
+            if size > self._size:
+                self.write(size - 1, b"\x00")
+                return
+            n_blocks = -(-size // self.block_size)
+            for b in [b for b in self._dirty if b >= n_blocks]:
+                del self._dirty[b]
+            del self._blocks[n_blocks:]
+            self._cache.clear()
+            if size % self.block_size:
+                b = n_blocks - 1
+                block = self._dirty.get(b)
+                if block is None:
+                    block = self._dirty[b] = bytearray(self._getBlock(b))
+                del block[size % self.block_size:]
+            self._size = size
+
+    def flush(self):
+        """Compress the blocks changed since the last flush,
+        append them to the data file and record them in the index.
+        """
+        with self._guard:
+            self._load()
+            entries = []
+            with self._dataPath(self._gen).open("ab") as f:
+                offset = f.tell()
+                for b in sorted(self._dirty):
+                    raw = bytes(self._dirty[b])
+                    data = self._module.compress(raw)
+                    f.write(data)
+                    loc = (offset, len(data), len(raw), zlib.crc32(data))
+                    self._blocks.extend([None] * (b + 1 - len(self._blocks)))
+                    self._blocks[b] = loc
+                    self._cache[b] = raw
+                    entries.append(self._entry.pack(self.BLOCK, b, *loc))
+                    offset += len(data)
+                self._data_size = offset
+            entries.append(self._entry.pack(self.SIZE, self._size, 0, 0, 0, 0))
+            with self.filename.open("ab") as f:
+                if f.tell() < self._header.size:
+                    f.truncate(0)
+                    f.write(self._header.pack(self._magic, self._gen))
+                f.write(b"".join(entries))
+            self._dirty.clear()
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+            live = sum(loc[1] for loc in self._blocks if loc is not None)
+            if self._data_size > max(2 * live, 4 * self.block_size):
+                self.compact()
+
+    def compact(self):
+        """Rewrite the data file without the old versions of
+        blocks, and start a new index.
+
+        The new files are written under a new generation number
+        and synced before the index is atomically replaced, so a
+        crash leaves either the old or the new version.
+        """
+        with self._guard:
+            self._load()
+            gen = self._gen + 1
+            blocks, entries = [], []
+            with self._dataPath(self._gen).open("rb") as src, \
+                self._dataPath(gen).open("wb") as dst:
+                for b, loc in enumerate(self._blocks):
+                    if loc is None:
+                        blocks.append(None)
+                        continue
+                    offset, clen, rlen, crc = loc
+                    src.seek(offset)
+                    new = (dst.tell(), clen, rlen, crc)
+                    dst.write(src.read(clen))
+                    blocks.append(new)
+                    entries.append(self._entry.pack(self.BLOCK, b, *new))
+                dst.flush()
+                os.fsync(dst.fileno())
+                data_size = dst.tell()
+            entries.append(self._entry.pack(self.SIZE, self._size, 0, 0, 0, 0))
+            tmp = self.filename.with_name(self.filename.name + ".tmp")
+            with tmp.open("wb") as f:
+                f.write(self._header.pack(self._magic, gen) + b"".join(entries))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(str(tmp), str(self.filename))
+            util.fsync_dir(self.filename.parent)
+            old = self._dataPath(self._gen)
+            self._gen, self._blocks, self._data_size = gen, blocks, data_size
+            old.unlink()
+
+    def remove(self):
+        """Delete the index and data files."""
+        with self._guard:
+            self._load()
+            for path in self.paths():
+                if path.exists():
+                    path.unlink()
+            self._blocks = None
@@ -0,0 +1,158 @@
+
+import os
+import hashlib
+import threading
+from pathlib import Path
+
+from typing import Any, Iterable, Union
+
+
+class BloomFilter:
+
+    BITS_PER_ROW = 10
+    HASHES = 7
+
+    def __init__(self, filename: Union[str,Path], zone_rows: int):
+        """Per-zone Bloom filters of a column's values, so
+        equality filters can skip the zones that don't hold
+        the value they're looking for.
+
+        Each zone of ``zone_rows`` rows (the same zones as the
+        table's ``ZoneMap``) gets a filter of ``BITS_PER_ROW``
+        bits per row, with ``HASHES`` hash functions, for a
+        false positive rate of about 1%. Like the zone map, values
+        are only ever added, so overwritten and deleted values
+        make the filters less selective until they're rebuilt.
+
+        :param filename: Location of the filter file
+        :param zone_rows: Number of rows per zone
+        """
+        assert zone_rows > 0
+        self.filename = Path(filename)
+        self.zone_rows = zone_rows
+        self.n_bits = zone_rows * self.BITS_PER_ROW
+        self.zone_size = -(-self.n_bits // 8)
+        self._zones = None
+        self._dirty = set()
+        self._guard = threading.RLock()
+
+    def __repr__(self):
+        return f"<toydb.BloomFilter {self.filename.name}>"
+
+    def __len__(self):
+        with self._guard:
+            self._load()
+            return len(self._zones)
+
+    def exists(self) -> bool:
+        """Does the filter file exist?"""
+        return self.filename.exists()
+
+    def _load(self):
+        if self._zones is None:
+            data = self.filename.read_bytes() if self.filename.exists() else b""
+            self._zones = [bytearray(data[i:i + self.zone_size]) for i
+                in range(0, len(data) - len(data) % self.zone_size, self.zone_size)]
+            self._dirty.clear()
+
+    def reload(self):
+        """Forget the cached filters, eg after another
+        process has written to the table.
+        """
+        with self._guard:
+            self._zones = None
+
+    @staticmethod
+    def _key(value: Any) -> bytes:
+        """Encode a value for hashing. Numbers that compare
+        equal (eg ``1``, ``1.0`` and ``True``) get the same key.
+        """
+        if isinstance(value, (bytes, str)):
+            return value.encode() if isinstance(value, str) else b"b" + value
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return repr(+value if isinstance(value, bool) else value).encode()
+
+    def _bits(self, value: Any) -> Iterable[int]:
+        """Get the bits a value sets (by double hashing)."""
+        digest = hashlib.blake2b(self._key(value), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.HASHES))
+
+    def add(self, first_row: int, values: Iterable[Any]):
+        """Add the values of rows being written. ``None``
+        values are skipped.
+
+        :param first_row: Row number of the first row
+        :param values: The column's raw values for consecutive rows
+        """
+        with self._guard:
+            self._load()
+            zones = self._zones
+            for n, value in enumerate(values, first_row):
+                if value is None: continue
+                z = n // self.zone_rows
+                while len(zones) <= z:
+                    zones.append(bytearray(self.zone_size))
+                    self._dirty.add(len(zones) - 1)
+                bits = zones[z]
+                for b in self._bits(value):
+                    bits[b >> 3] |= 1 << (b & 7)
+                self._dirty.add(z)
+
+    def mightContain(self, z: int, value: Any) -> bool:
+        """Check whether a zone might hold a value.
+
+        :param z: Zone number
+        :param value: Raw value to look for
+        :return: ``False`` if the zone definitely doesn't
+            hold ``value``. Zones without a filter might.
+        """
+        with self._guard:
+            self._load()
+            if z >= len(self._zones):
+                return True
+            bits = self._zones[z]
+        return all(bits[b >> 3] & (1 << (b & 7)) for b in self._bits(value))
+
+    def truncate(self, n_rows: int):
+        """Drop the filters of zones past the end of the table.
+
+        :param n_rows: New number of rows in the table
+        """
+        with self._guard:
+            self._load()
+            n = -(-n_rows // self.zone_rows)
+            del self._zones[n:]
+            self._dirty = {z for z in self._dirty if z < n}
+            self._dirty.add(-1)
+
+    def flush(self):
+        """Write the changed filters to the filter file."""
+        with self._guard:
+            if self._zones is None or not self._dirty:
+                return
+            mode = "r+b" if self.filename.exists() else "w+b"
+            with self.filename.open(mode) as f:
+                for z in sorted(self._dirty):
+                    if z < 0: continue
+                    f.seek(z * self.zone_size)
+                    f.write(self._zones[z])
+                f.truncate(len(self._zones) * self.zone_size)
+            self._dirty.clear()
+
+    def build(self, values: Iterable[Any]):
+        """Rebuild the filters from scratch, and replace
+        the filter file.
+
+        :param values: The column's raw value for every row
+            in the table (``None`` for nulls and deleted rows)
+        """
+        with self._guard:
+            self._zones, self._dirty = [], set()
+            self.add(0, values)
+            tmp = self.filename.with_name(self.filename.name + ".tmp")
+            tmp.write_bytes(b"".join(self._zones))
+            os.replace(str(tmp), str(self.filename))
+            self._dirty.clear()
@@ -0,0 +1,111 @@
+
+import threading
+from collections import OrderedDict
+
+from typing import Callable, Hashable, Optional
+
+
+class BufferPool:
+
+    PAGE_SIZE = 8192
+
+    def __init__(self, capacity: int = 64 * 2 ** 20, page_size: int = PAGE_SIZE):
+        """An in-memory cache of table pages, shared by
+        every table in a database.
+
+        Table files are split into pages of ``page_size``
+        bytes (rounded down to a whole number of rows, with
+        at least one row per page). Pages are evicted in
+        least-recently-used order once the pool holds more
+        than ``capacity`` bytes.
+
+        The pool is thread-safe.
+
+        :param capacity: Memory budget for cached pages, in bytes
+        :param page_size: Target size of each page, in bytes
+        """
+        assert capacity >= 0
+        assert page_size > 0
+        self.capacity = capacity
+        self.page_size = page_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+        self._files = {}
+        self._guard = threading.Lock()
+
+    def __repr__(self):
+        return (f"<toydb.BufferPool {len(self._pages)} pages, "
+            f"{self.size}/{self.capacity} bytes>")
+
+    def __len__(self):
+        return len(self._pages)
+
+    def rowsPerPage(self, row_size: int) -> int:
+        """Get the number of rows stored on each page.
+
+        :param row_size: Size of a row, in bytes
+        :return: Rows per page
+        """
+        return max(1, self.page_size // row_size)
+
+    def getPage(self, file: Hashable, page_no: int, load: Callable[[], bytes]) -> bytes:
+        """Get a page from the pool, loading it on a miss.
+
+        :param file: Key identifying the file the page is from
+        :param page_no: Page number within the file
+        :param load: Function that reads the page's bytes
+        :return: The page's bytes
+        """
+        key = (file, page_no)
+        with self._guard:
+            page = self._pages.get(key)
+            if page is not None:
+                self.hits += 1
+                self._pages.move_to_end(key)
+                return page
+            self.misses += 1
+        # Load without holding the lock, so other threads'
+        # hits don't wait on the read.
+        page = load()
+        if len(page) > self.capacity:
+            return page
+        with self._guard:
+            if key in self._pages:
+                return self._pages[key]
+            self._pages[key] = page
+            self._files.setdefault(file, set()).add(page_no)
+            self.size += len(page)
+            while self.size > self.capacity:
+                (old_file, old_page), old = self._pages.popitem(last=False)
+                self._files[old_file].discard(old_page)
+                self.size -= len(old)
+        return page
+
+    def invalidate(self, file: Hashable, first_page: int = 0,
+        last_page: Optional[int] = None):
+        """Drop a file's cached pages after it's
+        been written to.
+
+        :param file: Key identifying the file
+        :param first_page: Only drop pages from this
+            page onwards (eg after an append).
+        :param last_page: Only drop pages up to (and
+            including) this page. If ``None``, every page
+            from ``first_page`` onwards is dropped.
+        """
+        with self._guard:
+            pages = self._files.get(file)
+            if not pages: return
+            for page_no in [p for p in pages if p >= first_page
+                and (last_page is None or p <= last_page)]:
+                self.size -= len(self._pages.pop((file, page_no)))
+                pages.discard(page_no)
+
+    def clear(self):
+        """Drop every cached page."""
+        with self._guard:
+            self._pages.clear()
+            self._files.clear()
+            self.size = 0
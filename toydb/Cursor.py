@@ -0,0 +1,105 @@
+
+import itertools as it
+
+from . import exceptions
+
+from typing import Iterator, List, Optional
+
+
+class Cursor:
+
+    def __init__(self, rows: Iterator[tuple], columns: List[str],
+        rownumber: int = 0, arraysize: int = 1_000):
+        """A lazy iterator over a query's results (see
+        ``Database.cursor``).
+
+        Rows are only read from the table as they're fetched,
+        so memory use doesn't grow with the size of the result.
+        The cursor holds a shared lock on the table from the first
+        fetch until it's exhausted or closed, and the thread
+        reading it can't write to the table in the meantime, so
+        close cursors that aren't read to the end (or use them
+        as a context manager). The lock belongs to the thread
+        that started reading, but the cursor can be closed (or
+        garbage collected) from any thread.
+
+        :param rows: Iterator over the result rows
+        :param columns: Names of the result columns
+        :param rownumber: Index (in the full result) of the
+            first row in ``rows``
+        :param arraysize: Default number of rows for ``fetchmany``
+        """
+        self.columns = columns
+        self.rownumber = rownumber
+        self.arraysize = arraysize
+        self._rows = rows
+
+    def __repr__(self):
+        state = "closed" if self.closed else f"row {self.rownumber}"
+        return f"<toydb.Cursor {state}>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple:
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    @property
+    def closed(self) -> bool:
+        return self._rows is None
+
+    def _check(self):
+        if self._rows is None:
+            raise exceptions.CursorClosedError("Cursor is closed.")
+
+    def fetchone(self) -> Optional[tuple]:
+        """Fetch the next row.
+
+        :return: The next row, or ``None`` if there are no more.
+        """
+        self._check()
+        row = next(self._rows, None)
+        if row is not None:
+            self.rownumber += 1
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[tuple]:
+        """Fetch the next rows.
+
+        :param size: Max number of rows to fetch. Defaults
+            to ``arraysize``.
+        :return: Up to ``size`` rows. Empty if there are no more.
+        """
+        self._check()
+        rows = list(it.islice(self._rows, self.arraysize if size is None else size))
+        self.rownumber += len(rows)
+        return rows
+
+    def fetchall(self) -> List[tuple]:
+        """Fetch every remaining row.
+
+        :return: The remaining rows
+        """
+        self._check()
+        rows = list(self._rows)
+        self.rownumber += len(rows)
+        return rows
+
+    def close(self):
+        """Stop reading the results, releasing the table's
+        lock. Closing a closed cursor does nothing.
+        """
+        if self._rows is not None:
+            close = getattr(self._rows, "close", None)
+            if close is not None:
+                close()
+            self._rows = None
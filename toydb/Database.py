@@ -1,19 +1,51 @@
 """
 """
 
+import os
 import json
+import mmap
 import shutil
+import struct
+import threading
+import contextlib
+import concurrent.futures
+import itertools as it
 from pathlib import Path
 from datetime import datetime as dt
 
 from . import util
+from . import sort
 from . import dtypes
+from . import expr
+from . import exceptions
+from . import parallel
+from . import planner
+from .BTree import BTree
+from .BlockFile import BlockFile
+from .BloomFilter import BloomFilter
+from .BufferPool import BufferPool
+from .Cursor import Cursor
+from .HashIndex import HashIndex
+from .LockManager import LockManager
+from .ResultCache import ResultCache
+from .aggregates import Aggregate, HashAggregator
 from .RowStruct import RowStruct
+from .StringHeap import StringHeap
+from .WriteAheadLog import WriteAheadLog
+from .ZoneMap import ZoneMap
 
-from typing import Union, Dict, Any, Sequence, List, Callable, Iterable
+from typing import Union, Dict, Any, Sequence, List, Callable, Iterable, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 class Database:
+
+    PARALLEL_MIN_ROWS = 10_000
+
     @staticmethod
     def _validateDirectory(db_path: Union[str,Path]):
         """Check that the directory is valid.
@@ -40,9 +72,8 @@ class Database:
         # And key child directories
         (filename / "tables").mkdir()
         (filename / "indexes").mkdir()
-        metafile = filename / "metadata.json"
-        metafile.touch()
-        metafile.write_text(
+        (filename / "locks").mkdir()
+        util.write_atomic(filename / "metadata.json",
             json.dumps({
                 "db-name": name,
                 "tables": {},
@@ -59,22 +90,68 @@ class Database:
         cls._new(name,path)
         return cls(name,path)
 
-    def __init__(self, name: str = "db.tdb", path: str = "."):
+    def __init__(self, name: str = "db.tdb", path: str = ".",
+        sort_buffer_rows: int = 100_000, aggregate_buffer_groups: int = 100_000,
+        buffer_pool_size: int = 64 * 2 ** 20, durability: str = "commit",
+        wal_checkpoint_bytes: int = 16 * 2 ** 20, lock_timeout: Optional[float] = None,
+        result_cache_size: int = 0):
         """Creates an instance of a `toydb.Database`.
 
         If a database doesn't already exist, it will
         create a new one by calling ``Database.new()``.
 
         :param filename: Path to the database directory
+        :param sort_buffer_rows: Max number of rows to sort in
+            memory for an ``ORDER BY``. Bigger sorts are spilled
+            to disk in the database's ``tmp`` directory.
+        :param aggregate_buffer_groups: Max number of groups to
+            hold in memory for a ``GROUP BY``. Partial results for
+            more groups are spilled to the ``tmp`` directory.
+        :param buffer_pool_size: Memory budget, in bytes, for
+            caching table pages (see ``BufferPool``).
+        :param durability: How writes are made durable. One of
+            ``"none"``, ``"commit"`` (fsync every commit) or ``"group"``
+            (concurrent commits share an fsync). See ``WriteAheadLog``.
+        :param wal_checkpoint_bytes: Checkpoint (see ``checkpoint``)
+            once the write-ahead log grows past this size.
+        :param lock_timeout: Max time, in seconds, to wait for another
+            process's lock on a table (see ``LockManager``). If ``None``,
+            wait as long as it takes.
+        :param result_cache_size: Memory budget, in bytes, for
+            caching the results of ``query`` calls (see
+            ``ResultCache``). ``0`` (the default) disables it.
         """
         self.filename = Path(path) / name
+        self.sort_buffer_rows = sort_buffer_rows
+        self.aggregate_buffer_groups = aggregate_buffer_groups
         if self.filename.exists():
             self._validateDirectory(self.filename)
         else:
             self._new(name,path)
-        self.metadata = self._loadMetadata()
+        self._maps = {}
+        self._pool = None
+        self._pool_workers = 0
+        self.buffer_pool = BufferPool(buffer_pool_size)
+        self.result_cache = ResultCache(result_cache_size)
+        self._locks = LockManager(self.filename / "locks", lock_timeout)
+        self._reading = threading.local()
+        self._versions = {}
+        self._md_stamp = None
+        self._refreshMetadata()
         self.name = self.metadata.get("db-name")
-        self._structs = self._loadStructs()
+        self.wal_checkpoint_bytes = wal_checkpoint_bytes
+        self._wal = WriteAheadLog(self.filename / "wal.log", durability)
+        self._dirty = set()
+        # Only recover if no other process has the database
+        # open, since their changes might still be in the log.
+        if self._locks.acquire("open", LockManager.EXCLUSIVE, blocking=False):
+            try:
+                self._recover()
+            finally:
+                self._locks.acquire("open", LockManager.SHARED)
+                self._locks.release("open", LockManager.EXCLUSIVE)
+        else:
+            self._locks.acquire("open", LockManager.SHARED)
 
     def __str__(self):
         return f"<toydb.Database {self.name}>"
@@ -82,11 +159,406 @@ class Database:
     def __repr__(self):
         return str(self)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release the memory-mapped table files and
+        empty the buffer pool.
+
+        The database can still be used afterwards -- tables
+        will be re-mapped the next time they're read.
+        """
+        self.checkpoint()
+        self._wal.close()
+        self._shutdownPool()
+        self.buffer_pool.clear()
+        self.result_cache.clear()
+        for mm in self._maps.values():
+            try:
+                mm.close()
+            except BufferError:
+                # Still being read by a live generator. It'll
+                # be closed when that's garbage collected.
+                pass
+        self._maps.clear()
+
     def remove(self):
         """Deletes a database folder and
         all subdirectories."""
+        self._wal.close()
+        self._shutdownPool()
+        self._locks.close()
+        self._maps.clear()
+        self.buffer_pool.clear()
+        self.result_cache.clear()
         shutil.rmtree(self.filename)
 
+    def _metadataStamp(self) -> tuple:
+        st = (self.filename / "metadata.json").stat()
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _refreshMetadata(self):
+        """Reload the metadata (and everything derived from
+        it) if another process has changed it.
+        """
+        stamp = self._metadataStamp()
+        if stamp == self._md_stamp:
+            return
+        self.metadata = self._loadMetadata()
+        self._structs = self._loadStructs()
+        self._indexes = self._loadIndexes()
+        self._blocks = self._loadBlockFiles()
+        self._zones = self._loadZoneMaps()
+        self._blooms = self._loadBloomFilters()
+        self._maps.clear()
+        self.buffer_pool.clear()
+        self.result_cache.clear()
+        self._versions.clear()
+        self._md_stamp = stamp
+
+    def _tableLockName(self, table_name: str) -> str:
+        return f"table-{util.md5(table_name)}"
+
+    def _refreshTable(self, table_name: str):
+        """Drop a table's cached pages if another process
+        has written to it since they were read. Called
+        holding the table's lock.
+        """
+        version = self._locks.counter(self._tableLockName(table_name))
+        if self._versions.get(table_name) != version:
+            self._invalidateMap(table_name)
+            if table_name in self._blocks:
+                self._blocks[table_name].reload()
+            self._zones[table_name].reload()
+            for bloom in self._blooms[table_name].values():
+                bloom.reload()
+            self._versions[table_name] = version
+
+    @contextlib.contextmanager
+    def _lock(self, table_names: Iterable[str], exclusive: bool = False):
+        """Lock tables for reading (shared) or writing
+        (exclusive), so other processes can't change them
+        in the meantime.
+
+        Takes a shared lock on the metadata first (so tables
+        can't be created or dropped), then the tables' locks
+        in a consistent order.
+
+        :param table_names: Tables in the database
+        :param exclusive: Lock the tables exclusively
+        :raises exceptions.CursorOpenError: If this thread
+            has a cursor open on a table it's writing to
+        """
+        if exclusive:
+            self._checkNotReading(table_names)
+        with self._locks.shared("metadata"), contextlib.ExitStack() as stack:
+            self._refreshMetadata()
+            for table_name in sorted(set(t.lower() for t in table_names)):
+                name = self._tableLockName(table_name)
+                stack.enter_context(self._locks.exclusive(name)
+                    if exclusive else self._locks.shared(name))
+                if table_name in self.metadata["tables"]:
+                    self._refreshTable(table_name)
+            yield
+
+    @contextlib.contextmanager
+    def _lockCatalog(self):
+        """Lock the metadata exclusively, to create or drop
+        tables and indexes. No other process can use the
+        database while it's held.
+
+        :raises exceptions.CursorOpenError: If this thread
+            has a cursor open
+        """
+        self._checkNotReading()
+        with self._locks.exclusive("metadata"):
+            self._refreshMetadata()
+            yield
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Hold the write-ahead log's lock (shared) while a
+        write commits and the table's indexes and free-slot
+        list are updated to match, so a checkpoint can't empty
+        the log in between. If the process dies before they're
+        updated, the table is still in the log, and ``_recover``
+        rebuilds them from the table file.
+        """
+        with self._locks.shared("wal"):
+            yield
+
+    def _readingTables(self) -> Dict[str,int]:
+        """Get the number of cursors the current thread
+        has open on each table (see ``_iterLocked``).
+        """
+        tables = getattr(self._reading, "tables", None)
+        if tables is None:
+            tables = self._reading.tables = {}
+        return tables
+
+    def _checkNotReading(self, table_names: Optional[Iterable[str]] = None):
+        """Make sure the current thread isn't reading
+        tables through an open cursor before it writes to
+        them. Its shared locks can't be upgraded, and the
+        cursor would see a mix of old and new rows.
+
+        :param table_names: Tables to check. If ``None``,
+            check every table.
+        :raises exceptions.CursorOpenError: If a cursor
+            is open on one of the tables
+        """
+        reading = self._readingTables()
+        names = list(reading) if table_names is None else [t.lower() for t in table_names]
+        for table_name in names:
+            if reading.get(table_name):
+                raise exceptions.CursorOpenError(
+                    f"Table \"{table_name}\" has an open cursor in this thread. "
+                    "Close it before writing.")
+
+    def _iterLocked(self, itr: Iterable, table_names: Iterable[str]) -> Iterable:
+        """Hold shared locks on tables while iterating.
+        Until it's done, the thread can't write to the tables.
+
+        :param itr: Iterable reading from the tables
+        :param table_names: Tables to lock
+        :yields: Values from ``itr``
+        """
+        table_names = sorted(set(t.lower() for t in table_names))
+        with self._lock(table_names):
+            reading = self._readingTables()
+            for table_name in table_names:
+                reading[table_name] = reading.get(table_name, 0) + 1
+            try:
+                yield from itr
+            finally:
+                for table_name in table_names:
+                    reading[table_name] -= 1
+                    if not reading[table_name]:
+                        del reading[table_name]
+
+    def _recover(self):
+        """Replay the committed transactions in the
+        write-ahead log after a crash, then rebuild the
+        indexes and free-slot lists of the tables they
+        touched and checkpoint.
+        """
+        tables = []
+        for rtype, table_name, value, data in self._wal.committed():
+            if table_name not in self.metadata["tables"]:
+                continue
+            if table_name not in tables and table_name in self._blocks:
+                # Fall back to the last intact version of any
+                # blocks that were torn by the crash
+                self._blocks[table_name].load(validate=True)
+            self._applyRecords(table_name, [(rtype, table_name, value, data)])
+            if table_name not in tables:
+                tables.append(table_name)
+        for table_name in tables:
+            self._invalidateMap(table_name)
+            self._rebuildIndexes(table_name)
+            self._rebuildFreeSlots(table_name)
+            self._rebuildZoneMap(table_name)
+            self._rebuildBloomFilters(table_name)
+            self._dirty.add(table_name)
+        if tables or self._wal.size():
+            self._checkpoint()
+
+    def _applyRecords(self, table_name: str, records: List[Tuple[int,str,int,bytes]]):
+        """Apply logged changes to a table file.
+
+        :param table_name: Table in the database
+        :param records: ``WriteAheadLog`` records for the table
+        """
+        tablefile = Path(self.metadata["tables"][table_name]["filename"])
+        heap = [r for r in records if r[0] == WriteAheadLog.HEAP_WRITE]
+        if heap:
+            with self._heapPath(table_name).open("r+b") as f:
+                for _, _, offset, data in heap:
+                    f.seek(offset)
+                    f.write(data)
+        blocks = self._blocks.get(table_name)
+        if blocks is not None:
+            for rtype, _, value, data in records:
+                if rtype == WriteAheadLog.WRITE:
+                    blocks.write(value, data)
+                elif rtype == WriteAheadLog.TRUNCATE:
+                    blocks.truncate(value)
+            blocks.flush()
+            return
+        with tablefile.open("r+b") as f:
+            for rtype, _, value, data in records:
+                if rtype == WriteAheadLog.WRITE:
+                    f.seek(value)
+                    f.write(data)
+                elif rtype == WriteAheadLog.TRUNCATE:
+                    f.truncate(value)
+
+    def checkpoint(self):
+        """Flush every table changed since the last
+        checkpoint to disk (along with its indexes and
+        free-slot list), then empty the write-ahead log.
+
+        Tables changed by other processes (found in the
+        log) are flushed too.
+        """
+        with self._locks.shared("metadata"), self._locks.exclusive("wal"):
+            self._refreshMetadata()
+            self._checkpoint()
+
+    def _checkpoint(self):
+        """Checkpoint, holding the log's lock (see ``checkpoint``)."""
+        if self._wal.size():
+            self._dirty.update(table_name for _, table_name, _, _ in self._wal.records()
+                if table_name)
+        for table_name in self._dirty:
+            if table_name not in self.metadata["tables"]:
+                continue
+            paths = [Path(self.metadata["tables"][table_name]["filename"]),
+                self._freeSlotsPath(table_name), self._heapPath(table_name),
+                self._zones[table_name].filename]
+            paths += [bloom.filename for bloom in self._blooms[table_name].values()]
+            if table_name in self._blocks:
+                paths += self._blocks[table_name].paths()
+            paths += [index.filename for index in self._indexes[table_name].values()]
+            for path in paths:
+                if not path.exists(): continue
+                with path.open("rb+") as f:
+                    os.fsync(f.fileno())
+        self._dirty.clear()
+        if self._wal.size():
+            self._wal.reset()
+
+    def _maybeCheckpoint(self):
+        """Checkpoint if the write-ahead log has grown
+        past ``wal_checkpoint_bytes``.
+        """
+        if self._wal.size() > self.wal_checkpoint_bytes:
+            self.checkpoint()
+
+    def _getMap(self, table_name: str) -> Union[mmap.mmap,bytes]:
+        """Get a read-only memory map of a table file.
+
+        Maps are shared by every read of the table, and
+        are dropped by ``_invalidateMap`` whenever the
+        table is written to.
+
+        :param table_name: Table in the database
+        :return: Memory map of the table file (or an empty
+            ``bytes`` if the file is empty, since empty files
+            can't be mapped).
+        """
+        mm = self._maps.get(table_name)
+        if mm is None:
+            tablefile = Path(self.metadata["tables"][table_name]["filename"])
+            with tablefile.open("rb") as f:
+                if f.seek(0, 2) == 0:
+                    return b""
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[table_name] = mm
+        return mm
+
+    def _invalidateMap(self, table_name: str, first_row: int = 0,
+        last_row: Optional[int] = None):
+        """Drop a table's memory map, cached pages and cached
+        query results after it's been written to, so the next
+        read sees the new data.
+
+        The old map isn't closed explicitly, since a
+        generator might still be reading from it.
+
+        :param table_name: Table in the database
+        :param first_row: First row that changed. Cached pages
+            before it are kept (eg when rows are appended).
+        :param last_row: Last row that changed, if only a
+            range of rows was overwritten in place.
+        """
+        self._maps.pop(table_name, None)
+        self.result_cache.invalidate(table_name)
+        rstruct = self._structs.get(table_name)
+        if rstruct is None:
+            self.buffer_pool.invalidate(table_name)
+            return
+        rows_per_page = self.buffer_pool.rowsPerPage(rstruct.row_struct.size)
+        self.buffer_pool.invalidate(table_name, first_row // rows_per_page,
+            None if last_row is None else last_row // rows_per_page)
+
+    def _tableRows(self, table_name: str) -> int:
+        """Get the number of complete rows in a table's
+        current memory map (or block file, if it's compressed).
+
+        :param table_name: Table in the database
+        :return: Number of rows
+        """
+        blocks = self._blocks.get(table_name)
+        size = len(self._getMap(table_name)) if blocks is None else blocks.size()
+        return size // self._structs[table_name].row_struct.size
+
+    def _getPage(self, table_name: str, page_no: int) -> bytes:
+        """Read a page of a table through the buffer pool.
+
+        Pages hold ``BufferPool.rowsPerPage`` whole rows (the
+        last page may hold fewer).
+
+        :param table_name: Table in the database
+        :param page_no: Page number
+        :return: The page's bytes
+        """
+        row_size = self._structs[table_name].row_struct.size
+        page_bytes = self.buffer_pool.rowsPerPage(row_size) * row_size
+        def load():
+            blocks = self._blocks.get(table_name)
+            if blocks is not None:
+                data = blocks.read(page_no * page_bytes, page_bytes)
+                return data[:len(data) - len(data) % row_size]
+            mm = self._getMap(table_name)
+            end = min((page_no + 1) * page_bytes, len(mm) - len(mm) % row_size)
+            return bytes(mm[page_no * page_bytes:end])
+        return self.buffer_pool.getPage(table_name, page_no, load)
+
+    def _pageNumbers(self, table_name: str, where = None) -> List[int]:
+        """Get the numbers of the pages a scan needs to read.
+
+        If ``where`` is an expression, pages whose rows are all
+        in zones that can't match it are skipped (see ``ZoneMap``
+        and ``BloomFilter``).
+        Rows in the pages that are read still need filtering.
+
+        :param table_name: Table in the database
+        :param where: Optional filter (see ``query``)
+        :return: Sorted page numbers
+        """
+        rows_per_page = self.buffer_pool.rowsPerPage(
+            self._structs[table_name].row_struct.size)
+        n_rows = self._tableRows(table_name)
+        n_pages = -(-n_rows // rows_per_page)
+        if not isinstance(where, expr.Expr) or not n_rows:
+            return list(range(n_pages))
+        zone_map = self._zoneMap(table_name)
+        zone_rows = zone_map.zone_rows
+        pages = set()
+        for z in zone_map.candidates(where, self._structs[table_name], n_rows,
+            self._bloomFilters(table_name)):
+            first = z * zone_rows
+            last = min(first + zone_rows, n_rows) - 1
+            pages.update(range(first // rows_per_page, last // rows_per_page + 1))
+        return sorted(pages)
+
+    def _iterPages(self, table_name: str, where = None) -> Iterable[bytes]:
+        """Generator function for reading every page of
+        a table, in order, through the buffer pool.
+
+        :param table_name: Table in the database
+        :param where: Optional filter, to skip pages that
+            can't match it (see ``_pageNumbers``)
+        :yields: Each page's bytes
+        """
+        for page_no in self._pageNumbers(table_name, where):
+            yield self._getPage(table_name, page_no)
+
     def listTables(self) -> List[str]:
         """Get a list of Database table names.
 
@@ -112,7 +584,8 @@ class Database:
         return list(self.getTableSchema(table_name))
 
     def createTable(self, table_name: str, schema: Dict[str,dtypes.DType],
-        if_not_exists: bool = False):
+        if_not_exists: bool = False, primary_key: Optional[str] = None,
+        compression: Optional[str] = None, bloom_filters: Optional[List[str]] = None):
         """Create a new DB table.
 
         :param table_name: Name of new table
@@ -122,20 +595,74 @@ class Database:
         :param if_not_exists: If ``True`` and the table
             already exists, it won't be overwritten,
             otherwise it will.
+        :param primary_key: Optional column to use as the
+            table's primary key. Its values must be unique
+            and not null, and rows can be looked up by key
+            with ``Database.get``.
+        :param compression: Optionally, store the table as blocks
+            compressed with this codec (one of ``BlockFile.CODECS``).
+            Reads decompress a block at a time, and writes
+            recompress the blocks they change.
+        :param bloom_filters: Optionally, columns to keep Bloom
+            filters on (see ``createBloomFilter``).
         """
         table_name = table_name.lower()
-        assert " " not in table_name
-        if if_not_exists and table_name in self.listTables():
-            return
-        filename = self.filename / "tables" / util.md5(table_name)
-        filename.touch()
-        self.metadata["tables"][table_name] = {
-            "schema": schema,
-            "indexes": [], # NOTE: Indexes not implemented
-            "filename": str(filename)
-        }
-        self._writeMetadata()
-        self._structs = self._loadStructs()
+        with self._lockCatalog():
+            assert " " not in table_name
+            if if_not_exists and table_name in self.listTables():
+                return
+            # Don't let changes to an old table with the same
+            # name be replayed onto the new one
+            self.checkpoint()
+            filename = self.filename / "tables" / util.md5(table_name)
+            if compression is not None:
+                row_size = RowStruct(list(schema), list(schema.values()),
+                    tombstone=True).row_struct.size
+                compression = {"codec": compression, "block_size":
+                    max(1, BlockFile.BLOCK_SIZE // row_size) * row_size}
+                # Check the codec before creating anything
+                BlockFile(filename, **compression)
+                filename.write_bytes(b"")
+            else:
+                filename.touch()
+            if dtypes.VARSTRING in schema.values():
+                Path(f"{filename}.heap").write_bytes(b"")
+            Path(f"{filename}.zones").write_bytes(b"")
+            bloom_filters = list(bloom_filters or [])
+            for column in bloom_filters:
+                if column not in schema:
+                    raise exceptions.SchemaError(
+                        f"Bloom filter column \"{column}\" isn't a column.")
+                Path(f"{filename}.{util.md5(column)}.bloom").write_bytes(b"")
+            self._invalidateMap(table_name)
+            indexes = []
+            if primary_key is not None:
+                if primary_key not in schema:
+                    raise exceptions.SchemaError(
+                        f"Primary key \"{primary_key}\" isn't a column.")
+                if schema[primary_key] == dtypes.VARSTRING:
+                    raise exceptions.SchemaError("`VARSTRING` columns can't be primary keys.")
+                indexes.append({
+                    "column": primary_key,
+                    "type": "hash",
+                    "filename": str(self.filename / "indexes"
+                        / util.md5(f"{table_name}.{primary_key}.pkey"))
+                })
+            self.metadata["tables"][table_name] = {
+                "schema": schema,
+                "primary_key": primary_key,
+                "indexes": indexes,
+                "filename": str(filename),
+                "tombstones": True,
+                "compression": compression,
+                "bloom_filters": bloom_filters
+            }
+            self._writeMetadata()
+            self._structs = self._loadStructs()
+            self._indexes = self._loadIndexes()
+            self._blocks = self._loadBlockFiles()
+            self._zones = self._loadZoneMaps()
+            self._blooms = self._loadBloomFilters()
 
     def _loadMetadata(self) -> dict:
         """Read metadata from file.
@@ -157,10 +684,12 @@ class Database:
         to the metadata json file in the datebase
         directory.
         """
-        # Write out metadata using custom JSONEncoder
-        with (self.filename / "metadata.json").open("w") as f:
-            json.dump(self.metadata,f,
-                indent=2,cls=dtypes.JSONEncoder)
+        # Write out metadata using custom JSONEncoder. It's
+        # written to a temp file and renamed into place, so
+        # a crash can't leave it half-written.
+        util.write_atomic(self.filename / "metadata.json",
+            json.dumps(self.metadata,indent=2,cls=dtypes.JSONEncoder))
+        self._md_stamp = self._metadataStamp()
 
     def _loadStructs(self) -> Dict[str,dtypes.DType]:
         """Load structs from the metadata file.
@@ -169,9 +698,159 @@ class Database:
         """
         return {tn: RowStruct(
             list(d["schema"].keys()),
-            list(d["schema"].values()))
+            list(d["schema"].values()),
+            tombstone=d.get("tombstones", False),
+            heap=(StringHeap(self._heapPath(tn))
+                if dtypes.VARSTRING in d["schema"].values() else None))
             for tn, d in self.metadata["tables"].items()}
 
+    def _loadBlockFiles(self) -> Dict[str,BlockFile]:
+        """Open the block files of the compressed tables.
+
+        :return: Mapping from compressed tables to their `BlockFile`
+        """
+        return {tn: BlockFile(d["filename"], **d["compression"])
+            for tn, d in self.metadata["tables"].items() if d.get("compression")}
+
+    def _loadZoneMaps(self) -> Dict[str,ZoneMap]:
+        """Open the tables' zone maps.
+
+        :return: Mapping from tables to their `ZoneMap`
+        """
+        return {tn: ZoneMap(self._zonePath(tn), list(d["schema"].keys()),
+            list(d["schema"].values())) for tn, d in self.metadata["tables"].items()}
+
+    def _loadBloomFilters(self) -> Dict[str,Dict[str,BloomFilter]]:
+        """Open the tables' Bloom filters.
+
+        :return: Mapping from tables to a mapping from
+            column names to their `BloomFilter`
+        """
+        return {tn: {c: BloomFilter(self._bloomPath(tn, c), self._zones[tn].zone_rows)
+            for c in d.get("bloom_filters", [])}
+            for tn, d in self.metadata["tables"].items()}
+
+    def _loadIndexes(self) -> Dict[str,Dict[str,Union[BTree,HashIndex]]]:
+        """Load the indexes listed in the metadata file.
+
+        :return: Mapping from tables to a mapping from
+            column names to their `BTree` or `HashIndex`.
+        """
+        index_types = {"btree": BTree, "hash": HashIndex}
+        return {tn: {
+            idx["column"]: index_types[idx["type"]](
+                idx["filename"], d["schema"][idx["column"]])
+            for idx in d["indexes"]}
+            for tn, d in self.metadata["tables"].items()}
+
+    def createIndex(self, table_name: str, column: str,
+        if_not_exists: bool = False):
+        """Create a B+tree index on a table column.
+
+        The index is stored in the database's ``indexes``
+        directory, is kept up to date by ``insert`` and
+        ``delete``, and is used by ``query`` when its ``where``
+        argument is a ``toydb.expr`` expression that compares
+        the column to a constant.
+
+        :param table_name: Table in the database
+        :param column: Column in ``table_name`` to index
+        :param if_not_exists: If ``True`` and the index
+            already exists, don't raise an error.
+        """
+        table_name = table_name.lower()
+        with self._lockCatalog():
+            assert table_name in self.metadata["tables"]
+            schema = self.getTableSchema(table_name)
+            assert column in schema, f"Column \"{column}\" doesn't exist."
+            if schema[column] == dtypes.VARSTRING:
+                raise exceptions.SchemaError("`VARSTRING` columns can't be indexed.")
+            if column in self._indexes[table_name]:
+                assert if_not_exists, f"Index on \"{table_name}.{column}\" already exists."
+                return
+            filename = self.filename / "indexes" / util.md5(f"{table_name}.{column}")
+            btree = BTree(filename, schema[column])
+            rstruct = self._structs[table_name]
+            col_num = list(schema).index(column)
+            btree.build((rstruct.decode(raw)[col_num], i) for i, raw
+                in self._iterRaw(table_name))
+            self.metadata["tables"][table_name]["indexes"].append({
+                "column": column,
+                "type": "btree",
+                "filename": str(filename)
+            })
+            self._writeMetadata()
+            self._indexes[table_name][column] = btree
+
+    def createBloomFilter(self, table_name: str, column: str,
+        if_not_exists: bool = False):
+        """Keep Bloom filters on a table column.
+
+        Each zone of the table's rows (see ``ZoneMap``) gets a
+        filter of the column's values, which is kept up to date
+        by writes and rebuilt when ``vacuum`` finishes compacting
+        the table. Scans with a ``toydb.expr`` filter comparing
+        the column to a constant with ``==`` (or ``isin``) skip
+        the zones whose filter rules the value out, without
+        reading or decoding their pages. Best for columns with
+        many distinct values, like IDs, where min/max stats
+        rarely rule anything out.
+
+        :param table_name: Table in the database
+        :param column: Column in ``table_name`` to filter on
+        :param if_not_exists: If ``True`` and the column already
+            has Bloom filters, don't raise an error.
+        """
+        table_name = table_name.lower()
+        with self._lockCatalog():
+            assert table_name in self.metadata["tables"]
+            assert column in self.getTableSchema(table_name), \
+                f"Column \"{column}\" doesn't exist."
+            if column in self._blooms[table_name]:
+                assert if_not_exists, \
+                    f"Bloom filter on \"{table_name}.{column}\" already exists."
+                return
+            bloom = BloomFilter(self._bloomPath(table_name, column),
+                self._zones[table_name].zone_rows)
+            self._buildBloomFilter(table_name, column, bloom)
+            self.metadata["tables"][table_name].setdefault("bloom_filters", []).append(column)
+            self._writeMetadata()
+            self._blooms[table_name][column] = bloom
+
+    def _rebuildIndexes(self, table_name: str):
+        """Rebuild all of a table's indexes from
+        the contents of the table.
+
+        :param table_name: Table in the database
+        """
+        cols = self.getTableColumns(table_name)
+        rstruct = self._structs[table_name]
+        for column, index in self._indexes[table_name].items():
+            col_num = cols.index(column)
+            index.build((rstruct.decode(raw)[col_num], i) for i, raw
+                in self._iterRaw(table_name))
+
+    def _tableSize(self, table_name: str) -> int:
+        """Get the size of a table file, in bytes (uncompressed,
+        if the table is compressed).
+
+        :param table_name: Table in the database
+        :return: Size of the table
+        """
+        blocks = self._blocks.get(table_name)
+        if blocks is not None:
+            return blocks.size()
+        return Path(self.metadata["tables"][table_name]["filename"]).stat().st_size
+
+    def _rowCount(self, table_name: str) -> int:
+        """Get the number of rows in a table,
+        based on the size of the table file.
+
+        :param table_name: Table in the database
+        :return: Number of rows in ``table_name``
+        """
+        return self._tableSize(table_name) // self._structs[table_name].row_struct.size
+
     def printSchema(self, table_name: str):
         """Print a table's schema of column
         names and dtypes.
@@ -201,29 +880,13 @@ class Database:
         """
         table_name = table_name.lower()
         assert table_name in self.metadata["tables"]
-        tablefile = Path(self.metadata["tables"][table_name]["filename"])
         rstruct = self._structs.get(table_name)
-        struct_size = rstruct.row_struct.size
-        offset = struct_size * line_number
-        if offset < 0:
-            whence = 2
-        with tablefile.open("rb") as f:
-            f.seek(offset,whence)
-            return rstruct.unpack(f.read(struct_size))
-
-    def _iterReadBytes(self, filename: str, n: int) -> Iterable[bytes]:
-        """Generator function for reading a
-        binary file `n` bytes at a time.
-
-        :param filename: Filename of binary file
-        :param n: Number of bytes to read at a time
-        :yields: ``n`` bytes from ``filename``
-        """
-        with open(filename,"rb") as f:
-            while True:
-                line = f.read(n)
-                if not line: break
-                yield line
+        if line_number < 0:
+            line_number += self._tableRows(table_name)
+        rows_per_page = self.buffer_pool.rowsPerPage(rstruct.row_struct.size)
+        page = self._getPage(table_name, line_number // rows_per_page)
+        return rstruct.unpack_from(page,
+            (line_number % rows_per_page) * rstruct.row_struct.size)
 
     def _iterReadAllLines(self, table_name: str) -> Iterable[List]:
         """Generator function for iterating over
@@ -234,18 +897,389 @@ class Database:
         """
         table_name = table_name.lower()
         assert table_name in self.metadata["tables"]
-        tablefile = Path(self.metadata["tables"][table_name]["filename"])
-        lock = Path(str(tablefile) + ".lock")
-        assert not lock.exists()
+        decode = self._structs.get(table_name)._decodeRow
+        for _, raw in self._iterRaw(table_name):
+            yield decode(raw)
+
+    def _iterRaw(self, table_name: str, line_numbers: Optional[Iterable[int]] = None,
+        where = None) -> Iterable[Tuple[int,tuple]]:
+        """Generator function for reading a table's live
+        rows without decoding them.
+
+        :param table_name: Table in the database
+        :param line_numbers: Row numbers to read. If ``None``,
+            every row is read.
+        :param where: Optional filter, to skip pages that can't
+            match it when reading every row (see ``_pageNumbers``).
+            The rows still need filtering.
+        :yields: ``(row_number, raw)`` pairs, where ``raw`` is
+            the flat tuple from ``struct.unpack``. Deleted rows
+            are skipped.
+        """
         rstruct = self._structs.get(table_name)
         row_size = rstruct.row_struct.size
-        for row in self._iterReadBytes(tablefile,row_size):
-            yield rstruct.unpack(row)
+        rows_per_page = self.buffer_pool.rowsPerPage(row_size)
+        if line_numbers is None:
+            for page_no in self._pageNumbers(table_name, where):
+                page = self._getPage(table_name, page_no)
+                for n, raw in enumerate(rstruct.row_struct.iter_unpack(page),
+                    page_no * rows_per_page):
+                    if rstruct.isLive(raw):
+                        yield n, raw
+            return
+        page_no, page = None, None
+        for n in line_numbers:
+            if n // rows_per_page != page_no:
+                page_no = n // rows_per_page
+                page = self._getPage(table_name, page_no)
+            raw = rstruct.row_struct.unpack_from(page, (n % rows_per_page) * row_size)
+            if rstruct.isLive(raw):
+                yield n, raw
+
+    def _codec(self, table_name: str, columns: Optional[List[str]] = None,
+        where = None) -> RowStruct:
+        """Get the codec for reading a table when only
+        some of its columns are needed.
 
-    def _iterReadAllDict(self, table_name: str):
-        cols = list(self.metadata["tables"][table_name]["schema"].keys())
-        for row in self._iterReadAllLines(table_name):
-            yield dict(zip(cols,row))
+        :param table_name: Table in the database
+        :param columns: Columns that need to be decoded. If
+            ``None``, all columns are decoded.
+        :param where: Filter that will be applied to the rows.
+            Callables need every column; expressions only need
+            the columns they reference.
+        :return: ``RowStruct`` or projection of it
+        """
+        rstruct = self._structs.get(table_name)
+        if columns is None or not (where is None or isinstance(where, expr.Expr)):
+            return rstruct
+        if where is not None:
+            columns = list(columns) + where.columns()
+        return rstruct.project(columns)
+
+    def _rawFilter(self, table_name: str, where, rstruct: Optional[RowStruct] = None,
+        live_only: bool = True) -> Optional[Callable[[tuple],bool]]:
+        """Turn a ``where`` filter into a function that
+        can be evaluated against raw (undecoded) rows, as
+        returned by ``struct.unpack``.
+
+        ``toydb.expr`` expressions are compiled to work on the
+        raw values directly, so only matching rows get decoded.
+        Callables need the row decoded into a dict first.
+
+        :param table_name: Table in the database
+        :param where: Expression, callable or ``None``
+        :param rstruct: Codec the raw rows come from. Defaults
+            to the table's full ``RowStruct``.
+        :param live_only: Also filter out deleted rows
+        :return: Filter function, or ``None`` if there's no filter
+        """
+        if rstruct is None:
+            rstruct = self._structs.get(table_name)
+        live = live_only and rstruct.tombstone
+        if where is None:
+            return (lambda raw: raw[-1]) if live else None
+        if isinstance(where, expr.Expr):
+            match = where.compile(rstruct)
+        else:
+            cols, decode = rstruct.columns, rstruct._decodeRow
+            match = lambda raw: where(dict(zip(cols, decode(raw))))
+        if live:
+            return lambda raw: raw[-1] and match(raw)
+        return match
+
+    def _iterReadRows(self, table_name: str, line_numbers: Iterable[int],
+        where = None, columns: Optional[List[str]] = None) -> Iterable[Dict[str,Any]]:
+        """Generator function for reading specific
+        rows of a table, as dicts.
+
+        :param table_name: Name of table in database
+        :param line_numbers: Row numbers to read
+        :param where: Optional filter (see ``query``)
+        :param columns: Columns to decode (see ``_codec``). The
+            rows will only have these columns (plus the ones
+            ``where`` needs).
+        :yields: Row of data from ``table_name``
+        """
+        rstruct = self._codec(table_name, columns, where)
+        cols = rstruct.columns
+        row_size = rstruct.row_struct.size
+        match = self._rawFilter(table_name, where, rstruct)
+        decode = rstruct._decodeRow
+        rows_per_page = self.buffer_pool.rowsPerPage(row_size)
+        page_no, page = None, None
+        for n in line_numbers:
+            if n // rows_per_page != page_no:
+                page_no = n // rows_per_page
+                page = self._getPage(table_name, page_no)
+            raw = rstruct.row_struct.unpack_from(page, (n % rows_per_page) * row_size)
+            if match is None or match(raw):
+                yield dict(zip(cols, decode(raw)))
+
+    def _indexScan(self, table_name: str, where,
+        plan: Optional[planner.Plan] = None) -> Union[List[int],None]:
+        """Use the table's indexes to find the rows that
+        might match a ``where`` expression, if the planner
+        expects that to be cheaper than a scan (see ``_plan``).
+
+        :param table_name: Table in the database
+        :param where: ``WHERE`` filter passed to ``query``
+        :param plan: The query's plan (see ``_scanPlan``), if
+            it's already been made
+        :return: Sorted candidate row numbers, or ``None`` if
+            no index can (or should) be used. The candidates
+            still need to be checked against ``where``.
+        """
+        if not isinstance(where, expr.Expr) or not self._indexes[table_name]:
+            return None
+        if plan is None:
+            plan = self._plan(table_name, where)
+        if plan.method != "index_scan":
+            return None
+        rows = self._indexRows(table_name, where)
+        return None if rows is None else sorted(rows)
+
+    def _scanPlan(self, table_name: str, where = None) -> Optional[planner.Plan]:
+        """Plan how a query reads a table, once for the
+        whole query (see ``_iterQuery``).
+
+        :param table_name: Table in the database
+        :param where: Optional filter (see ``query``)
+        :return: The plan (see ``_plan``), or ``None`` if no
+            index can be used, so the table is always scanned
+        """
+        if not isinstance(where, expr.Expr) or not self._indexes[table_name]:
+            return None
+        return self._plan(table_name, where)
+
+    def _plan(self, table_name: str, where = None) -> planner.Plan:
+        """Choose how to read the rows of a table matching
+        ``where``: a full scan, a scan skipping pages (see
+        ``_pageNumbers``) or an index lookup (see ``_indexRows``).
+
+        Once the table has been analyzed (see ``analyze``),
+        the cheapest plan is chosen using its statistics.
+        Until then, an index is used whenever one applies.
+
+        :param table_name: Table in the database
+        :param where: Optional filter (see ``query``)
+        :return: The chosen plan, with the others as
+            its ``alternatives``
+        """
+        stats = self.metadata["tables"][table_name].get("stats")
+        rows_per_page = self.buffer_pool.rowsPerPage(
+            self._structs[table_name].row_struct.size)
+        n_rows = self._tableRows(table_name)
+        n_pages = -(-n_rows // rows_per_page)
+        est_rows = planner.selectivity(where, stats) * n_rows
+        plans = [planner.Plan("seq_scan", table_name, planner.scan_cost(n_pages, n_rows),
+            est_rows, n_pages, n_pages, where=where)]
+        indexed = set(self._indexes[table_name])
+        index_sel = planner.index_selectivity(where, stats, indexed) if indexed else None
+        if index_sel is not None:
+            fetched, entries = index_sel
+            plans.append(planner.Plan("index_scan", table_name,
+                planner.index_cost(fetched * n_rows, entries * n_rows, n_pages), est_rows,
+                index=[c for c in where.columns() if c in indexed], where=where))
+        n_zones = -(-n_rows // self._zones[table_name].zone_rows)
+        if isinstance(where, expr.Expr) and n_rows and (stats is not None or index_sel is None) \
+            and min(p.cost for p in plans) > planner.scan_cost(0, 0, n_zones):
+            # Checking the zones costs less than the cheapest plan so
+            # far, so see how many pages skipping them would save
+            n_read = len(self._pageNumbers(table_name, where))
+            if n_read < n_pages:
+                plans.append(planner.Plan("zone_scan", table_name, planner.scan_cost(
+                    n_read, min(n_read * rows_per_page, n_rows), n_zones),
+                    est_rows, n_read, n_pages, where=where))
+        if stats is None and index_sel is not None:
+            best = plans[1]
+        else:
+            best = min(plans, key=lambda p: p.cost)
+        best.analyzed = stats is not None
+        best.alternatives = [p for p in plans if p is not best]
+        return best
+
+    def _indexLookup(self, index: Union[BTree,HashIndex], lo: Any, hi: Any,
+        lo_inc: bool = True, hi_inc: bool = True) -> Optional[set]:
+        """Look up a range of values in an index. Expressions
+        are turned into ranges by ``_indexRows``.
+
+        :param index: The column's ``BTree`` or ``HashIndex``
+        :param lo: Lower bound, or ``None`` for no lower bound
+        :param hi: Upper bound, or ``None`` for no upper bound
+        :param lo_inc: Is ``lo`` itself in the range?
+        :param hi_inc: Is ``hi`` itself in the range?
+        :return: Set of row numbers, or ``None`` if the index
+            can't answer the lookup (eg a range lookup on a
+            ``HashIndex``, or constants of the wrong type).
+        """
+        if not all(v is None or index.dtype.validate(v) for v in (lo, hi)):
+            return None
+        if isinstance(index, HashIndex):
+            if lo is None or lo != hi or not (lo_inc and hi_inc):
+                return None
+            row_number = index.get(lo)
+            return set() if row_number is None else {row_number}
+        return set(index.search(lo, hi, lo_inc, hi_inc))
+
+    def _indexRows(self, table_name: str, where: expr.Expr) -> Optional[set]:
+        """Recursively find a superset of the rows matching
+        ``where`` using the table's indexes.
+
+        * ``AND``-ed comparisons on the same column are combined
+          into one range lookup, and the results of the terms that
+          can use an index are intersected.
+        * ``OR``-ed terms are unioned (if they can all use an index).
+        * ``isin`` does one equality lookup per value.
+
+        :return: Set of candidate row numbers, or ``None`` if
+            the indexes can't narrow down the search.
+        """
+        indexes = self._indexes[table_name]
+        if isinstance(where, expr.Or):
+            rows = set()
+            for t in where.terms:
+                r = self._indexRows(table_name, t)
+                if r is None: return None
+                rows |= r
+            return rows
+        if isinstance(where, expr.In):
+            if where.column not in indexes: return None
+            rows = set()
+            for v in where.values:
+                r = self._indexLookup(indexes[where.column], v, v)
+                if r is None: return None
+                rows |= r
+            return rows
+        candidates = []
+        for t in where.conjuncts():
+            if isinstance(t, (expr.Or, expr.In)):
+                r = self._indexRows(table_name, t)
+                if r is not None: candidates.append(r)
+        # Combine AND-ed range comparisons per column
+        bounds = expr.column_bounds(where.conjuncts(), indexes)
+        # Prefer a single-row primary key lookup
+        ordered = sorted(bounds.items(),
+            key=lambda b: not isinstance(indexes[b[0]], HashIndex))
+        for column, (lo, hi, lo_inc, hi_inc) in ordered:
+            r = self._indexLookup(indexes[column], lo, hi, lo_inc, hi_inc)
+            if r is not None:
+                candidates.append(r)
+                if len(r) <= 1: break
+        if not candidates:
+            return None
+        return set.intersection(*candidates)
+
+    def _iterReadAllDict(self, table_name: str, where = None,
+        columns: Optional[List[str]] = None):
+        """Generator function for iterating over all
+        rows of a table, as dicts.
+
+        Rows are filtered before they're decoded, when
+        possible (see ``_rawFilter``), and only the needed
+        columns are decoded (see ``_codec``).
+
+        :param table_name: Name of table in database
+        :param where: Optional filter (see ``query``)
+        :param columns: Columns to decode. If ``None``, all
+            columns are decoded.
+        :yields: Row of data from ``table_name``
+        """
+        rstruct = self._codec(table_name, columns, where)
+        cols, decode = rstruct.columns, rstruct._decodeRow
+        match = self._rawFilter(table_name, where, rstruct)
+        for page in self._iterPages(table_name, where):
+            for raw in rstruct.row_struct.iter_unpack(page):
+                if match is None or match(raw):
+                    yield dict(zip(cols, decode(raw)))
+
+    def _getPool(self, workers: int) -> concurrent.futures.ProcessPoolExecutor:
+        """Get the process pool for parallel scans, (re)starting
+        it if it has a different number of workers.
+
+        :param workers: Number of worker processes
+        :return: The pool
+        """
+        if self._pool is not None and self._pool_workers != workers:
+            self._shutdownPool()
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(workers)
+            self._pool_workers = workers
+        return self._pool
+
+    def _shutdownPool(self):
+        """Stop the parallel scan worker processes, if any."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _parallelTasks(self, table_name: str, where, columns: List[str],
+        workers: Optional[int], plan: Optional[planner.Plan]) -> Optional[List[dict]]:
+        """Split a full scan of a table into tasks for
+        the functions in ``toydb.parallel``.
+
+        Scans run serially (and this returns ``None``) if
+        ``workers`` is less than 2, if the query's plan uses
+        an index, if the filter is a plain callable (which can't be sent
+        to another process) or if the table is too small to
+        give each worker ``PARALLEL_MIN_ROWS`` rows.
+
+        The caller should hold the table's lock until the
+        tasks are done, so the file doesn't change under them.
+
+        :param table_name: Table in the database
+        :param where: Optional filter (see ``query``)
+        :param columns: Columns the workers should decode
+        :param workers: Max number of worker processes
+        :param plan: The query's plan (see ``_scanPlan``)
+        :return: List of tasks, or ``None`` to scan serially
+        """
+        if workers is None or workers < 2:
+            return None
+        if where is not None and not isinstance(where, expr.Expr):
+            return None
+        n_rows = self._tableRows(table_name)
+        if n_rows < 2 * self.PARALLEL_MIN_ROWS:
+            return None
+        if plan is not None and plan.method == "index_scan":
+            return None
+        rstruct = self._structs[table_name]
+        return [{"filename": self.metadata["tables"][table_name]["filename"],
+            "columns": rstruct.columns, "types": rstruct.types,
+            "tombstone": rstruct.tombstone, "start": start, "stop": stop,
+            "heap": None if rstruct.heap is None else str(rstruct.heap.filename),
+            "compression": self.metadata["tables"][table_name].get("compression"),
+            "read": list(columns), "where": where}
+            for start, stop in parallel.split_ranges(n_rows, workers,
+                self.PARALLEL_MIN_ROWS)]
+
+    def _iterScan(self, table_name: str, where = None,
+        columns: Optional[List[str]] = None, workers: Optional[int] = None,
+        plan: Optional[planner.Plan] = None) -> Iterable[Dict[str,Any]]:
+        """Read the rows of a table matching ``where``, using
+        an index if possible, or else a full scan (in parallel,
+        if ``workers`` allows it -- see ``_parallelTasks``).
+
+        :param table_name: Table in the database
+        :param where: Optional filter (see ``query``)
+        :param columns: Columns to decode
+        :param workers: Max number of worker processes
+        :param plan: The query's plan (see ``_scanPlan``). If
+            ``None``, no index is used.
+        :yields: Matching rows, as dicts, in table order
+        """
+        if columns is None:
+            columns = self.getTableColumns(table_name)
+        tasks = self._parallelTasks(table_name, where, columns, workers, plan)
+        if tasks is not None:
+            for cols, rows in self._getPool(workers).map(parallel.scan_range, tasks):
+                for row in rows:
+                    yield dict(zip(cols, row))
+            return
+        index_rows = None if plan is None else self._indexScan(table_name, where, plan)
+        if index_rows is not None:
+            yield from self._iterReadRows(table_name, index_rows, where, columns)
+        else:
+            yield from self._iterReadAllDict(table_name, where, columns)
 
     def _readAllLines(self, table_name: str) -> List[tuple]:
         """Read all lines in a database and return
@@ -257,62 +1291,1020 @@ class Database:
         return [tuple(row) for row
             in self._iterReadAllLines(table_name)]
 
+    def scanArray(self, table_name: str, columns: Optional[List[str]] = None,
+        where = None) -> Dict[str,Any]:
+        """Read a table as NumPy column arrays.
+
+        The table's pages are read through the buffer pool and
+        viewed as a structured array in a single ``numpy.frombuffer``
+        call, and ``where``
+        is evaluated as a vectorized boolean mask.
+        ``VARSTRING`` columns are read from the heap into
+        ``object`` arrays of ``str``.
+
+        Requires ``numpy`` to be installed.
+
+        :param table_name: Table in the database
+        :param columns: Columns to return. If ``None``,
+            all columns are returned.
+        :param where: Optional ``toydb.expr`` expression to
+            filter rows with. (Plain callables aren't
+            supported, since they can't be vectorized.)
+        :return: Dict mapping from column name to a
+            ``numpy.ma.MaskedArray``, masked where the value
+            is null. Strings are fixed-width ``bytes`` columns.
+        """
+        if np is None:
+            raise ImportError("`Database.scanArray` requires numpy.")
+        table_name = table_name.lower()
+        with self._lock([table_name]):
+            assert table_name in self.metadata["tables"]
+            if columns is None:
+                columns = self.getTableColumns(table_name)
+            if where is not None and not isinstance(where, expr.Expr):
+                raise TypeError("`where` must be a `toydb.expr` expression "
+                    "to be used with NumPy.")
+            rstruct = self._structs.get(table_name)
+            data = np.frombuffer(b"".join(self._iterPages(table_name, where)),
+                dtype=rstruct.numpyDtype(np))
+            if rstruct.tombstone:
+                data = data[data["__live__"]]
+            needed = list(dict.fromkeys(list(columns)
+                + (where.columns() if where is not None else [])))
+            arrays = {c: np.ma.MaskedArray(data[c], mask=~data[f"{c}.__notnull__"])
+                for c in needed}
+            for c in needed:
+                if self.metadata["tables"][table_name]["schema"][c] == dtypes.VARSTRING:
+                    arrays[c] = np.ma.MaskedArray(np.array([rstruct.heap.read(r)
+                        for r in data[c]], dtype=object), mask=arrays[c].mask)
+            if where is not None:
+                keep = where.mask(arrays)
+                arrays = {c: a[keep] for c, a in arrays.items()}
+            return {c: arrays[c] for c in columns}
+
+    def _orderedRows(self, table_name: str, where, columns: List[str],
+        order_by: List[Tuple[str,bool]], limit: Optional[int] = None,
+        workers: Optional[int] = None, plan: Optional[planner.Plan] = None
+        ) -> Iterable[Dict[str,Any]]:
+        """Read the rows matching ``where`` in sorted order.
+
+        * If there's a single sort column with a ``BTree`` index,
+          and the filter can't use an index itself, rows are
+          streamed in index order.
+        * Otherwise, if there's a ``limit``, the top rows are
+          kept in a bounded heap.
+        * Otherwise, the rows are sorted with an external merge
+          sort, spilling to disk if they don't fit in memory.
+
+        :param table_name: Table in the database
+        :param where: Optional filter (see ``query``)
+        :param columns: Columns to decode
+        :param order_by: Normalized sort spec (see ``sort.normalize_order_by``)
+        :param limit: Optional limit on the number of rows needed
+        :param workers: Max number of processes to scan with
+        :param plan: The query's plan (see ``_scanPlan``)
+        :yields: Matching rows, as dicts, in order
+        """
+        columns = list(dict.fromkeys(list(columns) + [c for c, _ in order_by]))
+        if (plan is None or plan.method != "index_scan") and len(order_by) == 1:
+            (column, desc), = order_by
+            btree = self._indexes[table_name].get(column)
+            if isinstance(btree, BTree):
+                return self._iterReadRows(table_name,
+                    (row for _, row in btree.items(reverse=desc)), where, columns)
+        rows = self._iterScan(table_name, where, columns, workers, plan)
+        return self._sortRows(rows, order_by, limit)
+
+    def _sortRows(self, rows: Iterable[Dict[str,Any]], order_by: List[Tuple[str,bool]],
+        limit: Optional[int] = None) -> Iterable[Dict[str,Any]]:
+        """Sort rows, using a bounded heap if there's a
+        limit, or an external merge sort otherwise.
+
+        :param rows: Rows to sort, as dicts
+        :param order_by: Normalized sort spec (see ``sort.normalize_order_by``)
+        :param limit: Optional limit on the number of rows needed
+        :return: Sorted rows
+        """
+        key = sort.make_key(order_by)
+        if limit is not None and limit > 0:
+            return sort.top_k(rows, key, limit)
+        return sort.external_sort(rows, key, self.sort_buffer_rows,
+            self.filename / "tmp")
+
+    def _iterAggregate(self, table_name: str, where, group_by: List[str],
+        aggregates: Dict[str,Aggregate], workers: Optional[int] = None,
+        plan: Optional[planner.Plan] = None) -> Iterable[Dict[str,Any]]:
+        """Run a streaming hash aggregation over the rows
+        matching ``where``.
+
+        With ``workers``, each worker aggregates a range of
+        the table and the partial states are merged here.
+
+        :param table_name: Table in the database
+        :param where: Optional filter (see ``query``)
+        :param group_by: Columns to group by
+        :param aggregates: Mapping from output name to aggregate
+        :param workers: Max number of processes to scan with
+        :param plan: The query's plan (see ``_scanPlan``)
+        :yields: One dict per group, with the ``group_by``
+            columns and the aggregate results.
+        """
+        aggregator = HashAggregator(group_by, aggregates,
+            self.aggregate_buffer_groups, self.filename / "tmp")
+        columns = aggregator.columns()
+        tasks = self._parallelTasks(table_name, where, columns, workers, plan)
+        if tasks is not None:
+            for task in tasks:
+                task.update(group_by=group_by, aggregates=aggregates,
+                    max_groups=self.aggregate_buffer_groups,
+                    tmp_dir=str(self.filename / "tmp"))
+            for partials in self._getPool(workers).map(parallel.aggregate_range, tasks):
+                for groups in partials:
+                    aggregator.mergeStates(groups)
+        else:
+            aggregator.updateMany(self._iterScan(table_name, where, columns, plan=plan))
+        yield from aggregator.results()
+
+    def _iterQuery(self, table_name: str, select: Dict[str,Callable], where = None,
+        limit: Optional[int] = None, order_by = None, group_by: List[str] = None,
+        aggregates: Dict[str,Aggregate] = None, workers: Optional[int] = None
+        ) -> Iterable[tuple]:
+        """Generator function that runs a query (see
+        ``Database.query``) and lazily yields the results.
+
+        :param table_name: Table in the database
+        :param select: Mapping from selected column name to
+            the getter to apply to its value. Ignored for
+            aggregate queries.
+        :yields: Result rows, as tuples
+        """
+        plan = self._scanPlan(table_name, where)
+        if group_by or aggregates:
+            group_by, aggregates = list(group_by or []), dict(aggregates or {})
+            itr = self._iterAggregate(table_name, where, group_by, aggregates, workers, plan)
+            iden = lambda val: val
+            select = {c: iden for c in group_by + list(aggregates)}
+            if order_by:
+                itr = self._sortRows(itr, sort.normalize_order_by(order_by), limit)
+        elif order_by:
+            itr = self._orderedRows(table_name, where, list(select),
+                sort.normalize_order_by(order_by), limit, workers, plan)
+        else:
+            # Only decode the selected columns
+            itr = self._iterScan(table_name, where, list(select), workers, plan)
+        # SELECT iterator
+        result = (
+            tuple(get(row[col]) for col, get in select.items())
+            for row in itr)
+        # Limit the result
+        if limit is not None and limit > 0:
+            result = util.iter_limit(result,limit)
+        yield from result
+
+    def _selectGetters(self, table_name: str,
+        select: Union[str,List[str],Dict[str,Callable]]) -> Dict[str,Callable]:
+        """Normalize a query's ``select`` into a mapping
+        from column name to getter.
+
+        :param table_name: Table in the database
+        :param select: ``"*"``, a column name, a list of column
+            names or a mapping from column name to getter
+        :return: Mapping from lowercase column name to getter
+        """
+        iden = lambda val: val
+        if select == "*":
+            select = self.getTableColumns(table_name)
+        if isinstance(select,str):
+            select = {select:iden}
+        if isinstance(select,(list,tuple)):
+            select = {k: iden for k in select}
+        return {k.lower():v for k, v in select.items()}
+
     def query(self, from_: str, select: List[Union[str,Dict[str,Callable]]] = "*", where = None,
-        limit: int = None):
+        limit: int = None, as_numpy: bool = False, order_by = None,
+        group_by: List[str] = None, aggregates: Dict[str,Aggregate] = None,
+        workers: Optional[int] = None):
         """Query a database using SQL(-ish) syntax.
 
+        The results are returned as a list. Use ``cursor``
+        to read them lazily instead. If the database has a
+        result cache (see ``result_cache_size``), repeating a
+        query on a table that hasn't changed since returns
+        the cached result.
+
         :param select: Columns to select
         :param from_: DB table to select from
         :param where: Conditionally filter results with a callable function
+            or a ``toydb.expr`` expression. Expressions can use the table's
+            indexes and are evaluated before rows are decoded.
         :param limit: Limit the number of results
+        :param as_numpy: Return a dict of NumPy column arrays (see
+            ``Database.scanArray``) instead of a list of tuples.
+            ``select`` must be a list of column names.
+        :param order_by: Sort the results, similar to SQL's ``ORDER BY``.
+            A column name, a ``(column, "asc"|"desc")`` tuple, or a
+            list of either. Nulls sort last in ascending order and
+            first in descending order.
+        :param group_by: Columns to group by, similar to SQL's ``GROUP BY``.
+        :param aggregates: Mapping from output name to a ``toydb.aggregates``
+            function (eg ``{"n": count(), "total": sum("x")}``). When
+            aggregating, ``select`` is ignored and each result row has the
+            ``group_by`` columns followed by the aggregates, and ``order_by``
+            refers to those output names.
+        :param workers: Scan the table with up to this many worker
+            processes (see ``toydb.parallel``). Only used for full
+            scans of large tables, with an expression (or no)
+            ``where`` filter; otherwise the scan runs in this process.
         """
         table_name = from_.lower()
-        assert table_name in self.listTables()
+        with self._lock([table_name]):
+            assert table_name in self.listTables()
+            if select == "*":
+                select = self.getTableColumns(table_name)
+            if as_numpy:
+                if order_by or group_by or aggregates:
+                    raise ValueError("`order_by` and aggregation aren't supported with `as_numpy`.")
+                if isinstance(select, str):
+                    select = [select]
+                arrays = self.scanArray(table_name, list(select), where)
+                if limit is not None and limit > 0:
+                    arrays = {c: a[:limit] for c, a in arrays.items()}
+                return arrays
+            key = self._resultCacheKey(table_name, select, where, limit,
+                order_by, group_by, aggregates)
+            if key is not None:
+                rows = self.result_cache.get(table_name, key)
+                if rows is not None:
+                    return rows
+            select = self._selectGetters(table_name, select)
+            rows = list(self._iterQuery(table_name, select, where, limit, order_by,
+                group_by, aggregates, workers))
+            if key is not None:
+                self.result_cache.put(table_name, key, rows)
+            return rows
+
+    def _resultCacheKey(self, table_name: str, select, where = None, limit: int = None,
+        order_by = None, group_by: List[str] = None,
+        aggregates: Dict[str,Aggregate] = None) -> Optional[tuple]:
+        """Normalize a query (see ``query``) into a key for
+        the result cache, including the table's version. Called
+        holding the table's lock.
+
+        Queries with plain callables (as ``where`` or getters in
+        ``select``) aren't cached, since they might not always
+        return the same thing.
+
+        :return: The key, or ``None`` if the query can't be cached
+        """
+        if not self.result_cache.capacity:
+            return None
+        def builtin(e) -> bool:
+            if type(e).__module__ != expr.__name__:
+                return False
+            terms = getattr(e, "terms", [getattr(e, "term", None)])
+            return all(t is None or builtin(t) for t in terms)
+        if where is not None and not (isinstance(where, expr.Expr) and builtin(where)):
+            return None
+        if group_by or aggregates:
+            if not all(type(a).__module__ == Aggregate.__module__
+                for a in (aggregates or {}).values()):
+                return None
+            select = []
         if select == "*":
             select = self.getTableColumns(table_name)
-        itr = self._iterReadAllDict(table_name)
+        if isinstance(select, str):
+            select = [select]
+        if not isinstance(select, (list, tuple)):
+            return None
+        return (self._md_stamp, self._versions.get(table_name),
+            tuple(c.lower() for c in select), repr(where),
+            limit if limit is not None and limit > 0 else None,
+            tuple(sort.normalize_order_by(order_by)) if order_by else (),
+            tuple(group_by or ()),
+            tuple((k, repr(a)) for k, a in (aggregates or {}).items()))
+
+    def explain(self, from_: str, where = None, limit: int = None, order_by = None,
+        group_by: List[str] = None, aggregates: Dict[str,Aggregate] = None
+        ) -> planner.Plan:
+        """Show how a query (see ``Database.query`` for the
+        arguments) would be run, without running it.
+
+        ``print``-ing the result shows the chosen plan with
+        its estimated cost and number of rows, the steps run
+        on its results (sorting, aggregating and limiting),
+        and the plans that were rejected. Estimates are much
+        better once the table has been analyzed (see ``analyze``).
+
+        :return: The plan for reading the table
+        """
+        table_name = from_.lower()
+        with self._lock([table_name]):
+            assert table_name in self.listTables()
+            plan = self._plan(table_name, where)
+            steps = []
+            if limit is not None and limit > 0:
+                steps.append(f"limit {limit}")
+            order = sort.normalize_order_by(order_by) if order_by else []
+            by = lambda cols: ", ".join(f"{c} desc" if d else c for c, d in cols)
+            if order:
+                if not (group_by or aggregates) and plan.method != "index_scan" \
+                    and len(order) == 1 and isinstance(
+                    self._indexes[table_name].get(order[0][0]), BTree):
+                    # Rows are read in index order instead (see `_orderedRows`)
+                    n_rows = self._tableRows(table_name)
+                    plan = planner.Plan("index_order", table_name, planner.index_cost(
+                        n_rows, n_rows, plan.n_pages or 0), plan.rows,
+                        index=[order[0][0]], where=where)
+                    plan.analyzed = "stats" in self.metadata["tables"][table_name]
+                elif steps:
+                    steps[-1] = f"top {limit} by {by(order)}"
+                else:
+                    steps.append(f"sort by {by(order)}")
+            if group_by or aggregates:
+                aggs = ", ".join(f"{k}={a!r}" for k, a in (aggregates or {}).items())
+                steps.append(f"hash aggregate by {', '.join(group_by or []) or '()'}"
+                    + (f": {aggs}" if aggs else ""))
+            plan.steps = steps
+            return plan
+
+    def analyze(self, table_name: str) -> dict:
+        """Collect statistics about a table's columns, for
+        the query planner (see ``explain``): the number of
+        rows, and each column's fraction of nulls, estimated
+        number of distinct values and histogram (see
+        ``toydb.planner.analyze_rows``).
+
+        The statistics are stored with the table's metadata.
+        They aren't kept up to date as the table changes, so
+        re-run ``analyze`` after big changes.
+
+        :param table_name: Table in the database
+        :return: The statistics
+        """
+        table_name = table_name.lower()
+        with self._lockCatalog():
+            assert table_name in self.metadata["tables"]
+            stats = planner.analyze_rows(self._iterReadAllDict(table_name),
+                self.getTableColumns(table_name))
+            self.metadata["tables"][table_name]["stats"] = stats
+            self._writeMetadata()
+            return stats
+
+    def cursor(self, from_: str, select: List[Union[str,Dict[str,Callable]]] = "*",
+        where = None, limit: int = None, order_by = None,
+        group_by: List[str] = None, aggregates: Dict[str,Aggregate] = None,
+        workers: Optional[int] = None, offset: int = 0) -> Cursor:
+        """Run a query (see ``Database.query`` for the arguments),
+        returning a ``Cursor`` that reads the results lazily
+        instead of a list.
+
+        :param offset: Skip this many result rows, eg to resume
+            from a cursor's ``rownumber``. Like SQL's ``OFFSET``,
+            ``limit`` counts the rows after the offset.
+        :return: Cursor over the results. Once it's started reading,
+            writes to the table from the same thread raise
+            ``exceptions.CursorOpenError`` until it's closed or
+            exhausted (other threads and processes wait).
+        """
+        assert offset >= 0
+        table_name = from_.lower()
+        with self._lock([table_name]):
+            assert table_name in self.listTables()
+            select = self._selectGetters(table_name, select)
+        if group_by or aggregates:
+            columns = list(group_by or []) + list(aggregates or {})
+        else:
+            columns = list(select)
         if limit is not None and limit > 0:
-            itr = util.iter_limit(itr,limit)
-        # Create SELECT getters
-        iden = lambda val: val
-        if isinstance(select,str):
-            select = {select:iden}
-        if isinstance(select,(list,tuple)):
-            select = {k: iden for k in select}
-        select = {k.lower():v for k, v in select.items()}
-        # SELECT and WHERE iterator
-        result = (
-            tuple(get(row[col]) for col, get in select.items())
-            for row in itr if where is None or where(row))
-        # Limit the result
+            limit += offset
+        rows = self._iterQuery(table_name, select, where, limit, order_by,
+            group_by, aggregates, workers)
+        if offset:
+            rows = it.islice(rows, offset, None)
+        return Cursor(self._iterLocked(rows, [table_name]), columns, offset)
+
+    def _joinSelect(self, left: str, right: str,
+        select: Union[str,List[str]]) -> List[Tuple[int,str]]:
+        """Resolve the columns selected by a join.
+
+        :param left: Left table
+        :param right: Right table
+        :param select: ``"*"``, or a list of column names. Names
+            can be qualified with their table (eg ``"users.id"``),
+            and must be if they're in both tables.
+        :return: List of ``(side, column)`` pairs, where ``side``
+            is ``0`` for the left table and ``1`` for the right.
+        """
+        left_cols, right_cols = self.getTableColumns(left), self.getTableColumns(right)
+        if select == "*":
+            return [(0, c) for c in left_cols] + [(1, c) for c in right_cols]
+        if isinstance(select, str):
+            select = [select]
+        result = []
+        for name in select:
+            name = name.lower()
+            table, _, column = name.rpartition(".")
+            if table:
+                assert table in (left, right), f"Table \"{table}\" isn't in the join."
+                side = 0 if table == left else 1
+                assert column in (left_cols, right_cols)[side], \
+                    f"Column \"{name}\" doesn't exist."
+            else:
+                sides = [s for s, cols in enumerate((left_cols, right_cols)) if column in cols]
+                assert sides, f"Column \"{column}\" doesn't exist."
+                if len(sides) > 1:
+                    raise ValueError(f"Column \"{column}\" is ambiguous. "
+                        f"Use \"{left}.{column}\" or \"{right}.{column}\".")
+                side = sides[0]
+            result.append((side, column))
+        return result
+
+    def _joinInput(self, table_name: str, key: str, columns: List[str],
+        keep_nulls: bool = False, ordered: bool = False) -> Iterable[Dict[str,Any]]:
+        """Read one side of a join.
+
+        :param table_name: Table in the database
+        :param key: Join key column
+        :param columns: Columns to decode
+        :param keep_nulls: Include rows where ``key`` is null
+        :param ordered: Yield rows sorted by ``key`` (nulls last),
+            either in ``BTree`` index order or with an external sort.
+        :yields: Rows, as dicts
+        """
+        where = None if keep_nulls else expr.col(key).notnull()
+        if not ordered:
+            return self._iterReadAllDict(table_name, where, columns)
+        index = self._indexes[table_name].get(key)
+        if isinstance(index, BTree):
+            return self._iterReadRows(table_name, (row for val, row in index.items()
+                if keep_nulls or val is not None), None, columns)
+        return self._sortRows(self._iterReadAllDict(table_name, where, columns),
+            [(key, False)])
+
+    def _hashJoin(self, left: str, right: str, left_key: str, right_key: str,
+        left_cols: List[str], right_cols: List[str], outer: bool
+        ) -> Iterable[Tuple[Dict[str,Any],Optional[Dict[str,Any]]]]:
+        """Join two tables by building a hash table of one
+        side's rows, then streaming the other side through it.
+
+        The smaller table (by row count) is held in memory,
+        except for left joins, which always build on the right.
+
+        :yields: ``(left_row, right_row)`` pairs. For left joins,
+            ``right_row`` is ``None`` if there's no match.
+        """
+        if not outer and self._rowCount(left) < self._rowCount(right):
+            table = {}
+            for lrow in self._joinInput(left, left_key, left_cols):
+                table.setdefault(lrow[left_key], []).append(lrow)
+            for rrow in self._joinInput(right, right_key, right_cols):
+                for lrow in table.get(rrow[right_key], ()):
+                    yield lrow, rrow
+            return
+        table = {}
+        for rrow in self._joinInput(right, right_key, right_cols):
+            table.setdefault(rrow[right_key], []).append(rrow)
+        for lrow in self._joinInput(left, left_key, left_cols, keep_nulls=outer):
+            matches = table.get(lrow[left_key])
+            if matches:
+                for rrow in matches:
+                    yield lrow, rrow
+            elif outer:
+                yield lrow, None
+
+    def _mergeJoin(self, left: str, right: str, left_key: str, right_key: str,
+        left_cols: List[str], right_cols: List[str], outer: bool
+        ) -> Iterable[Tuple[Dict[str,Any],Optional[Dict[str,Any]]]]:
+        """Join two tables by walking both in key order.
+
+        Each side is read in ``BTree`` index order if it has
+        one, or sorted with an external merge sort otherwise.
+        Only the right rows for the current key are held in
+        memory.
+
+        :yields: ``(left_row, right_row)`` pairs. For left joins,
+            ``right_row`` is ``None`` if there's no match.
+        """
+        lrows = self._joinInput(left, left_key, left_cols, keep_nulls=outer, ordered=True)
+        rrows = iter(self._joinInput(right, right_key, right_cols, ordered=True))
+        rrow = next(rrows, None)
+        group_key, group = None, []
+        for lrow in lrows:
+            key = lrow[left_key]
+            if key is not None and (not group or group_key != key):
+                # Skip past smaller keys, then collect the
+                # right rows matching this key
+                while rrow is not None and rrow[right_key] < key:
+                    rrow = next(rrows, None)
+                group_key, group = key, []
+                while rrow is not None and rrow[right_key] == key:
+                    group.append(rrow)
+                    rrow = next(rrows, None)
+            if key is not None and group:
+                for match in group:
+                    yield lrow, match
+            elif outer:
+                yield lrow, None
+
+    def join(self, left: str, right: str, on: Union[str,Tuple[str,str]],
+        how: str = "inner", select: Union[str,List[str]] = "*",
+        limit: Optional[int] = None) -> Iterable[tuple]:
+        """Join two tables on equal key values, similar
+        to SQL's ``JOIN ... ON``.
+
+        If either table has a ``BTree`` index on its key, the
+        tables are joined with a sort-merge join. Otherwise a
+        hash join is used, holding the smaller table in memory.
+
+        Null keys never match.
+
+        :param left: Left table
+        :param right: Right table
+        :param on: Column to join on, or a ``(left_column, right_column)``
+            tuple if the names are different.
+        :param how: ``"inner"``, or ``"left"`` to also return left rows
+            without a match (with nulls for the right table's columns).
+        :param select: Columns to select (see ``_joinSelect``). By default,
+            all of the left table's columns, then all of the right's.
+        :param limit: Limit the number of results
+        :return: Iterator of result rows, as tuples. Results are
+            streamed rather than read into memory.
+        """
+        left, right = left.lower(), right.lower()
+        self._refreshMetadata()
+        assert left in self.metadata["tables"], f"Table \"{left}\" doesn't exist."
+        assert right in self.metadata["tables"], f"Table \"{right}\" doesn't exist."
+        assert left != right, "Self-joins aren't supported."
+        assert how in ("inner", "left"), f"Invalid join type \"{how}\"."
+        left_key, right_key = (on, on) if isinstance(on, str) else on
+        left_key, right_key = left_key.lower(), right_key.lower()
+        assert left_key in self.getTableColumns(left), f"Column \"{left_key}\" doesn't exist."
+        assert right_key in self.getTableColumns(right), f"Column \"{right_key}\" doesn't exist."
+        select = self._joinSelect(left, right, select)
+        left_cols = list(dict.fromkeys([c for s, c in select if s == 0] + [left_key]))
+        right_cols = list(dict.fromkeys([c for s, c in select if s == 1] + [right_key]))
+        if (isinstance(self._indexes[left].get(left_key), BTree)
+            or isinstance(self._indexes[right].get(right_key), BTree)):
+            join = self._mergeJoin
+        else:
+            join = self._hashJoin
+        pairs = join(left, right, left_key, right_key, left_cols, right_cols, how == "left")
+        result = (tuple(lrow[c] if s == 0 else (None if rrow is None else rrow[c])
+            for s, c in select) for lrow, rrow in pairs)
         if limit is not None and limit > 0:
-            return list(util.iter_limit(result,limit))
-        return list(result)
+            result = util.iter_limit(result, limit)
+        return self._iterLocked(result, [left, right])
+
+    def _checkPrimaryKeys(self, table_name: str, rows: List[List[Any]]):
+        """Make sure a batch of rows' primary keys
+        are valid before inserting them.
+
+        :param table_name: Table in the database
+        :param rows: Rows of data, as lists
+        :raises exceptions.SchemaError: If a key is null
+        :raises exceptions.UniqueConstraintError: If a key
+            is already in the table or repeats in ``rows``.
+        """
+        pkey = self.metadata["tables"][table_name].get("primary_key")
+        if pkey is None:
+            return
+        col_num = self.getTableColumns(table_name).index(pkey)
+        keys = [row[col_num] for row in rows]
+        if None in keys:
+            raise exceptions.SchemaError(
+                f"Primary key \"{pkey}\" can't be null.")
+        index = self._indexes[table_name][pkey]
+        seen = set()
+        for key, exists in zip(keys, index.containsMany(keys)):
+            if exists or key in seen:
+                raise exceptions.UniqueConstraintError(
+                    f"Duplicate value for primary key \"{pkey}\": {key!r}")
+            seen.add(key)
+
+    def get(self, table_name: str, key: Any) -> Optional[tuple]:
+        """Look up a row by its primary key.
+
+        :param table_name: Table in the database, with
+            a primary key.
+        :param key: Primary key value to look up
+        :return: Matching row, or ``None`` if there isn't one
+        :raises TypeError: If ``key`` isn't of the primary
+            key's type
+        """
+        table_name = table_name.lower()
+        with self._lock([table_name]):
+            assert table_name in self.metadata["tables"]
+            pkey = self.metadata["tables"][table_name].get("primary_key")
+            assert pkey is not None, f"Table \"{table_name}\" doesn't have a primary key."
+            row_number = self._indexes[table_name][pkey].get(key)
+            if row_number is None:
+                return None
+            return tuple(self._readLine(table_name, row_number))
+
+    def _freeSlotsPath(self, table_name: str) -> Path:
+        """Get the location of a table's free-slot list.
+
+        The list is a stack of big-endian ``int64`` row
+        numbers of deleted rows, waiting to be reused.
+        """
+        return Path(self.metadata["tables"][table_name]["filename"] + ".free")
+
+    def _heapPath(self, table_name: str) -> Path:
+        """Get the location of a table's ``StringHeap``,
+        which holds its ``VARSTRING`` values.
+        """
+        return Path(self.metadata["tables"][table_name]["filename"] + ".heap")
+
+    def _readFreeSlots(self, table_name: str) -> List[int]:
+        """Read a table's free-slot list.
+
+        :param table_name: Table in the database
+        :return: Row numbers of the deleted rows
+        """
+        path = self._freeSlotsPath(table_name)
+        if not path.exists():
+            return []
+        data = path.read_bytes()
+        return list(struct.unpack(f">{len(data) // 8}q", data))
+
+    def _writeFreeSlots(self, table_name: str, slots: List[int]):
+        """Replace a table's free-slot list.
+
+        :param table_name: Table in the database
+        :param slots: Row numbers of the deleted rows
+        """
+        self._freeSlotsPath(table_name).write_bytes(struct.pack(f">{len(slots)}q", *slots))
+
+    def _rebuildFreeSlots(self, table_name: str):
+        """Rebuild a table's free-slot list by scanning
+        for deleted rows.
+
+        :param table_name: Table in the database
+        """
+        rstruct = self._structs.get(table_name)
+        if not rstruct.tombstone:
+            return
+        rows_per_page = self.buffer_pool.rowsPerPage(rstruct.row_struct.size)
+        slots = [n for page_no, page in enumerate(self._iterPages(table_name))
+            for n, raw in enumerate(rstruct.row_struct.iter_unpack(page),
+                page_no * rows_per_page) if not raw[-1]]
+        self._writeFreeSlots(table_name, slots[::-1])
+
+    def _pushFreeSlots(self, table_name: str, slots: List[int]):
+        """Add deleted rows to a table's free-slot list.
+
+        :param table_name: Table in the database
+        :param slots: Row numbers of the deleted rows
+        """
+        with self._freeSlotsPath(table_name).open("ab") as f:
+            f.write(struct.pack(f">{len(slots)}q", *slots))
+
+    def _peekFreeSlots(self, table_name: str, n: int) -> List[int]:
+        """Get up to ``n`` slots from the top of a table's
+        free-slot list, so new rows can be written there. They
+        stay on the list until ``_popFreeSlots`` is called,
+        once the rows written there have been committed.
+
+        :param table_name: Table in the database
+        :param n: Max number of slots needed
+        :return: Row numbers of the free slots
+        """
+        path = self._freeSlotsPath(table_name)
+        if n <= 0 or not path.exists():
+            return []
+        with path.open("rb") as f:
+            size = f.seek(0, 2)
+            f.seek(max(0, size - 8 * n))
+            data = f.read()
+        return list(struct.unpack(f">{len(data) // 8}q", data))[::-1]
+
+    def _popFreeSlots(self, table_name: str, n: int):
+        """Take ``n`` slots off of a table's free-slot list
+        (see ``_peekFreeSlots``).
+
+        :param table_name: Table in the database
+        :param n: Number of slots that were used
+        """
+        path = self._freeSlotsPath(table_name)
+        if n <= 0 or not path.exists():
+            return
+        with path.open("r+b") as f:
+            f.truncate(max(0, f.seek(0, 2) - 8 * n))
+
+    def _writeAt(self, table_name: str, writes: Iterable[Tuple[int,bytes]],
+        truncate: Optional[int] = None):
+        """Write data into a table file at specific
+        offsets, as a single transaction, and invalidate
+        the cached pages.
+
+        All writes to existing tables go through here. The
+        changes are committed to the write-ahead log before
+        they're applied to the table file, and the table's zone
+        map and Bloom filters are updated before the log's lock
+        is released (callers update the indexes and free-slot
+        list within a ``_transaction``).
+
+        :param table_name: Table in the database
+        :param writes: ``(offset, data)`` pairs. Offsets
+            can point past the end of the file, to append.
+        :param truncate: Optionally, truncate the table file
+            to this size after the writes.
+        """
+        rstruct = self._structs[table_name]
+        row_size = rstruct.row_struct.size
+        records = [(WriteAheadLog.WRITE, table_name, offset, bytes(data))
+            for offset, data in writes if len(data)]
+        if rstruct.heap is not None:
+            # Strings the rows point to go in the same transaction
+            records = [(WriteAheadLog.HEAP_WRITE, table_name, offset, data)
+                for offset, data in rstruct.heap.pending()] + records
+        if truncate is not None:
+            records.append((WriteAheadLog.TRUNCATE, table_name, truncate, b""))
+        if not records:
+            return
+        with self._transaction():
+            self._wal.commit(records)
+            self._dirty.add(table_name)
+            self._applyRecords(table_name, records)
+            self._updateZoneMap(table_name, records)
+            self._updateBloomFilters(table_name, records)
+            self._versions[table_name] = self._locks.bump(self._tableLockName(table_name))
+            for rtype, _, offset, data in records:
+                if rtype == WriteAheadLog.WRITE:
+                    self._invalidateMap(table_name, offset // row_size,
+                        (offset + len(data) - 1) // row_size)
+                elif rtype == WriteAheadLog.TRUNCATE:
+                    self._invalidateMap(table_name, offset // row_size)
+
+    def _zonePath(self, table_name: str) -> Path:
+        """Get the location of a table's ``ZoneMap``."""
+        return Path(self.metadata["tables"][table_name]["filename"] + ".zones")
+
+    def _zoneMap(self, table_name: str) -> ZoneMap:
+        """Get a table's zone map, building it first if the
+        table is from before zone maps were kept.
+
+        :param table_name: Table in the database
+        :return: The table's ``ZoneMap``
+        """
+        zone_map = self._zones[table_name]
+        if not zone_map.exists():
+            self._rebuildZoneMap(table_name)
+        return zone_map
+
+    def _rebuildZoneMap(self, table_name: str):
+        """Rebuild a table's zone map from its rows.
+
+        :param table_name: Table in the database
+        """
+        row_struct = self._structs[table_name].row_struct
+        self._zones[table_name].build(raw for page in self._iterPages(table_name)
+            for raw in row_struct.iter_unpack(page))
+
+    def _updateZoneMap(self, table_name: str, records: List[Tuple[int,str,int,bytes]]):
+        """Widen a table's zone map to cover the rows written
+        by a transaction.
+
+        Only writes of whole rows can change the stats. (The
+        other writes set live flags.)
+
+        :param table_name: Table in the database
+        :param records: The transaction's ``WriteAheadLog`` records
+        """
+        zone_map = self._zoneMap(table_name)
+        row_struct = self._structs[table_name].row_struct
+        row_size = row_struct.size
+        for rtype, _, offset, data in records:
+            if rtype == WriteAheadLog.WRITE:
+                if offset % row_size == 0 and len(data) % row_size == 0:
+                    zone_map.add(offset // row_size, row_struct.iter_unpack(data))
+            elif rtype == WriteAheadLog.TRUNCATE:
+                zone_map.truncate(offset // row_size)
+        zone_map.flush()
+
+    def _bloomPath(self, table_name: str, column: str) -> Path:
+        """Get the location of a column's ``BloomFilter``."""
+        filename = self.metadata["tables"][table_name]["filename"]
+        return Path(f"{filename}.{util.md5(column)}.bloom")
+
+    def _bloomFilters(self, table_name: str) -> Dict[str,BloomFilter]:
+        """Get a table's Bloom filters, building any whose
+        file is missing first.
+
+        :param table_name: Table in the database
+        :return: Mapping from column names to their ``BloomFilter``
+        """
+        blooms = self._blooms[table_name]
+        for column, bloom in blooms.items():
+            if not bloom.exists():
+                self._buildBloomFilter(table_name, column, bloom)
+        return blooms
+
+    def _buildBloomFilter(self, table_name: str, column: str, bloom: BloomFilter):
+        """Build a column's Bloom filters from the table's live rows.
+
+        :param table_name: Table in the database
+        :param column: Column the filters are on
+        :param bloom: The column's ``BloomFilter``
+        """
+        rstruct = self._structs[table_name]
+        flag = rstruct.columns.index(column) * 2
+        get = rstruct.rawGetter(column)
+        live = (lambda raw: raw[-1]) if rstruct.tombstone else (lambda raw: True)
+        bloom.build(get(raw) if raw[flag] and live(raw) else None
+            for page in self._iterPages(table_name)
+            for raw in rstruct.row_struct.iter_unpack(page))
+
+    def _rebuildBloomFilters(self, table_name: str):
+        """Rebuild all of a table's Bloom filters, dropping
+        the values of overwritten and deleted rows.
+
+        :param table_name: Table in the database
+        """
+        for column, bloom in self._blooms[table_name].items():
+            self._buildBloomFilter(table_name, column, bloom)
+
+    def _updateBloomFilters(self, table_name: str, records: List[Tuple[int,str,int,bytes]]):
+        """Add the values of the rows written by a transaction
+        to a table's Bloom filters (see ``_updateZoneMap``).
+
+        :param table_name: Table in the database
+        :param records: The transaction's ``WriteAheadLog`` records
+        """
+        blooms = self._bloomFilters(table_name)
+        if not blooms:
+            return
+        rstruct = self._structs[table_name]
+        row_size = rstruct.row_struct.size
+        for column, bloom in blooms.items():
+            flag = rstruct.columns.index(column) * 2
+            get = rstruct.rawGetter(column)
+            for rtype, _, offset, data in records:
+                if rtype == WriteAheadLog.WRITE:
+                    if offset % row_size == 0 and len(data) % row_size == 0:
+                        bloom.add(offset // row_size, (get(raw) if raw[flag] else None
+                            for raw in rstruct.row_struct.iter_unpack(data)))
+                elif rtype == WriteAheadLog.TRUNCATE:
+                    bloom.truncate(offset // row_size)
+            bloom.flush()
 
     def insert(self, table_name: str, row: Union[Sequence[Any], Dict[str, Any]]):
         """Add a new row of data into a table.
 
+        The row reuses a deleted row's slot if there
+        is one, and is appended otherwise.
+
         :param table_name: Table in the database
         :param row: Row of data to add to table
+        :raises exceptions.UniqueConstraintError: If the row's
+            primary key is already in the table.
         """
-        table_name = table_name.lower()
-        assert table_name in self.metadata["tables"]
-        tablefile = Path(self.metadata["tables"][table_name]["filename"])
-        rstruct = self._structs.get(table_name)
-        data = rstruct.pack(row)
-        # Append the data
-        with tablefile.open("ab") as f:
-            f.write(data)
+        self.insertMany(table_name, [row])
 
     def insertMany(self, table_name: str,
-        rows: Iterable[Union[Sequence[Any], Dict[str, Any]]]):
+        rows: Iterable[Union[Sequence[Any], Dict[str, Any]]],
+        batch_size: int = 10_000):
         """Insert multiple rows of data into a table.
 
+        Rows are validated and packed into a buffer a batch
+        at a time. Rows first fill the slots of deleted rows
+        (see ``delete``), and the rest of each batch is
+        appended to the table file with a single write.
+
+        If a row in a batch is invalid, none of that batch
+        is written, but earlier batches will already have
+        been added to the table.
+
         :param table_name: Name of table in database
         :param rows: Iterable of rows to add to table
+        :param batch_size: Number of rows to pack and
+            write at a time
+        :raises exceptions.UniqueConstraintError: If a row's
+            primary key is already in the table.
+        """
+        assert batch_size > 0
+        table_name = table_name.lower()
+        with self._lock([table_name], exclusive=True):
+            assert table_name in self.metadata["tables"]
+            rstruct = self._structs.get(table_name)
+            row_size = rstruct.row_struct.size
+            cols = self.getTableColumns(table_name)
+            indexes = [(cols.index(c), index) for c, index
+                in self._indexes[table_name].items()]
+            buf = bytearray(row_size * batch_size)
+            rows = iter(rows)
+            end = self._tableSize(table_name) // row_size
+            while True:
+                batch = [(rstruct._row_dict2list(r) if isinstance(r, dict) else list(r))
+                    for r in it.islice(rows, batch_size)]
+                if not batch: break
+                rstruct.validateRows(batch)
+                self._checkPrimaryKeys(table_name, batch)
+                slots = self._peekFreeSlots(table_name, len(batch)) if rstruct.tombstone else []
+                row_numbers = slots + list(range(end, end + len(batch) - len(slots)))
+                for i, row in enumerate(batch):
+                    rstruct.pack_into(buf, i * row_size, row, validate=False)
+                view = memoryview(buf)
+                writes = [(n * row_size, view[i * row_size:(i + 1) * row_size])
+                    for i, n in enumerate(slots)]
+                writes.append((end * row_size, view[len(slots) * row_size:len(batch) * row_size]))
+                with self._transaction():
+                    self._writeAt(table_name, writes)
+                    self._popFreeSlots(table_name, len(slots))
+                    for col_num, index in indexes:
+                        index.insertMany((row[col_num], n)
+                            for n, row in zip(row_numbers, batch))
+                end += len(batch) - len(slots)
+                # Keep the log from growing with the whole load
+                self._maybeCheckpoint()
+
+    def update(self, table_name: str, set: Dict[str,Any], where = None) -> int:
+        """Change the values of rows in a table, similar
+        to SQL's ``UPDATE ... SET ... WHERE``.
+
+        Rows have a fixed size, so each matching row is
+        overwritten in place. If ``where`` can use an index,
+        only the rows it points to are read.
+
+        :param table_name: Table in the database
+        :param set: Mapping from column name to its new value, or
+            to a callable that gets the current row (as a dict) and
+            returns the new value (eg ``lambda row: row["n"] + 1``).
+        :param where: Optional ``toydb.expr`` expression or callable
+            to choose the rows to update (see ``query``). If ``None``,
+            every row is updated.
+        :return: Number of rows updated
+        :raises exceptions.SchemaError: If a new value doesn't
+            match its column's dtype.
+        :raises exceptions.UniqueConstraintError: If the update
+            would duplicate a primary key.
         """
-        for row in rows:
-            self.insert(table_name,row)
+        table_name = table_name.lower()
+        with self._lock([table_name], exclusive=True):
+            assert table_name in self.metadata["tables"]
+            cols = self.getTableColumns(table_name)
+            set = {k.lower(): v for k, v in set.items()}
+            for column in set:
+                assert column in cols, f"Column \"{column}\" doesn't exist."
+            rstruct = self._structs.get(table_name)
+            match = self._rawFilter(table_name, where, live_only=False)
+            old, new = [], []
+            for n, raw in self._iterRaw(table_name, self._indexScan(table_name, where), where):
+                if match is not None and not match(raw):
+                    continue
+                row = rstruct.decode(raw)
+                current = dict(zip(cols, row))
+                for column, value in set.items():
+                    row[cols.index(column)] = value(current) if callable(value) else value
+                old.append((n, current))
+                new.append(row)
+            if not old:
+                return 0
+            rstruct.validateRows(new)
+            self._checkUpdatedKeys(table_name, old, new)
+            row_size = rstruct.row_struct.size
+            with self._transaction():
+                self._writeAt(table_name, [(n * row_size, rstruct.pack(row))
+                    for (n, _), row in zip(old, new)])
+                for column, index in self._indexes[table_name].items():
+                    if column not in set: continue
+                    col_num = cols.index(column)
+                    changed = [(n, current[column], row[col_num]) for (n, current), row
+                        in zip(old, new) if current[column] != row[col_num]]
+                    index.removeMany((v, n) for n, v, _ in changed)
+                    index.insertMany((v, n) for n, _, v in changed)
+            self._maybeCheckpoint()
+            return len(old)
+
+    def _checkUpdatedKeys(self, table_name: str, old: List[Tuple[int,Dict[str,Any]]],
+        new: List[List[Any]]):
+        """Make sure an update leaves a table's primary
+        keys unique and not null.
+
+        :param table_name: Table in the database
+        :param old: ``(row_number, row)`` pairs of the rows being
+            updated, before the update
+        :param new: The updated rows, as lists
+        :raises exceptions.SchemaError: If a key is null
+        :raises exceptions.UniqueConstraintError: If a key
+            would be duplicated.
+        """
+        pkey = self.metadata["tables"][table_name].get("primary_key")
+        if pkey is None:
+            return
+        col_num = self.getTableColumns(table_name).index(pkey)
+        keys = [row[col_num] for row in new]
+        if None in keys:
+            raise exceptions.SchemaError(
+                f"Primary key \"{pkey}\" can't be null.")
+        index = self._indexes[table_name][pkey]
+        updated = {n for n, _ in old}
+        seen = set()
+        for key, owner in zip(keys, index.getMany(keys)):
+            if key in seen or (owner is not None and owner not in updated):
+                raise exceptions.UniqueConstraintError(
+                    f"Duplicate value for primary key \"{pkey}\": {key!r}")
+            seen.add(key)
 
     def _createTempTable(self, table_name: str) -> Path:
         """Create a temporary table version of
@@ -327,37 +2319,164 @@ class Database:
         tmp_table.touch()
         return tmp_table
 
-    def delete(self, table_name: str, where: Callable[[dict],bool]):
+    def delete(self, table_name: str, where: Union[expr.Expr,Callable[[dict],bool]]):
         """Delete rows from a table in the
-        database where callable ``where``
-        evaluates to true.
+        database where ``where`` evaluates to true.
 
         Similar to the SQL ``DELETE FROM`` command.
 
+        Rows are deleted in place by clearing their live flag,
+        and their slots are reused by later inserts, so the
+        cost is proportional to the number of rows deleted
+        (plus the scan to find them, which can use an index).
+        Use ``vacuum`` to shrink the table file afterwards.
+        Tables created before row-level deletes were supported
+        are rewritten instead.
+
         :param table_name: Table in the database
-        :param where: Callable that gets a row from the
-            table as an argument (as a dict, mapping
-            from column name to value) and should return
-            ``True`` if that row should be deleted and
+        :param where: A ``toydb.expr`` expression, or a callable
+            that gets a row from the table as an argument (as a
+            dict, mapping from column name to value) and should
+            return ``True`` if that row should be deleted and
             ``False`` otherwise.
         """
-        assert table_name in self.metadata["tables"]
-        tbl_path = Path(self.metadata["tables"][table_name]["filename"])
-        tmp_path = self._createTempTable(table_name)
+        table_name = table_name.lower()
+        with self._lock([table_name], exclusive=True):
+            assert table_name in self.metadata["tables"]
+            rstruct = self._structs.get(table_name)
+            if rstruct.tombstone:
+                self._deleteInPlace(table_name, where)
+                return
+            # The file is replaced rather than logged, so make sure
+            # nothing in the log gets replayed onto the new file
+            self.checkpoint()
+            tbl_path = Path(self.metadata["tables"][table_name]["filename"])
+            tmp_path = self._createTempTable(table_name)
+            row_size = rstruct.row_struct.size
+            match = self._rawFilter(table_name, where)
+            # Copy the kept rows' bytes, without decoding them
+            with tmp_path.open("wb") as f:
+                for page in self._iterPages(table_name):
+                    for i, raw in enumerate(rstruct.row_struct.iter_unpack(page)):
+                        if not match(raw):
+                            f.write(page[i * row_size:(i + 1) * row_size])
+                f.flush()
+                os.fsync(f.fileno())
+            # "commit" the change
+            tmp_path.replace(tbl_path)
+            self._invalidateMap(table_name)
+            self._versions[table_name] = self._locks.bump(self._tableLockName(table_name))
+            # Row numbers have shifted, so the indexes need rebuilding
+            self._rebuildIndexes(table_name)
+            self._rebuildZoneMap(table_name)
+            self._rebuildBloomFilters(table_name)
+
+    def _deleteInPlace(self, table_name: str, where: Union[expr.Expr,Callable[[dict],bool]]):
+        """Delete rows by clearing their live flags (see ``delete``).
+
+        :param table_name: Table in the database, with tombstones
+        :param where: Expression or callable to match rows to delete
+        """
         rstruct = self._structs.get(table_name)
-        for row in self._iterReadAllDict(table_name):
-            if not where(row):
-                self.insert(table_name,row)
-        # "commit" the change
-        tmp_path.rename(tbl_path)
+        match = self._rawFilter(table_name, where, live_only=False)
+        dead = [(n, rstruct.decode(raw)) for n, raw
+            in self._iterRaw(table_name, self._indexScan(table_name, where), where)
+            if match(raw)]
+        if not dead:
+            return
+        row_size = rstruct.row_struct.size
+        cols = self.getTableColumns(table_name)
+        with self._transaction():
+            self._writeAt(table_name, [(n * row_size + rstruct.live_offset, b"\x00")
+                for n, _ in dead])
+            for column, index in self._indexes[table_name].items():
+                col_num = cols.index(column)
+                index.removeMany((row[col_num], n) for n, row in dead)
+            self._pushFreeSlots(table_name, [n for n, _ in dead])
+        self._maybeCheckpoint()
+
+    def vacuum(self, table_name: str, max_rows: Optional[int] = None) -> int:
+        """Compact a table by moving rows from the end of
+        the table file into the slots of deleted rows, then
+        truncating the file.
+
+        Compaction is incremental: each call moves at most
+        ``max_rows`` rows, so it can be run a step at a time
+        (eg between other work) until it returns ``0``. Once
+        it's done, the table's Bloom filters are rebuilt (see
+        ``createBloomFilter``).
+
+        :param table_name: Table in the database
+        :param max_rows: Max number of rows to move. If ``None``,
+            the table is fully compacted.
+        :return: Number of deleted rows still taking up space
+        """
+        table_name = table_name.lower()
+        with self._lock([table_name], exclusive=True):
+            assert table_name in self.metadata["tables"]
+            rstruct = self._structs.get(table_name)
+            if not rstruct.tombstone:
+                return 0
+            free = set(self._readFreeSlots(table_name))
+            if not free:
+                return 0
+            row_size = rstruct.row_struct.size
+            n_rows = self._tableRows(table_name)
+            holes = sorted(free, reverse=True)
+            moves = []
+            while free:
+                if n_rows - 1 in free:
+                    # Trailing deleted rows can just be cut off
+                    free.discard(n_rows - 1)
+                    n_rows -= 1
+                    continue
+                if max_rows is not None and len(moves) >= max_rows:
+                    break
+                hole = holes.pop()
+                while hole not in free:
+                    hole = holes.pop()
+                free.discard(hole)
+                n_rows -= 1
+                moves.append((n_rows, hole))
+            moved = [(src, dst, raw) for (src, raw), (_, dst)
+                in zip(self._iterRaw(table_name, [src for src, _ in moves]), moves)]
+            assert len(moved) == len(moves)
+            cols = self.getTableColumns(table_name)
+            with self._transaction():
+                self._writeAt(table_name, [(dst * row_size, rstruct.row_struct.pack(*raw))
+                    for _, dst, raw in moved], truncate=n_rows * row_size)
+                for column, index in self._indexes[table_name].items():
+                    col_num = cols.index(column)
+                    values = [(rstruct.decode(raw)[col_num], src, dst) for src, dst, raw in moved]
+                    index.removeMany((v, src) for v, src, _ in values)
+                    index.insertMany((v, dst) for v, _, dst in values)
+                self._writeFreeSlots(table_name, sorted(free, reverse=True))
+                if not free:
+                    # Compacted, so drop the moved and deleted rows' values
+                    self._rebuildBloomFilters(table_name)
+            self._maybeCheckpoint()
+            return len(free)
 
     def dropTable(self, table_name: str):
         """Delete a table from the database.
 
         :param table_name: Table in database
         """
-        assert table_name in self.metadata["tables"]
-        table = Path(self.metadata["tables"][table_name]["filename"])
-        table.unlink()
-        del self.metadata["tables"][table_name]
-        self._writeMetadata()
+        with self._lockCatalog():
+            assert table_name in self.metadata["tables"]
+            self.checkpoint()
+            table = Path(self.metadata["tables"][table_name]["filename"])
+            self._invalidateMap(table_name)
+            if table_name in self._blocks:
+                self._blocks.pop(table_name).remove()
+            if table.exists():
+                table.unlink()
+            for path in [self._freeSlotsPath(table_name), self._heapPath(table_name),
+                self._zonePath(table_name)] + [bloom.filename for bloom
+                in self._blooms[table_name].values()]:
+                if path.exists():
+                    path.unlink()
+            for index in self._indexes.pop(table_name).values():
+                index.filename.unlink()
+            del self.metadata["tables"][table_name]
+            self._writeMetadata()
@@ -0,0 +1,273 @@
+
+import struct
+import hashlib
+from pathlib import Path
+
+from . import dtypes
+
+from typing import Union, Any, Iterable, Iterator, List, Optional, Tuple
+
+
+class HashIndex:
+
+    MAGIC = b"TDBH"
+    MIN_SLOTS = 1024
+    MAX_LOAD = 0.7
+    EMPTY, USED, DELETED = 0, 1, 2
+    _header = struct.Struct(">4sqqq")
+
+    def __init__(self, filename: Union[str,Path], dtype: dtypes.DType):
+        """An on-disk hash index mapping unique column
+        values to the row number they're stored at.
+
+        The file is a header followed by a fixed number of
+        fixed-width slots, using open addressing with linear
+        probing. Each slot holds a state flag, the key and the
+        row number, so a lookup is a hash and (usually) a single
+        seek and read. When the table gets too full it's rebuilt
+        with twice as many slots.
+
+        Removed keys leave a ``DELETED`` marker in their slot
+        so probing still works, and are dropped on the next
+        rebuild.
+
+        :param filename: Location of the index file. It will
+            be created if it doesn't already exist.
+        :param dtype: Datatype of the indexed column
+        """
+        self.filename = Path(filename)
+        self.dtype = dtype
+        fmt = str(dtype)
+        self._isStr = "s" in fmt or "c" in fmt
+        self._key = struct.Struct(f">{fmt}")
+        self._slot = struct.Struct(f">B{self._key.size}sq")
+        if not self.filename.exists() or self.filename.stat().st_size == 0:
+            self.build([])
+
+    def __repr__(self):
+        return f"<toydb.HashIndex {self.filename.name}>"
+
+    def _encode(self, key: Any) -> bytes:
+        """Encode a key the same way it's stored in a slot.
+
+        :param key: Key to encode
+        :return: Packed key bytes
+        """
+        if self._isStr: key = key.encode()
+        return self._key.pack(key)
+
+    def _lookupKey(self, key: Any) -> Optional[bytes]:
+        """Encode a key being looked up. Unlike ``_encode``,
+        keys that can't have been stored (eg strings that are
+        too long, which ``struct`` would truncate) give ``None``
+        rather than matching the wrong entry.
+
+        :param key: Key to encode
+        :return: Packed key bytes, or ``None`` if ``key``
+            can't be in the index
+        :raises TypeError: If ``key`` isn't of the index's type
+        """
+        if key is None:
+            return None
+        if not (self.dtype.validate(key) or (self._isStr and isinstance(key, str))):
+            raise TypeError(f"Key {key!r} is not of type \"{self.dtype.name}\".")
+        if self._isStr:
+            key = key.encode()
+            if len(key) > self._key.size: return None
+        try:
+            return self._key.pack(key)
+        except struct.error:
+            return None
+
+    def _hash(self, key: bytes, n_slots: int) -> int:
+        """Get the home slot of a key. Uses a stable hash,
+        rather than python's ``hash``, because the slot
+        numbers are persisted.
+
+        :param key: Packed key bytes
+        :param n_slots: Number of slots in the table
+        :return: Slot number
+        """
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        return int.from_bytes(digest, "big") % n_slots
+
+    def _readHeader(self, f) -> Tuple[int,int,int]:
+        f.seek(0)
+        magic, n_slots, n_used, n_deleted = self._header.unpack(f.read(self._header.size))
+        assert magic == self.MAGIC, f"\"{self.filename}\" isn't a HashIndex."
+        return n_slots, n_used, n_deleted
+
+    def _writeHeader(self, f, n_slots: int, n_used: int, n_deleted: int):
+        f.seek(0)
+        f.write(self._header.pack(self.MAGIC, n_slots, n_used, n_deleted))
+
+    def _probe(self, f, key: bytes, n_slots: int) -> Iterator[Tuple[int,int,bytes,bytes]]:
+        """Walk the probe sequence for ``key``.
+
+        :yields: ``(slot, state, key, data)`` for each slot visited,
+            where ``data`` is the raw slot. Stops after the first
+            empty slot.
+        """
+        slot = self._hash(key, n_slots)
+        for _ in range(n_slots):
+            f.seek(self._header.size + slot * self._slot.size)
+            data = f.read(self._slot.size)
+            state = data[0] if data else self.EMPTY
+            yield slot, state, data[1:1 + self._key.size], data
+            if state == self.EMPTY: return
+            slot = (slot + 1) % n_slots
+
+    def _slotRow(self, data: bytes) -> int:
+        return struct.unpack_from(">q", data, 1 + self._key.size)[0]
+
+    def get(self, key: Any) -> Optional[int]:
+        """Look up the row number for a key.
+
+        :param key: Key to look up
+        :return: Row number, or ``None`` if ``key`` isn't
+            in the index.
+        :raises TypeError: If ``key`` isn't of the index's type
+        """
+        return self.getMany([key])[0]
+
+    def getMany(self, keys: Iterable[Any]) -> List[Optional[int]]:
+        """Look up the row numbers for a batch of keys,
+        opening the index file once for the whole batch.
+
+        :param keys: Keys to look up
+        :return: Row number of each key, or ``None`` for
+            the keys that aren't in the index.
+        :raises TypeError: If a key isn't of the index's type
+        """
+        keys = [self._lookupKey(key) for key in keys]
+        rows = [None] * len(keys)
+        if not any(key is not None for key in keys):
+            return rows
+        with self.filename.open("rb") as f:
+            n_slots, _, _ = self._readHeader(f)
+            for i, key in enumerate(keys):
+                if key is None: continue
+                for _, state, skey, data in self._probe(f, key, n_slots):
+                    if state == self.USED and skey == key:
+                        rows[i] = self._slotRow(data)
+                        break
+        return rows
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key) is not None
+
+    def containsMany(self, keys: Iterable[Any]) -> List[bool]:
+        """Check whether each of a batch of keys is in
+        the index (see ``getMany``).
+
+        :param keys: Keys to look for
+        :return: Whether each key is in the index
+        """
+        return [row is not None for row in self.getMany(keys)]
+
+    def items(self) -> Iterator[Tuple[Any,int]]:
+        """Iterate over every entry in the index, in
+        slot order.
+
+        :yields: ``(key, row)`` pairs
+        """
+        with self.filename.open("rb") as f:
+            n_slots, _, _ = self._readHeader(f)
+            data = f.read(n_slots * self._slot.size)
+        for state, key, row in self._slot.iter_unpack(data):
+            if state != self.USED: continue
+            key = self._key.unpack(key)[0]
+            if self._isStr: key = key.rstrip(b"\x00").decode()
+            yield key, row
+
+    def build(self, entries: Iterable[Tuple[Any,int]], n_slots: int = None):
+        """Replace the contents of the index.
+
+        :param entries: Iterable of ``(key, row)`` pairs
+        :param n_slots: Number of slots to allocate. If ``None``,
+            it's sized from the number of entries.
+        """
+        entries = list(entries)
+        if n_slots is None:
+            n_slots = self.MIN_SLOTS
+            while len(entries) > n_slots * self.MAX_LOAD / 2:
+                n_slots *= 2
+        buf = bytearray(self._header.size + n_slots * self._slot.size)
+        self._header.pack_into(buf, 0, self.MAGIC, n_slots, len(entries), 0)
+        for key, row in entries:
+            key = self._encode(key)
+            slot = self._hash(key, n_slots)
+            while buf[self._header.size + slot * self._slot.size] != self.EMPTY:
+                slot = (slot + 1) % n_slots
+            self._slot.pack_into(buf, self._header.size + slot * self._slot.size,
+                self.USED, key, row)
+        self.filename.write_bytes(bytes(buf))
+
+    def insert(self, key: Any, row: int):
+        """Add an entry to the index.
+
+        :param key: Key to add
+        :param row: Row number of ``key``
+        """
+        self.insertMany([(key, row)])
+
+    def insertMany(self, entries: Iterable[Tuple[Any,int]]):
+        """Add multiple entries to the index. If a key is
+        already in the index, its row number is replaced.
+
+        :param entries: Iterable of ``(key, row)`` pairs
+        """
+        entries = list(entries)
+        with self.filename.open("r+b") as f:
+            n_slots, n_used, n_deleted = self._readHeader(f)
+            if (n_used + n_deleted + len(entries)) > n_slots * self.MAX_LOAD:
+                grow = True
+            else:
+                grow = False
+                for key, row in entries:
+                    key = self._encode(key)
+                    target = target_state = None
+                    for slot, state, skey, _ in self._probe(f, key, n_slots):
+                        if state == self.USED and skey == key:
+                            target = slot
+                            break
+                        if state != self.USED and target is None:
+                            target, target_state = slot, state
+                    else:
+                        n_used += 1
+                        if target_state == self.DELETED: n_deleted -= 1
+                    f.seek(self._header.size + target * self._slot.size)
+                    f.write(self._slot.pack(self.USED, key, row))
+                self._writeHeader(f, n_slots, n_used, n_deleted)
+        if grow:
+            merged = dict(self.items())
+            merged.update(entries)
+            self.build(merged.items())
+
+    def remove(self, key: Any, row: int):
+        """Remove an entry from the index.
+
+        :param key: Key to remove
+        :param row: Row number of ``key``
+        """
+        self.removeMany([(key, row)])
+
+    def removeMany(self, entries: Iterable[Tuple[Any,int]]):
+        """Remove multiple entries from the index. Entries
+        that aren't in the index are ignored.
+
+        :param entries: Iterable of ``(key, row)`` pairs
+        """
+        with self.filename.open("r+b") as f:
+            n_slots, n_used, n_deleted = self._readHeader(f)
+            for key, row in entries:
+                key = self._encode(key)
+                for slot, state, skey, data in self._probe(f, key, n_slots):
+                    if state == self.USED and skey == key:
+                        if self._slotRow(data) == row:
+                            f.seek(self._header.size + slot * self._slot.size)
+                            f.write(bytes([self.DELETED]))
+                            n_used -= 1
+                            n_deleted += 1
+                        break
+            self._writeHeader(f, n_slots, n_used, n_deleted)
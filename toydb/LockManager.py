@@ -0,0 +1,240 @@
+
+import time
+import struct
+import threading
+from pathlib import Path
+
+from . import exceptions
+
+from typing import Union, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class _Lock:
+    __slots__ = ("file", "cond", "readers", "writer", "depth", "mode")
+
+    def __init__(self, file):
+        self.file = file
+        self.cond = threading.Condition()
+        self.readers = {}
+        self.writer = None
+        self.depth = 0
+        self.mode = None
+
+
+class LockManager:
+
+    SHARED, EXCLUSIVE = "shared", "exclusive"
+    _counter = struct.Struct(">q")
+
+    def __init__(self, directory: Union[str,Path], timeout: Optional[float] = None):
+        """Shared/exclusive locks that work across processes
+        (and threads) using the same database.
+
+        Each lock is an ``fcntl.flock`` on its own file in
+        ``directory``, so many processes can hold a lock in
+        shared mode while only one can hold it in exclusive
+        mode. Within a process, locks are reentrant per thread:
+        a thread holding a lock exclusively can take it again
+        in either mode. A thread holding a lock shared can't
+        upgrade it to exclusive, since ``flock`` drops the shared
+        lock before taking the exclusive one (so another writer
+        could get in between), and two threads upgrading at once
+        would deadlock. Take the lock exclusively up front instead.
+
+        Each lock file also holds a counter, which writers bump
+        so other processes know when to drop their caches.
+
+        If ``fcntl`` isn't available (eg on Windows), the locks
+        only coordinate threads within the process.
+
+        :param directory: Where to put the lock files
+        :param timeout: Max time to wait for a lock, in seconds.
+            If ``None``, wait forever.
+        """
+        self.directory = Path(directory)
+        self.timeout = timeout
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    def __repr__(self):
+        return f"<toydb.LockManager {self.directory}>"
+
+    def _get(self, name: str) -> _Lock:
+        with self._guard:
+            lock = self._locks.get(name)
+            if lock is None:
+                self.directory.mkdir(exist_ok=True)
+                f = (self.directory / f"{name}.lock").open("a+b")
+                lock = self._locks[name] = _Lock(f)
+            return lock
+
+    def _flock(self, lock: _Lock, mode: Optional[str], deadline: Optional[float],
+        blocking: bool = True) -> bool:
+        """Change the mode of a lock's ``flock``.
+
+        :return: ``False`` if the lock couldn't be taken
+            without blocking (or before the deadline).
+        """
+        if fcntl is not None:
+            op = {None: fcntl.LOCK_UN, self.SHARED: fcntl.LOCK_SH,
+                self.EXCLUSIVE: fcntl.LOCK_EX}[mode]
+            if mode is None or (blocking and deadline is None):
+                fcntl.flock(lock.file.fileno(), op)
+            else:
+                while True:
+                    try:
+                        fcntl.flock(lock.file.fileno(), op | fcntl.LOCK_NB)
+                        break
+                    except (BlockingIOError, PermissionError):
+                        if not blocking or time.monotonic() >= deadline:
+                            return False
+                        time.sleep(0.01)
+        lock.mode = mode
+        return True
+
+    def _wait(self, lock: _Lock, deadline: Optional[float], name: str):
+        if deadline is None:
+            lock.cond.wait()
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not lock.cond.wait(remaining):
+            raise exceptions.LockTimeoutError(f"Timed out waiting for lock \"{name}\".")
+
+    def acquire(self, name: str, mode: str = SHARED, blocking: bool = True) -> bool:
+        """Acquire a lock.
+
+        :param name: Name of the lock
+        :param mode: ``LockManager.SHARED`` or ``LockManager.EXCLUSIVE``
+        :param blocking: If ``False``, return ``False`` instead
+            of waiting for another process.
+        :return: ``True`` if the lock was acquired
+        :raises exceptions.LockTimeoutError: If the lock couldn't
+            be acquired within ``timeout`` seconds.
+        :raises exceptions.LockUpgradeError: If the thread only
+            holds the lock shared, and asks for it exclusively.
+        """
+        assert mode in (self.SHARED, self.EXCLUSIVE)
+        lock = self._get(name)
+        me = threading.get_ident()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with lock.cond:
+            if mode == self.SHARED:
+                while lock.writer not in (None, me):
+                    self._wait(lock, deadline, name)
+                if lock.mode is None and not self._flock(lock, mode, deadline, blocking):
+                    if blocking:
+                        raise exceptions.LockTimeoutError(
+                            f"Timed out waiting for lock \"{name}\".")
+                    return False
+                lock.readers[me] = lock.readers.get(me, 0) + 1
+                return True
+            if me in lock.readers and lock.writer != me:
+                raise exceptions.LockUpgradeError(
+                    f"Can't upgrade shared lock \"{name}\" to exclusive.")
+            while (lock.writer not in (None, me)
+                or any(t != me for t in lock.readers)):
+                self._wait(lock, deadline, name)
+            if lock.mode != mode and not self._flock(lock, mode, deadline, blocking):
+                if blocking:
+                    raise exceptions.LockTimeoutError(
+                        f"Timed out waiting for lock \"{name}\".")
+                return False
+            lock.writer = me
+            lock.depth += 1
+            return True
+
+    def release(self, name: str, mode: str = SHARED, owner: Optional[int] = None):
+        """Release a lock acquired with ``acquire``.
+
+        :param name: Name of the lock
+        :param mode: Mode it was acquired in
+        :param owner: Ident of the thread that acquired it, if
+            it's being released from another thread (eg when a
+            generator holding it is closed or collected there).
+            Defaults to the current thread.
+        """
+        lock = self._get(name)
+        me = threading.get_ident() if owner is None else owner
+        with lock.cond:
+            if mode == self.SHARED:
+                lock.readers[me] -= 1
+                if not lock.readers[me]:
+                    del lock.readers[me]
+            else:
+                assert lock.writer == me
+                lock.depth -= 1
+                if not lock.depth:
+                    lock.writer = None
+            new_mode = (self.EXCLUSIVE if lock.writer is not None
+                else self.SHARED if lock.readers else None)
+            if new_mode != lock.mode:
+                self._flock(lock, new_mode, None)
+            lock.cond.notify_all()
+
+    def shared(self, name: str) -> "_Held":
+        """Hold a lock in shared mode, as a context manager."""
+        return _Held(self, name, self.SHARED)
+
+    def exclusive(self, name: str) -> "_Held":
+        """Hold a lock in exclusive mode, as a context manager."""
+        return _Held(self, name, self.EXCLUSIVE)
+
+    def counter(self, name: str) -> int:
+        """Read a lock's change counter.
+
+        :param name: Name of the lock
+        :return: Current value of the counter
+        """
+        lock = self._get(name)
+        with lock.cond:
+            lock.file.seek(0)
+            data = lock.file.read(self._counter.size)
+        return self._counter.unpack(data)[0] if len(data) == self._counter.size else 0
+
+    def bump(self, name: str) -> int:
+        """Increment a lock's change counter. The lock
+        should be held exclusively.
+
+        :param name: Name of the lock
+        :return: New value of the counter
+        """
+        lock = self._get(name)
+        with lock.cond:
+            value = self.counter(name) + 1
+            lock.file.seek(0)
+            lock.file.truncate()
+            lock.file.write(self._counter.pack(value))
+            lock.file.flush()
+        return value
+
+    def close(self):
+        """Release every lock and close the lock files."""
+        with self._guard:
+            for lock in self._locks.values():
+                lock.file.close()
+            self._locks.clear()
+
+
+class _Held:
+    __slots__ = ("manager", "name", "mode", "owner")
+
+    def __init__(self, manager: LockManager, name: str, mode: str):
+        self.manager = manager
+        self.name = name
+        self.mode = mode
+        self.owner = None
+
+    def __enter__(self):
+        self.manager.acquire(self.name, self.mode)
+        self.owner = threading.get_ident()
+        return self
+
+    def __exit__(self, *args):
+        # Release for the thread that acquired the lock, even
+        # if it's exited from another one
+        self.manager.release(self.name, self.mode, self.owner)
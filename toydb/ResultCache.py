@@ -0,0 +1,104 @@
+
+import sys
+import threading
+from collections import OrderedDict
+
+from typing import Hashable, List, Optional, Sequence
+
+
+class ResultCache:
+
+    def __init__(self, capacity: int = 16 * 2 ** 20):
+        """An in-memory cache of query results.
+
+        Results are cached under a key that includes the
+        version of the table they were read from, so once the
+        table is written to, its old results are never returned
+        again (and ``invalidate`` frees them right away).
+        Results are evicted in least-recently-used order once
+        the cache holds more than ``capacity`` bytes (as
+        estimated by ``sys.getsizeof``).
+
+        The cache is thread-safe.
+
+        :param capacity: Memory budget for cached results, in bytes.
+            ``0`` disables the cache.
+        """
+        assert capacity >= 0
+        self.capacity = capacity
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._tables = {}
+        self._guard = threading.Lock()
+
+    def __repr__(self):
+        return (f"<toydb.ResultCache {len(self._results)} results, "
+            f"{self.size}/{self.capacity} bytes>")
+
+    def __len__(self):
+        return len(self._results)
+
+    @staticmethod
+    def _sizeOf(rows: Sequence[tuple]) -> int:
+        """Estimate the memory used by a result."""
+        return sys.getsizeof(rows) + sum(sys.getsizeof(row)
+            + sum(sys.getsizeof(v) for v in row) for row in rows)
+
+    def get(self, table: Hashable, key: Hashable) -> Optional[List[tuple]]:
+        """Look up a result.
+
+        :param table: Table the result was read from
+        :param key: The query, including the table's version
+        :return: A copy of the result rows, or ``None`` on a miss
+        """
+        with self._guard:
+            entry = self._results.get((table, key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._results.move_to_end((table, key))
+        return list(entry[0])
+
+    def put(self, table: Hashable, key: Hashable, rows: Sequence[tuple]):
+        """Add a result to the cache. Results bigger than
+        the whole cache aren't kept.
+
+        :param table: Table the result was read from
+        :param key: The query, including the table's version
+        :param rows: The result rows
+        """
+        rows = tuple(rows)
+        size = self._sizeOf(rows)
+        if size > self.capacity:
+            return
+        with self._guard:
+            old = self._results.pop((table, key), None)
+            if old is not None:
+                self.size -= old[1]
+            self._results[(table, key)] = (rows, size)
+            self._tables.setdefault(table, set()).add(key)
+            self.size += size
+            while self.size > self.capacity:
+                (old_table, old_key), old = self._results.popitem(last=False)
+                self._tables[old_table].discard(old_key)
+                self.size -= old[1]
+
+    def invalidate(self, table: Hashable):
+        """Drop a table's cached results after it's
+        been written to.
+
+        :param table: Table the results were read from
+        """
+        with self._guard:
+            for key in self._tables.pop(table, ()):
+                self.size -= self._results.pop((table, key))[1]
+
+    def clear(self):
+        """Drop every cached result."""
+        with self._guard:
+            self._results.clear()
+            self._tables.clear()
+            self.size = 0
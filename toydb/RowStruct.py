@@ -1,40 +1,16 @@
 
 import struct
-import itertools as it
+import operator
 
 from . import dtypes
 from . import exceptions
+from .StringHeap import StringHeap
 
-from typing import Union, List, Dict, Any
+from typing import Union, List, Dict, Any, Iterator, Callable, Optional
 
 
 class RowStruct:
 
-    @staticmethod
-    def _encode(txt: Union[str,None]) -> bytes:
-        """Encode `str` as `bytes` and handles ``None``
-        by converting it to an empty `bytes` obj.
-        (Assumes ``None``-ness has already been checked
-        when writing data row.)
-
-        :param txt: String to be encoded as bytes
-        :return: Byte encoding of ``txt``
-        """
-        if txt is None: return b""
-        return txt.encode()
-
-    @staticmethod
-    def _decode(txt: bytes) -> str:
-        """Decodes bytes object as a string.
-
-        Strips padding null (``\x00``) characters
-        and decodes.
-
-        :param txt: Bytes to be decoded
-        :return: String decoded from ``txt``
-        """
-        return txt.strip(b'\x00').decode()
-
     @staticmethod
     def _getDefault(dtype: Union[str,dtypes.DType]) -> Any:
         """Get the default value for a datatype.
@@ -55,13 +31,14 @@ class RowStruct:
         """
         if isinstance(dtype,dtypes.DType):
             dtype = str(dtype)
-        if any(c in dtype for c in "ilfd"):
+        if any(c in dtype for c in "ilfdQ"):
             return 0
         if "c" in dtype or "s" in dtype:
             return b""
         if "?" in dtype: return False
 
-    def __init__(self, columns: List[str], types: List[dtypes.DType], endian: str = ">"):
+    def __init__(self, columns: List[str], types: List[dtypes.DType], endian: str = ">",
+        tombstone: bool = False, heap: Optional[StringHeap] = None):
         """Wraps the `struct.Struct` class and handles
         null values and strings.
 
@@ -69,16 +46,160 @@ class RowStruct:
         :param types: Column types for ``columns``
         :param endian: Endianness of the data. Options: ``"@=<>!"``. (See python's
             `struct docs <https://docs.python.org/3/library/struct.html#byte-order-size-and-alignment>`_)
+        :param tombstone: Add a "live" flag to the end of each
+            row, so rows can be deleted in place by clearing it
+            (see ``isLive``). Packed rows are always live.
+        :param heap: Heap holding the values of ``VARSTRING``
+            columns. Packing a row adds its values to the heap,
+            and decoding a row reads them back.
         """
         assert len(types) > 0
         assert endian in "@=<>!"
         self.columns = columns
         self.types = types
         self.endian = endian
+        self.tombstone = tombstone
+        self.heap = heap
         self.format = self._makeFmt()
         self.row_struct = struct.Struct(self.format)
+        self.live_offset = self.row_struct.size - 1 if tombstone else None
         self._strRows = [("s" in str(t)) for t in types]
+        self._heapRows = [str(t) == dtypes.VARSTRING.value for t in types]
+        self._hasHeap = any(self._heapRows)
         self._defaults = [self._getDefault(t) for t in types]
+        self._projections = {}
+        self._compile()
+
+    def _compile(self):
+        """Generate the row codec's functions for this schema.
+
+        The generated functions (used by ``_validateTypes``,
+        ``_flatten`` and ``decode``) are stored on the codec
+        as ``_checkRow``, ``_flattenRow`` and ``_decodeRow``.
+        They're straight-line code with one expression per column, so
+        converting a row doesn't build any intermediate lists
+        or iterators, and type checks (including string
+        lengths) are worked out once, here, instead of per row.
+        """
+        n = len(self.types)
+        names = [f"v{i}" for i in range(n)]
+        env = {"SchemaError": exceptions.SchemaError, "types": self.types,
+            "defaults": self._defaults, "heap_ref": self._heapRef, "heap": self.heap}
+        checks, flat, decoded = [], [], []
+        for i, (v, t) in enumerate(zip(names, self.types)):
+            default = t.default
+            if isinstance(default, bool):
+                ok = f"isinstance({v}, bool)"
+            elif isinstance(default, float):
+                ok = f"isinstance({v}, float) or (isinstance({v}, int) " \
+                    f"and not isinstance({v}, bool))"
+            elif isinstance(default, (int, str)):
+                ok = f"isinstance({v}, {type(default).__name__})"
+                n_chars = t.getLength() if isinstance(default, str) else None
+                if n_chars is not None:
+                    ok += f" and len({v}) <= {n_chars}"
+            else:
+                ok = f"types[{i}].validate({v})"
+            checks.append(f"    if {v} is not None and not ({ok}):\n"
+                f"        raise SchemaError(f'Row value \"{{{v}}}\" is not of type \"{{types[{i}]}}\".')")
+            if self._heapRows[i]:
+                # Checked here rather than by ``StringHeap.append``, so a
+                # batch is rejected before any of its strings are added
+                max_len = 2 ** StringHeap.LENGTH_BITS - 1
+                checks.append(f"    if {v} is not None and len({v}) > {max_len // 4} "
+                    f"and len({v}.encode()) > {max_len}:\n"
+                    f"        raise SchemaError('`VARSTRING` values can be at most {max_len} bytes long.')")
+            if self._heapRows[i]:
+                value = f"heap_ref({v})"
+            elif self._strRows[i]:
+                value = f"b'' if {v} is None else {v}.encode()"
+            else:
+                value = f"defaults[{i}] if {v} is None else {v}"
+            flat.append(f"{v} is not None, {value}")
+            raw = f"b[{2 * i + 1}]"
+            if self._heapRows[i]:
+                raw = f"heap.read({raw})"
+            elif self._strRows[i]:
+                raw = f"{raw}.strip(b'\\x00').decode()"
+            decoded.append(f"{raw} if b[{2 * i}] else None")
+        unpack = f"    {', '.join(names)}, = row"
+        src = "\n".join([
+            "def validate(row):",
+            f"    if len(row) != {n}:",
+            f"        raise SchemaError(f'Row has {{len(row)}} values but the table has {n} columns.')",
+            unpack, *checks,
+            "def flatten(row):",
+            unpack,
+            f"    return ({', '.join(flat)}{', True' if self.tombstone else ''},)",
+            "def decode(b):",
+            f"    return [{', '.join(decoded)}]",
+        ])
+        exec(compile(src, f"<RowStruct {self.format}>", "exec"), env)
+        self._checkRow = env["validate"]
+        self._flattenRow = env["flatten"]
+        self._decodeRow = env["decode"]
+
+    def project(self, columns: List[str]) -> "RowStruct":
+        """Get a codec that only decodes some of the
+        columns (see ``RowProjection``).
+
+        Projections are cached, so repeated queries
+        reuse the same codec.
+
+        :param columns: Columns to decode
+        :return: Read-only codec for ``columns``. If all of
+            the columns are selected, this is ``self``.
+        """
+        key = frozenset(columns)
+        if key >= set(self.columns) or self.endian == "@":
+            return self
+        proj = self._projections.get(key)
+        if proj is None:
+            proj = self._projections[key] = RowProjection(self, columns)
+        return proj
+
+    def numpyDtype(self, np_module=None):
+        """Creates a NumPy structured dtype matching the
+        row layout, so a table file can be read as an array
+        of rows with ``numpy.frombuffer``.
+
+        Each column ``col`` becomes a field named ``col`` and
+        its not-null flag becomes a boolean field named
+        ``col.__notnull__``. Strings are fixed-width bytes
+        (``"S{n}"``) fields, and ``VARSTRING`` columns are
+        their ``uint64`` heap references. The row's live flag (if any) is
+        a boolean field named ``__live__``.
+
+        :param np_module: The ``numpy`` module (passed in so
+            NumPy stays an optional dependency).
+        :return: ``numpy.dtype`` with the same size as
+            ``self.row_struct``.
+        :raises exceptions.SchemaError: If the endianness is
+            ``"@"`` (native alignment can add padding that
+            NumPy doesn't know about).
+        """
+        if self.endian == "@":
+            raise exceptions.SchemaError(
+                "Native-aligned (\"@\") rows can't be read as NumPy arrays.")
+        endian = {">": ">", "!": ">", "<": "<", "=": "="}[self.endian]
+        sizes = {"?": "?", "c": "S1", "h": "i2", "i": "i4", "l": "i4",
+            "q": "i8", "Q": "u8", "f": "f4", "d": "f8"}
+        names, formats = [], []
+        for c, t in zip(self.columns, self.types):
+            t = str(t)
+            if t.endswith("s"):
+                fmt = f"S{t[:-1] or 1}"
+            else:
+                fmt = sizes[t]
+            if fmt[0] in "iuf": fmt = endian + fmt
+            names.extend([f"{c}.__notnull__", c])
+            formats.extend(["?", fmt])
+        if self.tombstone:
+            names.append("__live__")
+            formats.append("?")
+        dtype = np_module.dtype({"names": names, "formats": formats})
+        assert dtype.itemsize == self.row_struct.size
+        return dtype
 
     def _makeFmt(self) -> str:
         """Creates a format string for the `struct.Struct`
@@ -88,18 +209,20 @@ class RowStruct:
         character to signal if the value is ``NA``.
 
         Also adds an endian character to the start
-        of the format string.
+        of the format string, and the live flag to
+        the end (if ``self.tombstone``).
 
         :return: Format string passed to ``struct.Struct``
         """
-        valid_chars = "xc?hilqfds" + "0123456789"
+        valid_chars = "xc?hilqQfds" + "0123456789"
         fmt = self.endian
         fmt += "".join(f"?{t}" for t in self.types)
         for c in fmt[1:]:
             if c not in valid_chars:
                 raise exceptions.SchemaError(f"Fmt character '{c}' invalid.")
-        assert len(fmt) % 2 == 1, "There should be an even number of chars +1 for `endian`-ness"
-        assert len(fmt) > 1
+        n_fields = len(struct.unpack(fmt, bytes(struct.calcsize(fmt))))
+        assert n_fields == 2 * len(self.types), "There should be a flag and a value per column"
+        if self.tombstone: fmt += "?"
         return fmt
 
     def _row_dict2list(self, row: Dict[str,Any]) -> list:
@@ -126,6 +249,17 @@ class RowStruct:
         res.update(row)
         return list(res.values())
 
+    def _heapRef(self, txt: Optional[str]) -> int:
+        """Add a ``VARSTRING`` value to the heap.
+
+        :param txt: String to add
+        :return: Its heap reference (``0`` for ``None``)
+        """
+        if txt is None: return 0
+        if self.heap is None:
+            raise exceptions.SchemaError("`VARSTRING` columns need a `StringHeap`.")
+        return self.heap.append(txt.encode())
+
     def pack(self, row: Union[List[Any], Dict[str, Any]]) -> bytes:
         """Encodes data from row to a byte string
         that can be written to the table file, per
@@ -141,34 +275,63 @@ class RowStruct:
         if isinstance(row, dict):
             row = self._row_dict2list(row)
         # Validate the input row
-        self._validateTypes(row)
-        # Use bool flags to replace NA values
-        not_na_flags = [(r is not None) for r in row]
-        # Encode the strings, if necessary
-        if any(self._strRows):
-            row = [(self._encode(r) if is_s else r) for is_s, r
-                in zip(self._strRows,row)]
-        # Zip and flatten the iterables
-        row = it.chain(*[
-            (not_na, (val if not_na else dflt))
-            for not_na, val, dflt in
-            zip(not_na_flags,row,self._defaults)
-        ])
-        return self.row_struct.pack(*row)
+        self._checkRow(row)
+        return self.row_struct.pack(*self._flattenRow(row))
+
+    def pack_into(self, buffer: bytearray, offset: int,
+        row: Union[List[Any], Dict[str, Any]], validate: bool = True):
+        """Encodes data from row directly into a
+        writable buffer, like ``pack``.
+
+        Wrapper around python's ``struct.pack_into``.
+
+        :param buffer: Writable buffer (eg a ``bytearray``)
+        :param offset: Position in ``buffer`` to write the row at
+        :param row: Row of data to be written to table.
+        :param validate: Check the row's types first. Set to
+            ``False`` if the row has already been checked
+            with ``validateRows``.
+        """
+        if isinstance(row, dict):
+            row = self._row_dict2list(row)
+        if validate:
+            self._checkRow(row)
+        self.row_struct.pack_into(buffer, offset, *self._flattenRow(row))
+
+    def validateRows(self, rows: List[List[Any]]):
+        """Confirms the types of a batch of rows
+        before adding them to a table.
+
+        :param rows: List of rows, as ordered lists
+        :raises exceptions.SchemaError: If a row has the wrong
+            number of values, or a value in any row doesn't
+            match the propper dtype.
+        """
+        validate = self._checkRow
+        for row in rows:
+            validate(row)
 
     def _validateTypes(self, row: list):
-        """Confirms the types in ``row`` before
-        adding them to a table.
+        """Confirms the number of values and their types in
+        ``row`` before adding them to a table (see ``_compile``).
 
         :param row: A list of values to be added to
             a table in the database.
         :raises exceptions.SchemaError: If a value in row
             doesn't match the propper dtype.
         """
-        for v, t in zip(row,self.types):
-            if not t.validate(v):
-                raise exceptions.SchemaError(
-                    f'Row value "{v}" is not of type "{t}".')
+        self._checkRow(row)
+
+    def _flatten(self, row: List[Any]) -> tuple:
+        """Interleave a row's values with their not-null
+        flags, replacing nulls with default values and
+        encoding strings, ready to be passed to
+        ``struct.pack`` (see ``_compile``).
+
+        :param row: Row of data, as an ordered list
+        :return: Flattened ``(flag, value, ...)`` tuple
+        """
+        return self._flattenRow(row)
 
     def unpack(self, data: bytes) -> List[Any]:
         """Decodes a byte encoding of a row of data
@@ -181,12 +344,125 @@ class RowStruct:
         :param data: byte encoding of row data
         :return: Row data in list form
         """
-        b = self.row_struct.unpack(data)
-        assert len(b) > 0
-        assert len(b) % 2 == 0
-        flags, row = b[::2], b[1::2]
-        row = ((self._decode(r) if is_s else r)
-            for is_s, r in zip(self._strRows,row))
-        row = ((r if f else None)
-            for f, r in zip(flags,row))
-        return list(row)
+        return self._decodeRow(self.row_struct.unpack(data))
+
+    def unpack_from(self, buffer, offset: int = 0) -> List[Any]:
+        """Decodes a row of data straight from a buffer
+        (eg a memory-mapped table file), without copying
+        it out first.
+
+        :param buffer: Buffer holding encoded rows
+        :param offset: Position of the row in ``buffer``
+        :return: Row data in list form
+        """
+        return self._decodeRow(self.row_struct.unpack_from(buffer, offset))
+
+    def iter_unpack(self, buffer) -> Iterator[List[Any]]:
+        """Decodes every row in a buffer.
+
+        :param buffer: Buffer holding encoded rows. Its
+            length must be a multiple of the row size.
+        :yields: Row data in list form
+        """
+        decode = self._decodeRow
+        for b in self.row_struct.iter_unpack(buffer):
+            yield decode(b)
+
+    def isLive(self, b: tuple) -> bool:
+        """Check a raw row's live flag.
+
+        :param b: Flat ``(flag, value, ...)`` tuple
+        :return: ``False`` if the row has been deleted
+        """
+        return not self.tombstone or b[-1]
+
+    def rawGetter(self, column: str) -> Callable[[tuple],Any]:
+        """Get a function that reads a column's value from
+        a raw row, without decoding the rest of it. Strings
+        are left encoded, except for ``VARSTRING`` values,
+        which are read from the heap.
+
+        :param column: Name of the column
+        :return: Function taking a flat ``(flag, value, ...)``
+            tuple and returning the column's value
+        """
+        i = self.columns.index(column)
+        if not self._heapRows[i]:
+            return operator.itemgetter(2 * i + 1)
+        heap = self.heap
+        return lambda raw: heap.read(raw[2 * i + 1])
+
+    def decode(self, b: tuple) -> List[Any]:
+        """Decodes the values returned by ``struct.unpack``
+        into a row of data, handling NA values and strings
+        (see ``_compile``).
+
+        :param b: Flat ``(flag, value, ...)`` tuple
+        :return: Row data in list form
+        """
+        return self._decodeRow(b)
+
+
+class RowProjection(RowStruct):
+
+    def __init__(self, parent: RowStruct, columns: List[str]):
+        """A read-only ``RowStruct`` that only decodes a
+        subset of a row's columns.
+
+        The unselected columns (and their null flags) are
+        replaced with ``x`` pad bytes in the format string,
+        so ``struct`` skips over them without creating any
+        python objects, and their strings never get decoded.
+        Rows are the same size as the ``parent``'s.
+
+        Columns are decoded in table order, not in the
+        order of ``columns``.
+
+        :param parent: Codec for the full row
+        :param columns: Columns to decode
+        """
+        assert all(c in parent.columns for c in columns), "Unknown column in projection"
+        keep = set(columns)
+        self.parent = parent
+        self.columns = [c for c in parent.columns if c in keep]
+        self.types = [t for c, t in zip(parent.columns, parent.types) if c in keep]
+        self.endian = parent.endian
+        self.tombstone = parent.tombstone
+        self.live_offset = parent.live_offset
+        self.heap = parent.heap
+        self.format = self._makeProjectionFmt(keep)
+        self.row_struct = struct.Struct(self.format)
+        assert self.row_struct.size == parent.row_struct.size
+        self._strRows = [("s" in str(t)) for t in self.types]
+        self._heapRows = [str(t) == dtypes.VARSTRING.value for t in self.types]
+        self._hasHeap = any(self._heapRows)
+        self._defaults = [self._getDefault(t) for t in self.types]
+        self._projections = {}
+        self._compile()
+
+    def _makeProjectionFmt(self, keep: set) -> str:
+        """Creates a format string with pad bytes in
+        place of the columns that aren't in ``keep``.
+
+        :param keep: Names of the columns to decode
+        :return: Format string passed to ``struct.Struct``
+        """
+        fmt, pad = self.endian, 0
+        for c, t in zip(self.parent.columns, self.parent.types):
+            if c in keep:
+                if pad: fmt += f"{pad}x"
+                fmt, pad = fmt + f"?{t}", 0
+            else:
+                pad += struct.calcsize(f"{self.endian}?{t}")
+        if pad: fmt += f"{pad}x"
+        if self.tombstone: fmt += "?"
+        return fmt
+
+    def pack(self, row):
+        raise TypeError("Projections can only decode rows.")
+
+    def pack_into(self, buffer, offset, row, validate=True):
+        raise TypeError("Projections can only decode rows.")
+
+    def project(self, columns: List[str]) -> RowStruct:
+        return self.parent.project(columns)
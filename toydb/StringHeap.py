@@ -0,0 +1,94 @@
+
+import mmap
+import threading
+from pathlib import Path
+
+from . import exceptions
+
+from typing import Union, List, Tuple
+
+
+class StringHeap:
+
+    OFFSET_BITS, LENGTH_BITS = 40, 24
+
+    def __init__(self, filename: Union[str,Path]):
+        """An append-only file holding the values of a
+        table's ``VARSTRING`` columns.
+
+        Rows store a reference to their string instead of the
+        string itself: a 64-bit int with the offset of the
+        string's bytes in the heap in the high ``OFFSET_BITS``
+        and their length in the low ``LENGTH_BITS``. Rows keep
+        a fixed width, and strings only take up as much space
+        as they need.
+
+        New strings are buffered by ``append`` until the table's
+        next write commits them (see ``pending``). Strings are
+        never overwritten, so once written they can be read
+        without any locking. Space used by deleted or updated
+        strings isn't reclaimed.
+
+        :param filename: Location of the heap file
+        """
+        self.filename = Path(filename)
+        self._map = b""
+        self._pending = []
+        self._end = None
+        self._guard = threading.Lock()
+
+    def __repr__(self):
+        return f"<toydb.StringHeap {self.filename.name}>"
+
+    def size(self) -> int:
+        """Get the size of the heap file, in bytes."""
+        return self.filename.stat().st_size if self.filename.exists() else 0
+
+    def append(self, data: bytes) -> int:
+        """Add a string to the heap.
+
+        :param data: Encoded string
+        :return: Reference to the string, to store in the row
+        :raises exceptions.SchemaError: If the string is
+            longer than ``2 ** LENGTH_BITS - 1`` bytes.
+        """
+        if not data:
+            return 0
+        if len(data) >= 2 ** self.LENGTH_BITS:
+            raise exceptions.SchemaError(
+                f"Strings can be at most {2 ** self.LENGTH_BITS - 1} bytes long.")
+        with self._guard:
+            if self._end is None:
+                self._end = self.size()
+            offset = self._end
+            self._pending.append((offset, bytes(data)))
+            self._end += len(data)
+        return offset << self.LENGTH_BITS | len(data)
+
+    def pending(self) -> List[Tuple[int,bytes]]:
+        """Take the strings added since the last call, to
+        be written to the heap file with the table's next
+        transaction.
+
+        :return: ``(offset, data)`` pairs
+        """
+        with self._guard:
+            pending, self._pending, self._end = self._pending, [], None
+        return pending
+
+    def read(self, ref: int) -> str:
+        """Read a string from the heap.
+
+        :param ref: Reference returned by ``append``
+        :return: The decoded string
+        """
+        length = ref & (2 ** self.LENGTH_BITS - 1)
+        if not length:
+            return ""
+        offset = ref >> self.LENGTH_BITS
+        mm = self._map
+        if offset + length > len(mm):
+            # Written since the heap was mapped
+            with self.filename.open("rb") as f:
+                mm = self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mm[offset:offset + length].decode()
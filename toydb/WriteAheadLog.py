@@ -0,0 +1,201 @@
+
+import os
+import time
+import zlib
+import struct
+import threading
+from pathlib import Path
+
+from typing import Union, Iterator, List, Tuple
+
+
+class WriteAheadLog:
+
+    WRITE, TRUNCATE, COMMIT, HEAP_WRITE = 1, 2, 3, 4
+    DURABILITY = ("none", "commit", "group")
+    _header = struct.Struct(">IIB")
+    _write = struct.Struct(">Hq")
+
+    def __init__(self, filename: Union[str,Path], durability: str = "commit",
+        group_delay: float = 0.0):
+        """A redo log of physical writes to table files.
+
+        Each transaction's records are appended to the log,
+        followed by a commit record, before any of its writes
+        are applied to the table files. After a crash, the
+        committed transactions are replayed (see ``committed``),
+        and any torn or uncommitted records at the end of the
+        log are ignored.
+
+        Records are a ``(length, crc32, type)`` header followed
+        by the payload, so torn writes can be detected.
+
+        Durability modes:
+
+        * ``"none"``: The log is written but never fsync-ed. Protects
+          against the process crashing, but not the OS.
+        * ``"commit"``: Every commit is fsync-ed before it returns.
+        * ``"group"``: Group commit. Concurrent commits (from other
+          threads) share a single fsync -- the first one to arrive
+          becomes the leader and syncs everything written so far,
+          while the others wait for it.
+
+        The log is thread-safe.
+
+        :param filename: Location of the log file
+        :param durability: One of ``WriteAheadLog.DURABILITY``
+        :param group_delay: With ``"group"`` durability, how long
+            (in seconds) the leader waits for more commits to join
+            before syncing.
+        """
+        assert durability in self.DURABILITY, f"Invalid durability \"{durability}\"."
+        self.filename = Path(filename)
+        self.durability = durability
+        self.group_delay = group_delay
+        self.n_commits = 0
+        self.n_syncs = 0
+        self._file = None
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._synced = 0
+        self._syncing = False
+
+    def __repr__(self):
+        return f"<toydb.WriteAheadLog {self.filename.name} ({self.durability})>"
+
+    def _open(self):
+        if self._file is None:
+            # Unbuffered and in append mode, so each commit is a
+            # single write to the end of the file, even if other
+            # processes are writing to the log too.
+            self._file = self.filename.open("ab", buffering=0)
+        return self._file
+
+    def size(self) -> int:
+        """Get the size of the log, in bytes."""
+        return self.filename.stat().st_size if self.filename.exists() else 0
+
+    def _encode(self, rtype: int, payload: bytes = b"") -> bytes:
+        crc = zlib.crc32(payload, zlib.crc32(bytes([rtype])))
+        return self._header.pack(len(payload), crc, rtype) + payload
+
+    def _encodeRecord(self, rtype: int, table: str, value: int, data: bytes = b"") -> bytes:
+        name = table.encode()
+        return self._encode(rtype, self._write.pack(len(name), value) + name + bytes(data))
+
+    def commit(self, records: List[Tuple[int,str,int,bytes]]):
+        """Log a transaction and make it durable (per the
+        log's durability mode).
+
+        The caller should only apply the writes once this
+        returns.
+
+        :param records: The transaction's changes, as
+            ``(WRITE, table, offset, data)``,
+            ``(TRUNCATE, table, size, b"")`` or
+            ``(HEAP_WRITE, table, offset, data)`` (a write
+            to the table's ``StringHeap``) tuples
+        """
+        data = b"".join(self._encodeRecord(*r) for r in records) + self._encode(self.COMMIT)
+        with self._cond:
+            f = self._open()
+            view = memoryview(data)
+            while view:
+                view = view[f.write(view):]
+            self._seq += 1
+            self.n_commits += 1
+            lsn = self._seq
+            if self.durability == "commit":
+                self._sync(f)
+                self._synced = lsn
+            elif self.durability == "group":
+                self._groupSync(f, lsn)
+
+    def _sync(self, f):
+        os.fsync(f.fileno())
+        self.n_syncs += 1
+
+    def _groupSync(self, f, lsn: int):
+        """Wait until the log is synced up to commit
+        number ``lsn``, becoming the leader and syncing it
+        if no one else is. Called holding ``self._cond``.
+        """
+        while self._synced < lsn:
+            if self._syncing:
+                self._cond.wait()
+                continue
+            self._syncing = True
+            try:
+                if self.group_delay > 0:
+                    self._cond.release()
+                    try:
+                        time.sleep(self.group_delay)
+                    finally:
+                        self._cond.acquire()
+                target = self._seq
+                self._cond.release()
+                try:
+                    self._sync(f)
+                finally:
+                    self._cond.acquire()
+                self._synced = max(self._synced, target)
+            finally:
+                self._syncing = False
+                self._cond.notify_all()
+
+    def records(self) -> Iterator[Tuple[int,str,int,bytes]]:
+        """Read the log's valid records, stopping at the
+        first torn or corrupt one.
+
+        :yields: ``(type, table, value, data)`` tuples. Commit
+            records are ``(COMMIT, "", 0, b"")``.
+        """
+        if not self.filename.exists():
+            return
+        data = self.filename.read_bytes()
+        pos = 0
+        while pos + self._header.size <= len(data):
+            length, crc, rtype = self._header.unpack_from(data, pos)
+            start = pos + self._header.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload, zlib.crc32(bytes([rtype]))) != crc:
+                return
+            pos = start + length
+            if rtype == self.COMMIT:
+                yield rtype, "", 0, b""
+                continue
+            n, value = self._write.unpack_from(payload)
+            offset = self._write.size
+            yield rtype, payload[offset:offset + n].decode(), value, payload[offset + n:]
+
+    def committed(self) -> Iterator[Tuple[int,str,int,bytes]]:
+        """Read the records of the committed transactions,
+        in the order they were logged.
+
+        :yields: ``(type, table, value, data)`` tuples
+        """
+        pending = []
+        for record in self.records():
+            if record[0] == self.COMMIT:
+                yield from pending
+                pending = []
+            else:
+                pending.append(record)
+
+    def reset(self):
+        """Empty the log, once all of its changes have
+        been made durable in the table files.
+        """
+        with self._cond:
+            self.close()
+            with self.filename.open("wb") as f:
+                os.fsync(f.fileno())
+
+    def close(self):
+        """Close the log file. It'll be re-opened by the
+        next commit.
+        """
+        with self._cond:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,190 @@
+
+import os
+import struct
+import functools
+import threading
+from pathlib import Path
+
+from . import dtypes
+
+from typing import Union, Dict, Iterable, List, Optional, Tuple
+
+
+class ZoneMap:
+
+    ZONE_ROWS = 1024
+
+    def __init__(self, filename: Union[str,Path], columns: List[str],
+        types: List[dtypes.DType], zone_rows: int = ZONE_ROWS):
+        """Per-zone statistics for a table's columns, so scans
+        can skip the parts of a table that can't match a filter.
+
+        A table's rows are split into zones of ``zone_rows``
+        rows, and for each zone and column the map keeps the
+        number of non-null values, the number of nulls and the
+        min and max values. Values are kept as they're stored
+        in the rows (eg strings are null-padded bytes), so they
+        can be compared to an expression's encoded constants
+        (see ``toydb.expr.Expr.mayMatch``).
+
+        Stats are only ever widened -- overwriting or deleting
+        a row doesn't shrink them, and the counts are upper
+        bounds -- so they can be wrong about a zone matching,
+        but never about it not matching. ``VARSTRING`` columns
+        and NaNs aren't tracked.
+
+        :param filename: Location of the zone map file
+        :param columns: The table's column names
+        :param types: The table's column types
+        :param zone_rows: Number of rows per zone
+        """
+        assert zone_rows > 0
+        self.filename = Path(filename)
+        self.zone_rows = zone_rows
+        self._cols = [(c, 2 * i) for i, (c, t) in enumerate(zip(columns, types))
+            if str(t) != dtypes.VARSTRING.value]
+        fmts = [str(t) for c, t in zip(columns, types) if str(t) != dtypes.VARSTRING.value]
+        self._struct = struct.Struct(">" + "".join(f"qq{f}{f}" for f in fmts))
+        self._empty = []
+        for f in fmts:
+            dflt = b"\x00" if f.endswith("c") else b"" if f.endswith("s") else False \
+                if f == "?" else 0
+            self._empty.extend([0, 0, dflt, dflt])
+        self._zones = None
+        self._dirty = set()
+        self._guard = threading.RLock()
+
+    def __repr__(self):
+        return f"<toydb.ZoneMap {self.filename.name}>"
+
+    def __len__(self):
+        with self._guard:
+            self._load()
+            return len(self._zones)
+
+    def exists(self) -> bool:
+        """Does the zone map file exist?"""
+        return self.filename.exists()
+
+    def _load(self):
+        if self._zones is None:
+            data = self.filename.read_bytes() if self.filename.exists() else b""
+            data = data[:len(data) - len(data) % self._struct.size]
+            self._zones = [list(z) for z in self._struct.iter_unpack(data)]
+            self._dirty.clear()
+
+    def reload(self):
+        """Forget the cached stats, eg after another
+        process has written to the table.
+        """
+        with self._guard:
+            self._zones = None
+
+    def add(self, first_row: int, raws: Iterable[tuple]):
+        """Widen the stats to cover rows being written.
+
+        :param first_row: Row number of the first row
+        :param raws: Consecutive rows, as flat ``(flag, value, ...)``
+            tuples from ``struct.unpack``
+        """
+        with self._guard:
+            self._load()
+            zones = self._zones
+            for n, raw in enumerate(raws, first_row):
+                z = n // self.zone_rows
+                while len(zones) <= z:
+                    zones.append(list(self._empty))
+                    self._dirty.add(len(zones) - 1)
+                zone = zones[z]
+                self._dirty.add(z)
+                for i, (_, flag) in enumerate(self._cols):
+                    j = 4 * i
+                    if not raw[flag]:
+                        zone[j + 1] += 1
+                        continue
+                    v = raw[flag + 1]
+                    if v != v: continue
+                    if not zone[j]:
+                        zone[j + 2] = zone[j + 3] = v
+                    elif v < zone[j + 2]:
+                        zone[j + 2] = v
+                    elif v > zone[j + 3]:
+                        zone[j + 3] = v
+                    zone[j] += 1
+
+    def truncate(self, n_rows: int):
+        """Drop the zones past the end of the table.
+
+        :param n_rows: New number of rows in the table
+        """
+        with self._guard:
+            self._load()
+            n = -(-n_rows // self.zone_rows)
+            del self._zones[n:]
+            self._dirty = {z for z in self._dirty if z < n}
+            self._dirty.add(-1)
+
+    def flush(self):
+        """Write the changed zones to the zone map file."""
+        with self._guard:
+            if self._zones is None or not self._dirty:
+                return
+            size = self._struct.size
+            mode = "r+b" if self.filename.exists() else "w+b"
+            with self.filename.open(mode) as f:
+                for z in sorted(self._dirty):
+                    if z < 0: continue
+                    f.seek(z * size)
+                    f.write(self._struct.pack(*self._zones[z]))
+                f.truncate(len(self._zones) * size)
+            self._dirty.clear()
+
+    def build(self, raws: Iterable[tuple]):
+        """Rebuild the stats from scratch, and replace the
+        zone map file.
+
+        :param raws: Every row in the table (including deleted
+            ones), as flat tuples, in order
+        """
+        with self._guard:
+            self._zones, self._dirty = [], set()
+            self.add(0, raws)
+            tmp = self.filename.with_name(self.filename.name + ".tmp")
+            tmp.write_bytes(b"".join(self._struct.pack(*z) for z in self._zones))
+            os.replace(str(tmp), str(self.filename))
+            self._dirty.clear()
+
+    def zoneStats(self, z: int) -> Optional[Dict[str,Tuple]]:
+        """Get the stats of a zone.
+
+        :param z: Zone number
+        :return: Mapping from column name to ``(n_values, n_nulls,
+            min, max)``, or ``None`` if the zone isn't in the map.
+        """
+        with self._guard:
+            self._load()
+            if z >= len(self._zones):
+                return None
+            zone = self._zones[z]
+            return {c: tuple(zone[4 * i:4 * i + 4]) for i, (c, _) in enumerate(self._cols)}
+
+    def candidates(self, where, rstruct, n_rows: int,
+        blooms: Optional[Dict[str,"BloomFilter"]] = None) -> List[int]:
+        """Find the zones that might hold rows matching
+        an expression.
+
+        :param where: ``toydb.expr`` expression
+        :param rstruct: ``RowStruct`` of the table
+        :param n_rows: Number of rows in the table
+        :param blooms: Optionally, the table's Bloom filters,
+            by column, for equality filters to check too
+        :return: Sorted zone numbers
+        """
+        zones = []
+        for z in range(-(-n_rows // self.zone_rows)):
+            stats = self.zoneStats(z)
+            probes = {c: functools.partial(bf.mightContain, z)
+                for c, bf in (blooms or {}).items()}
+            if where.mayMatch(stats or {}, rstruct, probes):
+                zones.append(z)
+        return zones
@@ -4,10 +4,22 @@
 import pathlib as _pathlib
 import shutil as _shutil
 
+from . import aggregates
 from . import dtypes
 from . import exceptions
+from . import expr
+from .AsyncDatabase import AsyncDatabase
+from .BlockFile import BlockFile
+from .BloomFilter import BloomFilter
+from .BufferPool import BufferPool
+from .Cursor import Cursor
 from .Database import Database
+from .LockManager import LockManager
+from .ResultCache import ResultCache
 from .RowStruct import RowStruct
+from .StringHeap import StringHeap
+from .WriteAheadLog import WriteAheadLog
+from .ZoneMap import ZoneMap
 
 __version__ = "0.1.0"
 
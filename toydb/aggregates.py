@@ -0,0 +1,294 @@
+"""Aggregate functions for ``GROUP BY`` queries.
+
+Example::
+
+    from toydb import aggregates as agg
+    db.query("sales", group_by=["region"],
+        aggregates={"n": agg.count(), "total": agg.sum("amount")})
+
+Aggregates ignore null values (except ``count()``
+with no column, which counts rows).
+
+Note: this module defines ``sum``, ``min`` and ``max``
+aliases, which shadow the builtins inside it.
+"""
+
+import pickle
+import tempfile
+from pathlib import Path
+
+from typing import Union, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class Aggregate:
+
+    def __init__(self, column: Optional[str] = None):
+        """Base class for aggregate functions.
+
+        Aggregates are computed incrementally: each group
+        starts with ``init()``, each row's value is folded in
+        with ``update()``, partial states (eg from different
+        workers, or spilled to disk) are combined with
+        ``merge()``, and ``result()`` gives the final value.
+
+        :param column: Column to aggregate
+        """
+        self.column = column
+
+    def __repr__(self):
+        col = "" if self.column is None else repr(self.column)
+        return f"{self.__class__.__name__.lower()}({col})"
+
+    def columns(self) -> List[str]:
+        """Columns the aggregate needs to read."""
+        return [] if self.column is None else [self.column]
+
+    def init(self) -> Any:
+        raise NotImplementedError
+
+    def update(self, state: Any, value: Any) -> Any:
+        raise NotImplementedError
+
+    def merge(self, a: Any, b: Any) -> Any:
+        raise NotImplementedError
+
+    def result(self, state: Any) -> Any:
+        return state
+
+
+class Count(Aggregate):
+    """Counts rows, or non-null values if a column is given."""
+
+    def init(self) -> int:
+        return 0
+
+    def update(self, state: int, value: Any) -> int:
+        if self.column is not None and value is None:
+            return state
+        return state + 1
+
+    def merge(self, a: int, b: int) -> int:
+        return a + b
+
+
+class Sum(Aggregate):
+    """Sum of a column's values. ``None`` if there are none."""
+
+    def init(self) -> Any:
+        return None
+
+    def update(self, state: Any, value: Any) -> Any:
+        if value is None: return state
+        return value if state is None else state + value
+
+    def merge(self, a: Any, b: Any) -> Any:
+        if a is None: return b
+        if b is None: return a
+        return a + b
+
+
+class Min(Aggregate):
+    """Smallest of a column's values."""
+
+    def init(self) -> Any:
+        return None
+
+    def update(self, state: Any, value: Any) -> Any:
+        if value is None: return state
+        return value if state is None or value < state else state
+
+    def merge(self, a: Any, b: Any) -> Any:
+        return self.update(a, b)
+
+
+class Max(Aggregate):
+    """Largest of a column's values."""
+
+    def init(self) -> Any:
+        return None
+
+    def update(self, state: Any, value: Any) -> Any:
+        if value is None: return state
+        return value if state is None or value > state else state
+
+    def merge(self, a: Any, b: Any) -> Any:
+        return self.update(a, b)
+
+
+class Mean(Aggregate):
+    """Average of a column's values. ``None`` if there are none."""
+
+    def init(self) -> Tuple[Any,int]:
+        return (0, 0)
+
+    def update(self, state: Tuple[Any,int], value: Any) -> Tuple[Any,int]:
+        if value is None: return state
+        return (state[0] + value, state[1] + 1)
+
+    def merge(self, a: Tuple[Any,int], b: Tuple[Any,int]) -> Tuple[Any,int]:
+        return (a[0] + b[0], a[1] + b[1])
+
+    def result(self, state: Tuple[Any,int]) -> Optional[float]:
+        total, n = state
+        return total / n if n else None
+
+
+class HashAggregator:
+
+    N_PARTITIONS = 16
+
+    def __init__(self, group_by: List[str], aggregates: Dict[str,Aggregate],
+        max_groups: int = 100_000, tmp_dir: Union[str,Path,None] = None):
+        """Streaming hash aggregation.
+
+        Keeps one set of aggregate states per group, so memory
+        grows with the number of groups rather than the number
+        of rows. If there are more than ``max_groups`` groups,
+        the partial states are spilled to ``N_PARTITIONS``
+        temporary files (partitioned by the group's hash), and
+        each partition is merged separately at the end.
+
+        :param group_by: Columns to group by
+        :param aggregates: Mapping from output name to aggregate
+        :param max_groups: Max number of groups to hold in memory
+        :param tmp_dir: Directory for spill files
+        """
+        assert max_groups > 0
+        self.group_by = list(group_by)
+        self.aggregates = dict(aggregates)
+        self.max_groups = max_groups
+        self.tmp_dir = tmp_dir
+        self.groups = {}
+        self._partitions = None
+
+    def columns(self) -> List[str]:
+        """Columns that need to be read from the table."""
+        cols = list(self.group_by)
+        for a in self.aggregates.values():
+            cols.extend(a.columns())
+        return list(dict.fromkeys(cols))
+
+    def _newStates(self) -> list:
+        return [a.init() for a in self.aggregates.values()]
+
+    def update(self, row: Dict[str,Any]):
+        """Add a row to its group.
+
+        :param row: Row, as a dict
+        """
+        key = tuple(row[c] for c in self.group_by)
+        states = self.groups.get(key)
+        if states is None:
+            if len(self.groups) >= self.max_groups:
+                self._spill()
+            states = self.groups[key] = self._newStates()
+        for i, a in enumerate(self.aggregates.values()):
+            states[i] = a.update(states[i], None if a.column is None else row[a.column])
+
+    def updateMany(self, rows: Iterable[Dict[str,Any]]):
+        for row in rows:
+            self.update(row)
+
+    def mergeStates(self, groups: Dict[tuple,list]):
+        """Merge in partial states (eg from another
+        ``HashAggregator``).
+
+        :param groups: Mapping from group key to states
+        """
+        aggs = list(self.aggregates.values())
+        for key, other in groups.items():
+            states = self.groups.get(key)
+            if states is None:
+                if len(self.groups) >= self.max_groups:
+                    self._spill()
+                self.groups[key] = list(other)
+                continue
+            for i, a in enumerate(aggs):
+                states[i] = a.merge(states[i], other[i])
+
+    def _spill(self):
+        """Write the in-memory groups' partial states
+        out to the partition files.
+        """
+        if self._partitions is None:
+            tmp_dir = Path(self.tmp_dir) if self.tmp_dir is not None else None
+            if tmp_dir is not None:
+                tmp_dir.mkdir(exist_ok=True)
+            self._partitions = [tempfile.TemporaryFile(
+                dir=None if tmp_dir is None else str(tmp_dir), suffix=".agg")
+                for _ in range(self.N_PARTITIONS)]
+        parts = [[] for _ in range(self.N_PARTITIONS)]
+        for key, states in self.groups.items():
+            parts[hash(key) % self.N_PARTITIONS].append((key, states))
+        for f, part in zip(self._partitions, parts):
+            if part:
+                pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.groups = {}
+
+    def _iterPartitions(self) -> Iterator[Dict[tuple,list]]:
+        """Load each spilled partition back, merging
+        the partial states for each group.
+        """
+        self._spill()
+        aggs = list(self.aggregates.values())
+        try:
+            for f in self._partitions:
+                f.seek(0)
+                groups = {}
+                while True:
+                    try:
+                        part = pickle.load(f)
+                    except EOFError:
+                        break
+                    for key, other in part:
+                        states = groups.get(key)
+                        if states is None:
+                            groups[key] = other
+                            continue
+                        for i, a in enumerate(aggs):
+                            states[i] = a.merge(states[i], other[i])
+                f.close()
+                yield groups
+        finally:
+            for f in self._partitions:
+                f.close()
+            self._partitions = None
+
+    def partialStates(self) -> Iterator[Dict[tuple,list]]:
+        """Get the (unfinalized) states of every group, eg
+        to be merged into another aggregator with
+        ``mergeStates``.
+
+        :yields: Dicts mapping from group key to states. Each
+            group is in exactly one of them.
+        """
+        if self._partitions is None:
+            yield self.groups
+        else:
+            yield from self._iterPartitions()
+
+    def results(self) -> Iterator[Dict[str,Any]]:
+        """Get the final value of every group.
+
+        With no ``group_by`` columns, there's always
+        exactly one group (even if there were no rows).
+
+        :yields: Dicts mapping from the ``group_by`` columns
+            and the aggregate names to their values.
+        """
+        if not self.group_by and not self.groups and self._partitions is None:
+            self.groups[()] = self._newStates()
+        names = list(self.aggregates)
+        aggs = list(self.aggregates.values())
+        for groups in self.partialStates():
+            for key, states in groups.items():
+                row = dict(zip(self.group_by, key))
+                row.update(zip(names, (a.result(s) for a, s in zip(aggs, states))))
+                yield row
+
+
+count = Count
+sum = Sum
+min = Min
+max = Max
+mean = avg = Mean
@@ -66,10 +66,14 @@ class DType:
         :returns: Is ``val`` a valid instance of this dtype?
         """
         if val is None: return True
+        if isinstance(self.default,float) and isinstance(val,int) \
+            and not isinstance(val,bool):
+            return True
         if not isinstance(val,type(self.default)):
             return False
         if isinstance(val,str):
-            if len(val) > self.getLength():
+            n = self.getLength()
+            if n is not None and len(val) > n:
                 return False
         return True
 
@@ -104,14 +108,17 @@ class JSONEncoder(json.JSONEncoder):
 
 I32 = DType("Int32","i",0)
 I64 = DType("Int64","l",0)
-F32 = DType("Float32","f",0)
-F64 = DType("Float64","d",0)
+F32 = DType("Float32","f",0.0)
+F64 = DType("Float64","d",0.0)
 BOOL = DType("Bool","?",False)
 CHAR = DType("Char","c","")
 STRING = DType("String","s","")
 STRING50 = STRING.subtype(50)
+# Stored out of line, in the table's ``StringHeap``. The row
+# holds a (offset, length) reference packed into a uint64.
+VARSTRING = DType("VarString","Q","")
 
-valid_chars = "ilfd?cs"
+valid_chars = "ilfd?csQ"
 supported_types = [
     I32,
     I64,
@@ -121,6 +128,7 @@ supported_types = [
     CHAR,
     STRING,
     STRING50,
+    VARSTRING,
 ]
 
 def validate(value: Union[int,float,bool,str], dtype: DType) -> bool:
@@ -168,6 +176,7 @@ def get_type_from_string(fmt_str: str) -> DType:
     if just_char == F64.value: return F64
     if just_char == BOOL.value: return BOOL
     if just_char == CHAR.value: return CHAR
+    if just_char == VARSTRING.value: return VARSTRING
 
     if just_char == "s":
         if non_char is None:
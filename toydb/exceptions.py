@@ -8,3 +8,33 @@ class SchemaError(BaseError):
     """
     """
     pass
+
+class UniqueConstraintError(BaseError):
+    """
+    """
+    pass
+
+class LockTimeoutError(BaseError):
+    """
+    """
+    pass
+
+class LockUpgradeError(BaseError):
+    """
+    """
+    pass
+
+class CursorClosedError(BaseError):
+    """
+    """
+    pass
+
+class CursorOpenError(BaseError):
+    """
+    """
+    pass
+
+class TableChangedError(BaseError):
+    """
+    """
+    pass
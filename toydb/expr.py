@@ -0,0 +1,456 @@
+"""Declarative ``WHERE`` expressions.
+
+Unlike a plain python callable, an expression can be
+inspected by the ``Database``. That lets it answer a
+query using an index, evaluate it against the raw
+encoded rows (so rows that don't match are never fully
+decoded), or vectorize it with NumPy. Expressions are
+still callable, so they can be used anywhere a ``where``
+function is accepted.
+
+Comparisons against null values are always false.
+
+Example::
+
+    from toydb.expr import col
+    db.query("people", where=(col("age") >= 30) & col("name").isin(["a", "b"]))
+"""
+
+import operator
+
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class Expr:
+    """Base class for ``WHERE`` expressions."""
+
+    def evaluate(self, row: Dict[str,Any]) -> bool:
+        """Evaluate the expression against a row.
+
+        :param row: Dict mapping from column name to value
+        :return: Does ``row`` match the expression?
+        """
+        raise NotImplementedError
+
+    def __call__(self, row: Dict[str,Any]) -> bool:
+        return self.evaluate(row)
+
+    def mask(self, arrays: Dict[str,Any]):
+        """Evaluate the expression against whole columns
+        at once.
+
+        :param arrays: Dict mapping from column name to a
+            ``numpy.ma.MaskedArray`` of its values (masked
+            where the value is null).
+        :return: Boolean ``numpy`` array, ``True`` where
+            the row matches.
+        """
+        raise NotImplementedError
+
+    def compile(self, rstruct) -> Callable[[tuple],bool]:
+        """Compile the expression into a function that
+        can be evaluated against a row as returned by
+        ``struct.unpack`` -- a flat ``(flag, value, ...)``
+        tuple -- so rows can be filtered before they're
+        decoded.
+
+        :param rstruct: ``RowStruct`` describing the layout
+            of the rows
+        :return: Function taking a raw row tuple and returning
+            ``True`` if it matches.
+        """
+        raise NotImplementedError
+
+    def mayMatch(self, stats: Dict[str,tuple], rstruct,
+        blooms: Optional[Dict[str,Callable[[Any],bool]]] = None) -> bool:
+        """Check whether any row in a zone of a table
+        could match the expression (see ``ZoneMap``).
+
+        :param stats: Mapping from column name to the zone's
+            ``(n_values, n_nulls, min, max)`` stats, with min and
+            max as raw values. Columns without stats are missing.
+        :param rstruct: ``RowStruct`` describing the row layout
+        :param blooms: Optionally, mapping from column name to a
+            function checking whether the zone might hold a raw
+            value (see ``BloomFilter.mightContain``)
+        :return: ``False`` if no row in the zone can match
+        """
+        return True
+
+    def __and__(self, other: "Expr") -> "And":
+        return And(self, other)
+
+    def __or__(self, other: "Expr") -> "Or":
+        return Or(self, other)
+
+    def __invert__(self) -> "Not":
+        return Not(self)
+
+    def conjuncts(self) -> List["Expr"]:
+        """Split the expression into a list of terms
+        that all need to be true for it to match.
+
+        :return: List of ``AND``-ed terms
+        """
+        return [self]
+
+    def columns(self) -> List[str]:
+        """Get the names of the columns referenced
+        by the expression.
+
+        :return: List of column names
+        """
+        return []
+
+
+def _rawColumn(rstruct, column: str):
+    """Find where a column's flag is in a raw row tuple,
+    how to read its value, and how to encode constants
+    so they can be compared to its raw value.
+
+    :param rstruct: ``RowStruct`` describing the row layout
+    :param column: Name of the column
+    :return: ``(flag_index, get_value, encode)``
+    """
+    i = rstruct.columns.index(column)
+    fmt = str(rstruct.types[i])
+    encode = lambda v: v
+    if fmt.endswith("s") or fmt.endswith("c"):
+        n = int(fmt[:-1] or 1)
+        # Strings are stored null-padded, which sorts the
+        # same as the unpadded string, so compare padded
+        # bytes to padded bytes.
+        encode = lambda v: v.encode().ljust(n, b"\x00") if isinstance(v, str) else v
+    return 2 * i, rstruct.rawGetter(column), encode
+
+
+class Compare(Expr):
+
+    OPS = {
+        "==": operator.eq,
+        "!=": operator.ne,
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+    }
+
+    def __init__(self, column: str, op: str, value: Any):
+        """Compares a column to a constant value.
+
+        :param column: Name of the column
+        :param op: Comparison operator. One of ``Compare.OPS``.
+        :param value: Constant to compare against. Comparisons
+            against ``None`` never match (use ``isnull`` instead).
+        """
+        assert op in self.OPS, f"Invalid operator \"{op}\"."
+        self.column = column
+        self.op = op
+        self.value = value
+        self._fn = self.OPS[op]
+
+    def __repr__(self):
+        return f"(col({self.column!r}) {self.op} {self.value!r})"
+
+    def evaluate(self, row: Dict[str,Any]) -> bool:
+        val = row[self.column]
+        if val is None or self.value is None: return False
+        return self._fn(val, self.value)
+
+    def mask(self, arrays: Dict[str,Any]):
+        arr = arrays[self.column]
+        value = self.value
+        if value is None:
+            import numpy as np
+            return np.zeros(len(arr), dtype=bool)
+        if arr.dtype.kind == "S" and isinstance(value, str):
+            value = value.encode()
+        return self._fn(arr.data, value) & ~arr.mask
+
+    def compile(self, rstruct) -> Callable[[tuple],bool]:
+        flag, get, encode = _rawColumn(rstruct, self.column)
+        if self.value is None:
+            return lambda raw: False
+        fn, value = self._fn, encode(self.value)
+        return lambda raw: raw[flag] and fn(get(raw), value)
+
+    def mayMatch(self, stats: Dict[str,tuple], rstruct, blooms = None) -> bool:
+        if self.value is None: return False
+        value = _rawColumn(rstruct, self.column)[2](self.value)
+        if self.op == "==" and blooms and self.column in blooms \
+            and not blooms[self.column](value):
+            return False
+        if self.column not in stats: return True
+        n, _, lo, hi = stats[self.column]
+        if not n: return False
+        try:
+            if self.op == "==": return lo <= value <= hi
+            if self.op == "<": return lo < value
+            if self.op == "<=": return lo <= value
+            if self.op == ">": return hi > value
+            if self.op == ">=": return hi >= value
+        except TypeError:
+            pass
+        return True
+
+    def columns(self) -> List[str]:
+        return [self.column]
+
+
+class In(Expr):
+
+    def __init__(self, column: str, values: Iterable[Any]):
+        """Matches rows where a column is one of a
+        set of constant values.
+
+        :param column: Name of the column
+        :param values: Constants to match
+        """
+        self.column = column
+        self.values = list(values)
+        self._set = set(self.values)
+
+    def __repr__(self):
+        return f"col({self.column!r}).isin({self.values!r})"
+
+    def evaluate(self, row: Dict[str,Any]) -> bool:
+        val = row[self.column]
+        return val is not None and val in self._set
+
+    def mask(self, arrays: Dict[str,Any]):
+        import numpy as np
+        arr = arrays[self.column]
+        values = [v.encode() if arr.dtype.kind == "S" and isinstance(v, str) else v
+            for v in self.values]
+        return np.isin(arr.data, values) & ~arr.mask
+
+    def compile(self, rstruct) -> Callable[[tuple],bool]:
+        flag, get, encode = _rawColumn(rstruct, self.column)
+        values = {encode(v) for v in self.values}
+        return lambda raw: raw[flag] and get(raw) in values
+
+    def mayMatch(self, stats: Dict[str,tuple], rstruct, blooms = None) -> bool:
+        encode = _rawColumn(rstruct, self.column)[2]
+        values = [encode(v) for v in self.values]
+        if blooms and self.column in blooms:
+            values = [v for v in values if blooms[self.column](v)]
+        if self.column not in stats: return bool(values)
+        n, _, lo, hi = stats[self.column]
+        try:
+            return bool(n) and any(lo <= v <= hi for v in values)
+        except TypeError:
+            return bool(values)
+
+    def columns(self) -> List[str]:
+        return [self.column]
+
+
+class IsNull(Expr):
+
+    def __init__(self, column: str):
+        """Matches rows where a column is null.
+
+        :param column: Name of the column
+        """
+        self.column = column
+
+    def __repr__(self):
+        return f"col({self.column!r}).isnull()"
+
+    def evaluate(self, row: Dict[str,Any]) -> bool:
+        return row[self.column] is None
+
+    def mask(self, arrays: Dict[str,Any]):
+        return arrays[self.column].mask.copy()
+
+    def compile(self, rstruct) -> Callable[[tuple],bool]:
+        flag, _, _ = _rawColumn(rstruct, self.column)
+        return lambda raw: not raw[flag]
+
+    def mayMatch(self, stats: Dict[str,tuple], rstruct, blooms = None) -> bool:
+        return self.column not in stats or stats[self.column][1] > 0
+
+    def columns(self) -> List[str]:
+        return [self.column]
+
+
+class And(Expr):
+
+    def __init__(self, *terms: Expr):
+        """Matches rows where all of ``terms`` match.
+
+        :param terms: Expressions to combine
+        """
+        self.terms = []
+        for t in terms:
+            assert isinstance(t, Expr), f"Can't combine \"{t!r}\" with an expression."
+            self.terms.extend(t.terms if isinstance(t, And) else [t])
+
+    def __repr__(self):
+        return "(" + " & ".join(map(repr, self.terms)) + ")"
+
+    def evaluate(self, row: Dict[str,Any]) -> bool:
+        return all(t.evaluate(row) for t in self.terms)
+
+    def mask(self, arrays: Dict[str,Any]):
+        result = self.terms[0].mask(arrays)
+        for t in self.terms[1:]:
+            result = result & t.mask(arrays)
+        return result
+
+    def compile(self, rstruct) -> Callable[[tuple],bool]:
+        fns = [t.compile(rstruct) for t in self.terms]
+        return lambda raw: all(fn(raw) for fn in fns)
+
+    def mayMatch(self, stats: Dict[str,tuple], rstruct, blooms = None) -> bool:
+        return all(t.mayMatch(stats, rstruct, blooms) for t in self.terms)
+
+    def conjuncts(self) -> List[Expr]:
+        return list(self.terms)
+
+    def columns(self) -> List[str]:
+        return list(dict.fromkeys(c for t in self.terms for c in t.columns()))
+
+
+class Or(Expr):
+
+    def __init__(self, *terms: Expr):
+        """Matches rows where any of ``terms`` match.
+
+        :param terms: Expressions to combine
+        """
+        self.terms = []
+        for t in terms:
+            assert isinstance(t, Expr), f"Can't combine \"{t!r}\" with an expression."
+            self.terms.extend(t.terms if isinstance(t, Or) else [t])
+
+    def __repr__(self):
+        return "(" + " | ".join(map(repr, self.terms)) + ")"
+
+    def evaluate(self, row: Dict[str,Any]) -> bool:
+        return any(t.evaluate(row) for t in self.terms)
+
+    def mask(self, arrays: Dict[str,Any]):
+        result = self.terms[0].mask(arrays)
+        for t in self.terms[1:]:
+            result = result | t.mask(arrays)
+        return result
+
+    def compile(self, rstruct) -> Callable[[tuple],bool]:
+        fns = [t.compile(rstruct) for t in self.terms]
+        return lambda raw: any(fn(raw) for fn in fns)
+
+    def mayMatch(self, stats: Dict[str,tuple], rstruct, blooms = None) -> bool:
+        return any(t.mayMatch(stats, rstruct, blooms) for t in self.terms)
+
+    def columns(self) -> List[str]:
+        return list(dict.fromkeys(c for t in self.terms for c in t.columns()))
+
+
+class Not(Expr):
+
+    def __init__(self, term: Expr):
+        """Matches rows where ``term`` doesn't match.
+
+        :param term: Expression to negate
+        """
+        assert isinstance(term, Expr), f"Can't negate \"{term!r}\"."
+        self.term = term
+
+    def __repr__(self):
+        return f"~{self.term!r}"
+
+    def evaluate(self, row: Dict[str,Any]) -> bool:
+        return not self.term.evaluate(row)
+
+    def mask(self, arrays: Dict[str,Any]):
+        return ~self.term.mask(arrays)
+
+    def compile(self, rstruct) -> Callable[[tuple],bool]:
+        fn = self.term.compile(rstruct)
+        return lambda raw: not fn(raw)
+
+    def columns(self) -> List[str]:
+        return self.term.columns()
+
+
+class Col:
+
+    def __init__(self, name: str):
+        """Reference to a table column, used to
+        build expressions with python's comparison
+        operators.
+
+        :param name: Name of the column
+        """
+        self.name = name
+
+    def __repr__(self):
+        return f"col({self.name!r})"
+
+    def __eq__(self, value) -> Compare: return Compare(self.name, "==", value)
+    def __ne__(self, value) -> Compare: return Compare(self.name, "!=", value)
+    def __lt__(self, value) -> Compare: return Compare(self.name, "<", value)
+    def __le__(self, value) -> Compare: return Compare(self.name, "<=", value)
+    def __gt__(self, value) -> Compare: return Compare(self.name, ">", value)
+    def __ge__(self, value) -> Compare: return Compare(self.name, ">=", value)
+
+    __hash__ = None
+
+    def isin(self, values: Iterable[Any]) -> In:
+        """Match rows where the column is one of ``values``."""
+        return In(self.name, values)
+
+    def between(self, lo: Any, hi: Any) -> And:
+        """Match rows where ``lo <= column <= hi``."""
+        return And(Compare(self.name, ">=", lo), Compare(self.name, "<=", hi))
+
+    def isnull(self) -> IsNull:
+        """Match rows where the column is null."""
+        return IsNull(self.name)
+
+    def notnull(self) -> Not:
+        """Match rows where the column isn't null."""
+        return Not(IsNull(self.name))
+
+
+def col(name: str) -> Col:
+    """Reference a column in a ``WHERE`` expression.
+
+    :param name: Name of the column
+    :return: Column reference
+    """
+    return Col(name)
+
+
+def column_bounds(terms: Iterable[Expr], columns: Iterable[str]
+    ) -> Dict[str,Tuple[Any,Any,bool,bool]]:
+    """Combine ``AND``-ed comparisons into one range per
+    column, eg for an index lookup. ``!=`` comparisons,
+    comparisons against ``None`` and other terms are skipped,
+    so rows in the ranges still need to be checked against
+    the whole expression.
+
+    :param terms: ``AND``-ed terms (see ``Expr.conjuncts``)
+    :param columns: Columns to find ranges for
+    :return: Mapping from column name to ``(lo, hi, lo_inc, hi_inc)``,
+        with ``None`` for an open end
+    """
+    columns = set(columns)
+    bounds = {}
+    for t in terms:
+        if not (isinstance(t, Compare) and t.column in columns
+            and t.op != "!=" and t.value is not None):
+            continue
+        lo, hi, lo_inc, hi_inc = bounds.get(t.column, (None, None, True, True))
+        try:
+            if t.op in ("==", ">", ">=") and (lo is None or t.value > lo
+                or (t.value == lo and t.op == ">")):
+                lo, lo_inc = t.value, t.op != ">"
+            if t.op in ("==", "<", "<=") and (hi is None or t.value < hi
+                or (t.value == hi and t.op == "<")):
+                hi, hi_inc = t.value, t.op != "<"
+        except TypeError:
+            continue
+        bounds[t.column] = (lo, hi, lo_inc, hi_inc)
+    return bounds
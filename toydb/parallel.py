@@ -0,0 +1,104 @@
+"""Parallel table scans.
+
+A table's rows have a fixed size, so a table file can be
+split into ranges of rows by offset and each range scanned
+by a different process. The functions here run in the worker
+processes, so they only take picklable arguments and read
+the table file directly.
+"""
+
+from .BlockFile import BlockFile
+from .RowStruct import RowStruct
+from .StringHeap import StringHeap
+from .aggregates import HashAggregator
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+READ_SIZE = 4 * 2 ** 20
+
+
+def split_ranges(n_rows: int, n_chunks: int, min_rows: int = 1) -> List[Tuple[int,int]]:
+    """Split a table's rows into contiguous ranges.
+
+    :param n_rows: Number of rows in the table
+    :param n_chunks: Number of ranges to aim for
+    :param min_rows: Smallest range size
+    :return: List of ``(start, stop)`` row ranges
+    """
+    size = max(min_rows, -(-n_rows // max(1, n_chunks)))
+    return [(start, min(start + size, n_rows)) for start in range(0, n_rows, size)]
+
+
+def _iter_range(task: dict) -> Iterator[Tuple[RowStruct,tuple]]:
+    """Read and filter the rows in a range of a table file.
+
+    :param task: Dict with the table's ``filename``, ``columns``,
+        ``types``, ``tombstone`` flag, ``heap`` file (or ``None``)
+        and ``compression`` settings (or ``None``, see ``BlockFile``),
+        the range's ``start``
+        and ``stop`` rows, the columns to ``read`` and the
+        ``where`` expression (or ``None``).
+    :yields: ``(codec, raw)`` pairs for the matching live rows
+    """
+    heap = None if task["heap"] is None else StringHeap(task["heap"])
+    rstruct = RowStruct(task["columns"], task["types"], tombstone=task["tombstone"],
+        heap=heap)
+    where = task["where"]
+    read = list(task["read"])
+    if where is not None:
+        read += where.columns()
+    codec = rstruct.project(read)
+    match = None if where is None else where.compile(codec)
+    live = codec.tombstone
+    row_size = codec.row_struct.size
+    batch_rows = max(1, READ_SIZE // row_size)
+    if task["compression"]:
+        read = BlockFile(task["filename"], **task["compression"]).read
+    else:
+        f = open(task["filename"], "rb")
+        def read(offset, n):
+            f.seek(offset)
+            return f.read(n)
+    try:
+        for start in range(task["start"], task["stop"], batch_rows):
+            n = min(batch_rows, task["stop"] - start)
+            data = read(start * row_size, n * row_size)
+            data = data[:len(data) - len(data) % row_size]
+            for raw in codec.row_struct.iter_unpack(data):
+                if live and not raw[-1]: continue
+                if match is None or match(raw):
+                    yield codec, raw
+    finally:
+        if not task["compression"]:
+            f.close()
+
+
+def scan_range(task: dict) -> Tuple[List[str],List[tuple]]:
+    """Scan a range of a table (see ``_iter_range``).
+
+    :param task: Description of the range to scan
+    :return: The column names, and the matching rows as
+        tuples of those columns
+    """
+    rows, cols = [], None
+    for codec, raw in _iter_range(task):
+        rows.append(tuple(codec._decodeRow(raw)))
+        cols = codec.columns
+    return cols, rows
+
+
+def aggregate_range(task: dict) -> List[Dict[tuple,list]]:
+    """Aggregate a range of a table (see ``_iter_range``).
+
+    :param task: Description of the range to scan, plus the
+        ``group_by`` columns, ``aggregates`` and ``max_groups``
+        (see ``HashAggregator``).
+    :return: Partial aggregate states, to be merged with
+        ``HashAggregator.mergeStates``
+    """
+    aggregator = HashAggregator(task["group_by"], task["aggregates"],
+        task["max_groups"], task["tmp_dir"])
+    for codec, raw in _iter_range(task):
+        aggregator.update(dict(zip(codec.columns, codec._decodeRow(raw))))
+    return list(aggregator.partialStates())
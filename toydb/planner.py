@@ -0,0 +1,347 @@
+"""Table statistics and cost estimates for choosing
+how to scan a table.
+
+``Database.analyze`` collects per-column statistics
+(see ``analyze_rows``), and the planner uses them to
+estimate how many rows a filter matches, and so whether
+an index lookup is cheaper than scanning the table (see
+``Database.explain``).
+
+Costs are in units of sequentially reading one page.
+"""
+
+import math
+import bisect
+import random
+import hashlib
+
+from . import expr
+
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+
+SEQ_PAGE_COST = 1.0
+RANDOM_PAGE_COST = 4.0
+CPU_ROW_COST = 0.01
+CPU_INDEX_COST = 0.005
+ZONE_COST = 0.01
+
+# Selectivities to assume without statistics
+DEFAULT_EQ_SEL = 0.005
+DEFAULT_RANGE_SEL = 1 / 3
+
+HISTOGRAM_BUCKETS = 32
+SAMPLE_ROWS = 10_000
+
+
+class HyperLogLog:
+
+    def __init__(self, p: int = 12):
+        """Estimates the number of distinct values in a
+        stream, using ``2 ** p`` one-byte registers (about
+        1.6% standard error for ``p=12``).
+
+        :param p: Number of hash bits used to pick a register
+        """
+        assert 4 <= p <= 16
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def add(self, value: Any):
+        """Add a value to the stream."""
+        x = int.from_bytes(hashlib.blake2b(repr(value).encode(),
+            digest_size=8).digest(), "big")
+        j = x >> (64 - self.p)
+        rank = 64 - self.p - (x & ((1 << (64 - self.p)) - 1)).bit_length() + 1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def count(self) -> int:
+        """Estimate the number of distinct values added."""
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if est <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small counts
+            est = m * math.log(m / zeros)
+        return int(round(est))
+
+
+def analyze_rows(rows: Iterable[Dict[str,Any]], columns: List[str],
+    sample_rows: int = SAMPLE_ROWS, buckets: int = HISTOGRAM_BUCKETS) -> dict:
+    """Collect statistics about a table's rows.
+
+    Null counts are exact, distinct counts are estimated
+    with a ``HyperLogLog``, and histograms are equi-depth
+    bucket bounds taken from a random sample of the values.
+
+    :param rows: The table's live rows, as dicts
+    :param columns: Columns to collect statistics for
+    :param sample_rows: Max number of values to sample
+        per column for the histograms
+    :param buckets: Max number of histogram buckets
+    :return: ``{"rows": n, "columns": {column: {"null_frac",
+        "distinct", "histogram"}}}``
+    """
+    rng = random.Random(0)
+    hlls = {c: HyperLogLog() for c in columns}
+    nulls = dict.fromkeys(columns, 0)
+    samples = {c: [] for c in columns}
+    seen = dict.fromkeys(columns, 0)
+    n = 0
+    for row in rows:
+        n += 1
+        for c in columns:
+            v = row[c]
+            if v is None or v != v:
+                nulls[c] += v is None
+                continue
+            hlls[c].add(v)
+            # Reservoir sample
+            seen[c] += 1
+            if len(samples[c]) < sample_rows:
+                samples[c].append(v)
+            else:
+                i = rng.randrange(seen[c])
+                if i < sample_rows:
+                    samples[c][i] = v
+    stats = {}
+    for c in columns:
+        sample = sorted(samples[c])
+        k = min(buckets, len(sample) - 1)
+        hist = [sample[round(j * (len(sample) - 1) / k)] for j in range(k + 1)] \
+            if k > 0 else sample
+        stats[c] = {
+            "null_frac": nulls[c] / n if n else 0.0,
+            "distinct": min(hlls[c].count(), seen[c]) if seen[c] else 0,
+            "histogram": hist,
+        }
+    return {"rows": n, "columns": stats}
+
+
+def _fractionBelow(hist: list, value: Any) -> float:
+    """Estimate the fraction of non-null values below
+    ``value``, interpolating within a histogram bucket.
+    """
+    if value <= hist[0]:
+        return 0.0
+    if value > hist[-1]:
+        return 1.0
+    i = bisect.bisect_left(hist, value)
+    lo, hi = hist[i - 1], hist[i]
+    t = 0.5
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool)
+        for v in (lo, hi, value)) and hi > lo:
+        t = (value - lo) / (hi - lo)
+    return (i - 1 + t) / (len(hist) - 1)
+
+
+def _eqSel(cstats: Optional[dict], value: Any) -> float:
+    if value is None:
+        return 0.0
+    if cstats is None:
+        return DEFAULT_EQ_SEL
+    hist = cstats["histogram"]
+    try:
+        if not hist or value < hist[0] or value > hist[-1]:
+            return 0.0
+    except TypeError:
+        return DEFAULT_EQ_SEL
+    return (1 - cstats["null_frac"]) / max(cstats["distinct"], 1)
+
+
+def _rangeSel(cstats: Optional[dict], lo: Any, hi: Any,
+    lo_inc: bool = True, hi_inc: bool = True) -> float:
+    """Estimate the fraction of rows with a column between
+    ``lo`` and ``hi`` (either can be ``None``, for no bound).
+    """
+    if cstats is None:
+        return DEFAULT_EQ_SEL if lo is not None and lo == hi else DEFAULT_RANGE_SEL
+    hist = cstats["histogram"]
+    if not hist:
+        return 0.0
+    try:
+        below_hi = 1.0 if hi is None else _fractionBelow(hist, hi)
+        below_lo = 0.0 if lo is None else _fractionBelow(hist, lo)
+        eq = lambda v: _eqSel(cstats, v) / max(1 - cstats["null_frac"], 1e-9)
+        frac = below_hi - below_lo + (eq(hi) if hi is not None and hi_inc else 0.0) \
+            - (eq(lo) if lo is not None and not lo_inc else 0.0)
+    except TypeError:
+        return DEFAULT_RANGE_SEL
+    return min(max(frac, 0.0), 1.0) * (1 - cstats["null_frac"])
+
+
+def selectivity(where, stats: Optional[dict]) -> float:
+    """Estimate the fraction of a table's rows matching
+    a filter.
+
+    Terms are assumed to be independent. Plain callables
+    are assumed to match ``DEFAULT_RANGE_SEL`` of the rows.
+
+    :param where: ``toydb.expr`` expression, callable or ``None``
+    :param stats: The table's statistics (see ``analyze_rows``),
+        or ``None`` to use default estimates
+    :return: Fraction between 0 and 1
+    """
+    if where is None:
+        return 1.0
+    cols = (stats or {}).get("columns", {})
+    if isinstance(where, expr.Compare):
+        cstats = cols.get(where.column)
+        if where.value is None:
+            # Comparisons with nulls are always false
+            return 0.0
+        if where.op == "==":
+            return _eqSel(cstats, where.value)
+        if where.op == "!=":
+            nn = 1 - cstats["null_frac"] if cstats else 1.0
+            return max(nn - _eqSel(cstats, where.value), 0.0)
+        if where.op in (">", ">="):
+            return _rangeSel(cstats, where.value, None, lo_inc=where.op == ">=")
+        return _rangeSel(cstats, None, where.value, hi_inc=where.op == "<=")
+    if isinstance(where, expr.In):
+        return min(sum(_eqSel(cols.get(where.column), v)
+            for v in set(where.values)), 1.0)
+    if isinstance(where, expr.IsNull):
+        cstats = cols.get(where.column)
+        return cstats["null_frac"] if cstats else DEFAULT_EQ_SEL
+    if isinstance(where, expr.And):
+        return _prod(selectivity(t, stats) for t in where.terms)
+    if isinstance(where, expr.Or):
+        return 1 - _prod(1 - selectivity(t, stats) for t in where.terms)
+    if isinstance(where, expr.Not):
+        return 1 - selectivity(where.term, stats)
+    return DEFAULT_RANGE_SEL
+
+
+def _prod(values: Iterable[float]) -> float:
+    result = 1.0
+    for v in values:
+        result *= v
+    return result
+
+
+def index_selectivity(where, stats: Optional[dict], indexed: Set[str]
+    ) -> Optional[Tuple[float,float]]:
+    """Estimate how much of a table an index lookup for
+    ``where`` would read, following the same rules as
+    ``Database._indexRows``.
+
+    :param where: ``toydb.expr`` expression
+    :param stats: The table's statistics, or ``None``
+    :param indexed: Names of the table's indexed columns
+    :return: ``(fetched, entries)`` -- the fraction of rows
+        that would be fetched from the table, and the fraction
+        of index entries that would be read (summed over the
+        indexes used) -- or ``None`` if no index can be used.
+    """
+    if not isinstance(where, expr.Expr):
+        return None
+    if isinstance(where, expr.Or):
+        parts = [index_selectivity(t, stats, indexed) for t in where.terms]
+        if any(p is None for p in parts):
+            return None
+        return min(sum(p[0] for p in parts), 1.0), sum(p[1] for p in parts)
+    if isinstance(where, expr.In):
+        if where.column not in indexed:
+            return None
+        sel = selectivity(where, stats)
+        return sel, sel
+    cols = (stats or {}).get("columns", {})
+    parts = []
+    for t in where.conjuncts():
+        if isinstance(t, (expr.Or, expr.In)):
+            p = index_selectivity(t, stats, indexed)
+            if p is not None: parts.append(p)
+    bounds = expr.column_bounds(where.conjuncts(), indexed)
+    for column, (lo, hi, lo_inc, hi_inc) in bounds.items():
+        if lo is not None and lo == hi and lo_inc and hi_inc:
+            sel = _eqSel(cols.get(column), lo)
+        else:
+            sel = _rangeSel(cols.get(column), lo, hi, lo_inc, hi_inc)
+        parts.append((sel, sel))
+    if not parts:
+        return None
+    # Intersecting the lookups' results
+    return _prod(p[0] for p in parts), sum(p[1] for p in parts)
+
+
+def scan_cost(n_pages: int, n_rows: int, n_zones: int = 0) -> float:
+    """Estimate the cost of reading pages in order.
+
+    :param n_pages: Number of pages read
+    :param n_rows: Number of rows checked against the filter
+    :param n_zones: Number of zones checked to skip pages
+    """
+    return n_pages * SEQ_PAGE_COST + n_rows * CPU_ROW_COST + n_zones * ZONE_COST
+
+
+def index_cost(n_rows: float, n_entries: float, n_pages: int) -> float:
+    """Estimate the cost of an index lookup, and of fetching
+    the rows it finds.
+
+    :param n_rows: Number of rows fetched from the table
+    :param n_entries: Number of index entries read
+    :param n_pages: Number of pages in the table. Rows on
+        the same page only cost one page read.
+    """
+    pages = min(n_rows, n_pages)
+    return pages * RANDOM_PAGE_COST + n_rows * CPU_ROW_COST + n_entries * CPU_INDEX_COST
+
+
+class Plan:
+
+    def __init__(self, method: str, table: str, cost: float, rows: float,
+        pages: Optional[int] = None, n_pages: Optional[int] = None,
+        index: Optional[List[str]] = None, where = None):
+        """How a table is read for a query.
+
+        :param method: ``"seq_scan"`` (read every page),
+            ``"zone_scan"`` (skip pages using zone maps and
+            Bloom filters) or ``"index_scan"`` (look rows up
+            in indexes)
+        :param table: Table being read
+        :param cost: Estimated cost (see ``scan_cost`` and ``index_cost``)
+        :param rows: Estimated number of matching rows
+        :param pages: Number of pages read by a scan
+        :param n_pages: Number of pages in the table
+        :param index: Indexed columns an index scan can use
+        :param where: The filter
+        """
+        self.method = method
+        self.table = table
+        self.cost = cost
+        self.rows = rows
+        self.pages = pages
+        self.n_pages = n_pages
+        self.index = index
+        self.where = where
+        self.analyzed = False
+        self.alternatives = []
+        self.steps = []
+
+    def __repr__(self):
+        return f"<toydb.planner.Plan {self.method} on {self.table} cost={self.cost:.2f}>"
+
+    def _line(self) -> str:
+        line = f"{self.method} on {self.table}"
+        if self.index:
+            line += f" using {', '.join(self.index)}"
+        line += f"  (cost={self.cost:.2f} rows={round(self.rows)}"
+        if self.pages is not None:
+            line += f" pages={self.pages}/{self.n_pages}"
+        return line + ")"
+
+    def __str__(self):
+        lines = [("  " * i) + step for i, step in enumerate(self.steps)]
+        indent = "  " * len(self.steps)
+        lines.append(indent + self._line())
+        if self.where is not None:
+            lines.append(indent + f"  filter: {self.where!r}")
+        if not self.analyzed:
+            lines.append(indent + "  (table not analyzed -- using default estimates)")
+        for alt in self.alternatives:
+            lines.append(indent + f"  rejected: {alt._line()}")
+        return "\n".join(lines)
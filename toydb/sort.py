@@ -0,0 +1,145 @@
+
+import heapq
+import pickle
+import tempfile
+import itertools as it
+from pathlib import Path
+
+from typing import Union, Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+
+def normalize_order_by(order_by: Union[str,Tuple[str,str],List[Union[str,Tuple[str,str]]]]
+    ) -> List[Tuple[str,bool]]:
+    """Normalize an ``ORDER BY`` specification.
+
+    :param order_by: A column name, a ``(column, "asc"|"desc")``
+        tuple, or a list of either.
+    :return: List of ``(column, descending)`` tuples
+    """
+    if isinstance(order_by, str) or (isinstance(order_by, tuple)
+        and len(order_by) == 2 and str(order_by[1]).lower() in ("asc", "desc")):
+        order_by = [order_by]
+    result = []
+    for o in order_by:
+        if isinstance(o, str):
+            o = (o, "asc")
+        col, direction = o
+        direction = direction.lower()
+        assert direction in ("asc", "desc"), f"Invalid sort direction \"{direction}\"."
+        result.append((col, direction == "desc"))
+    return result
+
+
+class SortKey:
+    __slots__ = ("values", "desc")
+
+    def __init__(self, values: tuple, desc: tuple):
+        """Sort key for a row, supporting a mix of
+        ascending and descending columns.
+
+        Nulls sort last in ascending order and first
+        in descending order (matching ``BTree`` indexes).
+
+        :param values: Values of the sort columns
+        :param desc: Whether each column is sorted descending
+        """
+        self.values = values
+        self.desc = desc
+
+    def __lt__(self, other: "SortKey") -> bool:
+        for v, o, d in zip(self.values, other.values, self.desc):
+            if v == o: continue
+            if v is None: lt = False
+            elif o is None: lt = True
+            else: lt = v < o
+            return (not lt) if d else lt
+        return False
+
+
+def make_key(order_by: List[Tuple[str,bool]]) -> Callable[[Dict[str,Any]],SortKey]:
+    """Create a key function for sorting row dicts.
+
+    :param order_by: Normalized ``ORDER BY`` spec
+        (see ``normalize_order_by``)
+    :return: Function mapping a row dict to its ``SortKey``
+    """
+    cols = tuple(c for c, _ in order_by)
+    desc = tuple(d for _, d in order_by)
+    return lambda row: SortKey(tuple(row[c] for c in cols), desc)
+
+
+def top_k(rows: Iterable[Dict[str,Any]], key: Callable, k: int) -> List[Dict[str,Any]]:
+    """Get the first ``k`` rows in sorted order, keeping
+    at most ``k`` rows in memory (using a bounded heap).
+
+    :param rows: Rows to sort
+    :param key: Sort key function
+    :param k: Number of rows to keep
+    :return: Sorted list of up to ``k`` rows
+    """
+    return heapq.nsmallest(k, rows, key=key)
+
+
+def _writeRun(rows: List[Any], tmp_dir: Path, chunk_size: int = 1000):
+    """Spill a sorted run of rows to a temporary file.
+
+    :return: Open temporary file, positioned at the start
+    """
+    f = tempfile.TemporaryFile(dir=str(tmp_dir), suffix=".run")
+    for i in range(0, len(rows), chunk_size):
+        pickle.dump(rows[i:i + chunk_size], f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+
+def _readRun(f) -> Iterator[Any]:
+    """Stream the rows back out of a spilled run, then
+    close (and so delete) the temporary file.
+    """
+    try:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            yield from chunk
+    finally:
+        f.close()
+
+
+def external_sort(rows: Iterable[Dict[str,Any]], key: Callable, buffer_rows: int,
+    tmp_dir: Union[str,Path]) -> Iterator[Dict[str,Any]]:
+    """Sort rows that might not fit in memory.
+
+    Rows are read ``buffer_rows`` at a time, and each
+    batch is sorted and spilled to a temporary file in
+    ``tmp_dir``. The sorted runs are then streamed back
+    and merged. If everything fits in a single batch,
+    nothing is written to disk.
+
+    The sort is stable.
+
+    :param rows: Rows to sort
+    :param key: Sort key function
+    :param buffer_rows: Max number of rows to hold in memory
+    :param tmp_dir: Directory for the sorted runs
+    :yields: Rows in sorted order
+    """
+    assert buffer_rows > 0
+    rows = iter(rows)
+    runs = []
+    try:
+        while True:
+            batch = list(it.islice(rows, buffer_rows))
+            batch.sort(key=key)
+            if not runs and len(batch) < buffer_rows:
+                yield from batch
+                return
+            if not batch: break
+            tmp_dir = Path(tmp_dir)
+            tmp_dir.mkdir(exist_ok=True)
+            runs.append(_writeRun(batch, tmp_dir))
+        yield from heapq.merge(*map(_readRun, runs), key=key)
+    finally:
+        for f in runs:
+            f.close()
@@ -1,8 +1,10 @@
 
+import os
 import hashlib
 import itertools as it
+from pathlib import Path
 
-from typing import Iterable, Generator
+from typing import Union, Iterable, Generator
 
 def md5(text: str) -> str:
     """md5 hash function.
@@ -26,3 +28,42 @@ def iter_limit(itr: Iterable, limit: int) -> Generator:
     for i, v in zip(it.count(),itr):
         if i >= limit: break
         yield v
+
+def fsync_dir(path: Union[str,Path]):
+    """Flush a directory's entries to disk, so files
+    created or renamed in it survive a crash.
+
+    Does nothing on platforms that can't open
+    directories (eg Windows).
+
+    :param path: Directory to sync
+    """
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_atomic(path: Union[str,Path], text: str):
+    """Replace a file's contents atomically.
+
+    The text is written to a temporary file, which is
+    fsync-ed and then renamed over ``path``, so readers
+    (and crashes) see either the old or the new contents.
+
+    :param path: File to write
+    :param text: New contents of the file
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(str(tmp), str(path))
+    fsync_dir(path.parent)